@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Reference agent which pushes completed SLURM jobs to Waldur.
+
+It runs on the cluster head node, reads jobs finished since the previous run
+from sacct and posts them in batches to the ingest endpoint of SLURM service:
+
+    slurm_usage_agent.py --url https://waldur.example.com/api/slurm/<service_uuid>/ingest/ \\
+        --token <staff_token> --state-file /var/lib/waldur/slurm_agent.state
+
+Time of the latest delivered job end is stored in the state file after each
+successful batch, so that the agent can be restarted at any moment.
+Waldur skips jobs it has already received, therefore delivering a batch twice is safe.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import subprocess  # nosec
+import sys
+import time
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+FIELDS = 'Account,ReqTRES,Elapsed,User,JobID,End'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def read_state(path, default):
+    try:
+        with open(path) as state_file:
+            return state_file.read().strip() or default
+    except IOError:
+        return default
+
+
+def write_state(path, value):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as state_file:
+        state_file.write(value)
+    os.rename(temporary_path, path)
+
+
+def get_completed_jobs(since, until):
+    command = [
+        'sacct', '--parsable2', '--noheader', '--noconvert', '--allocations', '--allusers',
+        '--state=CD,F,TO,CA,NF,OOM',
+        '--starttime=%s' % since, '--endtime=%s' % until,
+        '--format=%s' % FIELDS,
+    ]
+    output = subprocess.check_output(command).decode('utf-8')  # nosec
+    jobs = [line.split('|') for line in output.splitlines() if '|' in line]
+    # Only jobs which have finished within the period are reported
+    jobs = [job for job in jobs if since <= job[5] < until]
+    return sorted(jobs, key=lambda job: job[5])
+
+
+def push_jobs(url, token, jobs):
+    request = Request(url, data=json.dumps({'jobs': jobs}).encode('utf-8'), headers={
+        'Authorization': 'Token %s' % token,
+        'Content-Type': 'application/json',
+    })
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+def run_once(options):
+    default_since = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime(TIME_FORMAT)
+    since = read_state(options.state_file, default_since)
+    until = datetime.datetime.now().strftime(TIME_FORMAT)
+
+    jobs = get_completed_jobs(since, until)
+    for start in range(0, len(jobs), options.batch_size):
+        batch = jobs[start:start + options.batch_size]
+        result = push_jobs(options.url, options.token, batch)
+        # Jobs ending at the same second as the last one of the batch are resent with the next batch
+        write_state(options.state_file, batch[-1][5])
+        print('Pushed %(ingested)s jobs, skipped %(skipped)s jobs.' % result)
+    write_state(options.state_file, until)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push completed SLURM jobs to Waldur.')
+    parser.add_argument('--url', required=True, help='URL of ingest endpoint of SLURM service.')
+    parser.add_argument('--token', required=True, help='Authentication token of Waldur staff user.')
+    parser.add_argument('--state-file', required=True, help='File storing time of the latest pushed job.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Maximum number of jobs in request.')
+    parser.add_argument('--interval', type=int, default=0,
+                        help='Run continuously with given delay in seconds between runs.')
+    options = parser.parse_args()
+
+    while True:
+        try:
+            run_once(options)
+        except Exception as e:
+            print('Unable to push jobs: %s' % e, file=sys.stderr)
+            if not options.interval:
+                return 1
+        if not options.interval:
+            return 0
+        time.sleep(options.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,7 @@ from setuptools import setup, find_packages
 
 
 install_requires = [
+    'requests>=2.6.0',
     'waldur-core>=0.157.5',
     'waldur-freeipa>=0.2.4',
 ]
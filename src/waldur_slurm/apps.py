@@ -18,6 +18,7 @@ class SlurmConfig(AppConfig):
 
         from .backend import SlurmBackend
         from . import handlers, models, utils
+        from . import signals as slurm_signals
 
         SupportedServices.register_backend(SlurmBackend)
 
@@ -79,3 +80,47 @@ class SlurmConfig(AppConfig):
             sender=models.Allocation,
             dispatch_uid='waldur_slurm.handlers.update_quotas_on_allocation_usage_update',
         )
+
+        signals.post_save.connect(
+            handlers.bump_version_stamp_on_allocation_change,
+            sender=models.Allocation,
+            dispatch_uid='waldur_slurm.handlers.bump_version_stamp_on_allocation_save',
+        )
+
+        signals.post_delete.connect(
+            handlers.bump_version_stamp_on_allocation_change,
+            sender=models.Allocation,
+            dispatch_uid='waldur_slurm.handlers.bump_version_stamp_on_allocation_delete',
+        )
+
+        # Allocation listing depends on related objects and user permissions too
+        related_models = (
+            structure_models.Customer,
+            structure_models.Project,
+            structure_models.ServiceSettings,
+            freeipa_models.Profile,
+        )
+        global_stamp_signals = (
+            ('post_save', signals.post_save, related_models),
+            ('post_delete', signals.post_delete, related_models),
+            ('role_granted', structure_signals.structure_role_granted, structure_models_with_roles),
+            ('role_revoked', structure_signals.structure_role_revoked, structure_models_with_roles),
+        )
+        for signal_name, signal, senders in global_stamp_signals:
+            for model in senders:
+                signal.connect(
+                    handlers.bump_global_version_stamp,
+                    sender=model,
+                    dispatch_uid='waldur_slurm.handlers.bump_global_version_stamp.%s.%s' % (
+                        signal_name, model.__name__),
+                )
+
+        slurm_signals.batch_command_executed.connect(
+            handlers.record_command_metrics,
+            dispatch_uid='waldur_slurm.handlers.record_command_metrics',
+        )
+
+        slurm_signals.batch_command_queued.connect(
+            handlers.record_command_wait_metrics,
+            dispatch_uid='waldur_slurm.handlers.record_command_wait_metrics',
+        )
@@ -1,6 +1,6 @@
-from functools import reduce
+import itertools
 import logging
-import operator
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings as django_settings
 from django.db import transaction
@@ -11,12 +11,19 @@ from waldur_core.structure import ServiceBackend, ServiceBackendError
 from waldur_freeipa import models as freeipa_models
 from waldur_slurm.client import SlurmClient
 from waldur_slurm.client_moab import MoabClient
-from waldur_slurm.structures import Quotas
+from waldur_slurm.client_rest import SlurmRestClient
+from waldur_slurm.structures import Quotas, get_tres_schema
 
-from . import models, base
+from . import base, ledger, models, profiling, scheduling, transport, utils
 
 logger = logging.getLogger(__name__)
 
+# Fields of allocation used by usage synchronization, other fields are not loaded
+SYNC_FIELDS = (
+    ('uuid', 'service_project_link', 'tres_usage', 'usage_velocity', 'last_usage_sync') +
+    ledger.USAGE_FIELDS + tuple(limit_field for _, limit_field in scheduling.LIMIT_FIELDS)
+)
+
 
 class SlurmBackend(ServiceBackend):
     def __init__(self, settings):
@@ -25,19 +32,50 @@ class SlurmBackend(ServiceBackend):
 
     def get_client(self, settings):
         batch_service = models.get_batch_service(settings)
+        slurmrestd_url = settings.options.get('slurmrestd_url')
+        if batch_service == 'SLURM' and slurmrestd_url:
+            client = SlurmRestClient(
+                url=slurmrestd_url,
+                token=settings.token,
+                username=settings.username or 'root',
+                verify=settings.options.get('verify_ssl', True),
+            )
+            self._configure_client(client, settings)
+            return client
+
         cls = SlurmClient
         if batch_service == 'MOAB':
             cls = MoabClient
-        return cls(
-            hostname=settings.options.get('hostname', 'localhost'),
+        hostname = settings.options.get('hostname', 'localhost')
+        client = cls(
+            hostname=hostname,
             username=settings.username or 'root',
             port=settings.options.get('port', 22),
             key_path=django_settings.WALDUR_SLURM['PRIVATE_KEY_PATH'],
             use_sudo=settings.options.get('use_sudo', False),
+            transport=transport.get_transport(hostname),
         )
+        self._configure_client(client, settings)
+        if isinstance(client, SlurmClient):
+            # JSON usage report is used if it is supported by cluster unless it is configured explicitly
+            client.use_json = settings.options.get('sacct_json')
+        trace_dir = django_settings.WALDUR_SLURM.get('COMMAND_TRACE_DIR')
+        if trace_dir:
+            client.transport = transport.RecordingTransport(
+                client.transport, transport.get_trace_path(trace_dir, hostname))
+        return client
+
+    def _configure_client(self, client, settings):
+        client.capabilities_scope = settings.uuid.hex
+        # Concurrency limit of the cluster overrides the global one
+        client.max_concurrency = (settings.options.get('max_concurrent_commands') or
+                                  django_settings.WALDUR_SLURM.get('MAX_CONCURRENT_COMMANDS'))
+        client.queue_timeout = django_settings.WALDUR_SLURM.get('COMMAND_QUEUE_TIMEOUT', 5 * 60)
 
     def sync(self):
-        self.sync_usage()
+        # Usage of allocations is synchronized by sync_due_usage task if adaptive schedule is enabled
+        if not scheduling.is_enabled():
+            self.sync_usage()
 
     def ping(self, raise_exception=False):
         try:
@@ -107,16 +145,29 @@ class SlurmBackend(ServiceBackend):
         if self.client.get_association(username, account):
             self.client.delete_association(username, account)
 
-    def set_resource_limits(self, allocation):
-        quotas = Quotas(
+    def get_allocation_limits(self, allocation):
+        return Quotas(
             cpu=allocation.cpu_limit,
             gpu=allocation.gpu_limit,
             ram=allocation.ram_limit,
             deposit=allocation.deposit_limit,
+            extra={name: allocation.tres_limits.get(name, -1) for name in get_tres_schema().extra},
         )
 
+    def set_resource_limits(self, allocation):
+        quotas = self.get_allocation_limits(allocation)
         self.client.set_resource_limits(self.get_allocation_name(allocation), quotas)
 
+    def set_resource_limits_bulk(self, allocations):
+        """
+        Apply limits of many allocations using as few batch commands as possible.
+        :return: dict mapping allocation to error message or None if limits are applied
+        """
+        accounts = {self.get_allocation_name(allocation): allocation for allocation in allocations}
+        limits = [(account, self.get_allocation_limits(allocation)) for account, allocation in accounts.items()]
+        results = self.client.set_resource_limits_bulk(limits)
+        return {allocation: results.get(account) for account, allocation in accounts.items()}
+
     def cancel_allocation(self, allocation):
         allocation.cpu_limit = allocation.cpu_usage
         allocation.gpu_limit = allocation.gpu_usage
@@ -126,74 +177,249 @@ class SlurmBackend(ServiceBackend):
         self.set_resource_limits(allocation)
 
         allocation.is_active = False
-        allocation.save()
+        allocation.save(update_fields=['cpu_limit', 'gpu_limit', 'ram_limit', 'deposit_limit', 'is_active'])
 
-    def sync_usage(self):
-        waldur_allocations = {
-            self.get_allocation_name(allocation): allocation
-            for allocation in self.get_allocation_queryset()
-        }
+    def sync_usage(self, allocations=None):
+        """
+        Synchronize usage of the current month.
+        Allocations are processed in chunks: usage of each chunk is fetched from the cluster and
+        committed separately, so that memory usage and transaction size do not depend on size of the cluster.
+        Synchronization of all allocations records checkpoint after each chunk and
+        if it has been interrupted, the next one is resumed after the last committed chunk.
+        Synchronization is skipped if usage of the cluster is already being synchronized by another worker.
+        Usage rollups of affected customers are recalculated once after all chunks.
+        :param allocations: optional subset of allocations of the cluster, all of them are synchronized by default
+        """
+        with self._usage_lock() as lease:
+            if not lease.acquired:
+                logger.info('Skipping usage synchronization of %s because it is already in progress.',
+                            self.settings)
+                return
+            self._sync_usage(allocations, lease)
+
+    def _sync_usage(self, allocations, lease):
+        queryset = self.get_allocation_queryset().only(*SYNC_FIELDS)
+        checkpoint = None
+        resumed_after = None
+        if allocations is not None:
+            queryset = queryset.filter(pk__in=[allocation.pk for allocation in allocations])
+        else:
+            checkpoint = self._get_sync_checkpoint()
+            resumed_after = checkpoint.last_allocation_id
+        chunks = utils.iterate_chunks(
+            queryset,
+            django_settings.WALDUR_SLURM.get('SYNC_CHUNK_SIZE', 500),
+            start_after=resumed_after,
+        )
+        synchronized = False
+        # Usage rollups are recalculated once after all chunks, because allocations of customer may span many chunks
+        groups = set()
+
+        profiler = profiling.get_sync_profiler(self.settings, self.client.hostname)
+        with profiler:
+            while True:
+                with profiler.phase('load') as phase:
+                    chunk = next(chunks, [])
+                    phase.rows = len(chunk)
+
+                if not chunk:
+                    break
+
+                groups |= self._sync_usage_chunk(chunk, profiler, checkpoint)
+                lease.extend()
+                synchronized = True
+
+            with profiler.phase('rollup') as phase:
+                customers = ledger.get_rollup_customers(groups)
+                if resumed_after:
+                    # Rollups of allocations synchronized before interruption have not been recalculated yet
+                    now = timezone.now()
+                    customers[(now.year, now.month)].update(
+                        queryset.filter(pk__lte=resumed_after).order_by().values_list(
+                            'service_project_link__project__customer_id', flat=True).distinct())
+                phase.rows = ledger.update_customer_rollups(customers)
+
+        if checkpoint is not None:
+            checkpoint.last_allocation_id = 0
+            checkpoint.save(update_fields=['last_allocation_id', 'modified'])
+
+        if synchronized:
+            utils.bump_version_stamp(self.settings.pk)
+
+    def _get_sync_checkpoint(self):
+        now = timezone.now()
+        checkpoint, _ = models.UsageSyncCheckpoint.objects.get_or_create(
+            settings=self.settings, defaults={'year': now.year, 'month': now.month})
+
+        if (checkpoint.year, checkpoint.month) != (now.year, now.month):
+            # Usage of the new month is synchronized for all allocations
+            checkpoint.year, checkpoint.month, checkpoint.last_allocation_id = now.year, now.month, 0
+            checkpoint.save(update_fields=['year', 'month', 'last_allocation_id', 'modified'])
+        elif checkpoint.last_allocation_id:
+            logger.info('Resuming interrupted usage synchronization of %s after allocation with ID %s.',
+                        self.settings, checkpoint.last_allocation_id)
+        return checkpoint
+
+    def _sync_usage_chunk(self, allocations, profiler, checkpoint=None):
+        """
+        Usage report is fetched before transaction is opened, so that database connection
+        is not kept idle in transaction while the command is running on the cluster.
+        :return: set of (allocation ID, year, month) groups which usage has been recalculated
+        """
+        waldur_allocations = {self.get_allocation_name(allocation): allocation for allocation in allocations}
+        previous_usage = {allocation.pk: allocation.cpu_usage for allocation in allocations}
+
+        with profiler.phase('fetch') as phase:
+            # Streamed report is consumed here, so that the phase includes execution of the command
+            records = list(self.client.get_usage_report(waldur_allocations.keys()))
+            phase.rows = len(records)
+
+        with transaction.atomic():
+            with profiler.phase('write') as phase:
+                result = ledger.apply_records(
+                    self.settings, records, waldur_allocations, truncated=self.client.truncates_usage)
+                phase.rows = len(result.created) + len(result.updated) + len(result.unchanged)
+
+            with profiler.phase('sum') as phase:
+                changed = ledger.update_usage(result.groups)
+                self._set_usage(allocations, changed)
+                phase.rows = len(result.groups)
+
+            with profiler.phase('rollup') as phase:
+                phase.rows = ledger.update_quotas(changed.keys())
+
+            if scheduling.is_enabled():
+                with profiler.phase('schedule') as phase:
+                    scheduling.update_schedule(allocations, previous_usage, timezone.now())
+                    phase.rows = len(allocations)
+
+            if checkpoint is not None:
+                checkpoint.last_allocation_id = allocations[-1].pk
+                checkpoint.save(update_fields=['last_allocation_id', 'modified'])
 
-        report = self.get_usage_report(waldur_allocations.keys())
-        for account, usage in report.items():
-            allocation = waldur_allocations.get(account)
-            if not allocation:
-                logger.debug('Skipping usage report for account %s because it is not managed under Waldur', account)
-                continue
-            self._update_quotas(allocation, usage)
+        return result.groups
 
     def pull_allocation(self, allocation):
+        """
+        Synchronize usage of the allocation. If usage of the cluster is being synchronized
+        by another worker, it waits for completion, so that the same jobs are not written concurrently.
+        """
+        with self._usage_lock(wait=django_settings.WALDUR_SLURM.get('LOCK_WAIT', 60)) as lease:
+            if not lease.acquired:
+                logger.info('Skipping usage synchronization of allocation %s because usage of %s '
+                            'is still being synchronized.', allocation, self.settings)
+                return
+            self._pull_allocation(allocation)
+
+    def _pull_allocation(self, allocation):
         account = self.get_allocation_name(allocation)
-        report = self.get_usage_report([account])
-        usage = report.get(account)
-        if not usage:
-            logger.debug('Skipping usage report for account %s because it is not managed under Waldur', account)
-            return
-        self._update_quotas(allocation, usage)
+        records = self.client.get_usage_report([account])
+        result = ledger.apply_records(
+            self.settings, records, {account: allocation}, truncated=self.client.truncates_usage)
+        changed = ledger.update_usage(result.groups)
+        self._set_usage([allocation], changed)
+        ledger.update_quotas(changed.keys())
+        ledger.update_rollups(result.groups)
+        utils.bump_version_stamp(self.settings.pk)
+
+    def backfill_usage(self, year, month, windows=1):
+        """
+        Store usage of jobs running in the given month to job ledger and recalculate per-user usage.
+        Allocations are processed in chunks, like by usage synchronization, and for each chunk
+        month is split into time windows which are fetched in parallel. Job running across
+        boundary of time windows is reported in each of them and its parts of usage are summed.
+        Allocation totals are changed only if the current month is backfilled.
+        """
+        with self._usage_lock(wait=django_settings.WALDUR_SLURM.get('LOCK_WAIT', 60)) as lease:
+            if not lease.acquired:
+                raise ServiceBackendError('Usage of %s is already being synchronized.' % self.settings)
+            self._backfill_usage(year, month, windows, lease)
+
+    def _backfill_usage(self, year, month, windows, lease):
+        chunks = utils.iterate_chunks(
+            self.get_allocation_queryset().only(*SYNC_FIELDS),
+            django_settings.WALDUR_SLURM.get('SYNC_CHUNK_SIZE', 500),
+        )
+        periods = utils.get_month_windows(year, month, windows)
+        groups = set()
+
+        pool = ThreadPool(len(periods))
+        try:
+            for chunk in chunks:
+                groups |= self._backfill_usage_chunk(chunk, (year, month), periods, pool)
+                lease.extend()
+        finally:
+            pool.close()
+            pool.join()
+
+        if groups:
+            ledger.update_rollups(groups)
+            utils.bump_version_stamp(self.settings.pk)
+
+    def _backfill_usage_chunk(self, allocations, period, windows, pool):
+        """
+        Fetch usage of the chunk within each time window in parallel and store it to job ledger.
+        Client is shared by the threads: it does not keep state of executed commands, its transports
+        and HTTP session are safe for concurrent use and recording transport serializes writes to trace.
+        :return: set of (allocation ID, year, month) groups which usage has been recalculated
+        """
+        waldur_allocations = {self.get_allocation_name(allocation): allocation for allocation in allocations}
+        accounts = list(waldur_allocations.keys())
+
+        def fetch(window):
+            return list(self.client.get_usage_report(accounts, *window))
+
+        # All windows of the chunk are merged, so that parts of job reported in several of them are summed
+        records = itertools.chain.from_iterable(pool.map(fetch, windows))
+        result = ledger.apply_records(
+            self.settings, records, waldur_allocations, period, self.client.truncates_usage)
+        changed = ledger.update_usage(result.groups)
+        self._set_usage(allocations, changed)
+        ledger.update_quotas(changed.keys())
+        return result.groups
+
+    def _usage_lock(self, wait=0):
+        return ledger.usage_lock(self.settings, wait=wait)
 
     def get_usage_report(self, accounts):
+        records = self.client.get_usage_report(accounts)
+        return self.aggregate_usage_report(records)
+
+    def aggregate_usage_report(self, records):
+        """
+        Sum usage records per account and user. Charges are accumulated
+        as integer number of cents and converted to Decimal afterwards.
+        """
         report = {}
-        lines = self.client.get_usage_report(accounts)
+        schema = get_tres_schema()
 
-        for line in lines:
-            report.setdefault(line.account, {}).setdefault(line.user, Quotas())
-            report[line.account][line.user] += line.quotas
+        for record in records:
+            usage = report.get(record.account)
+            if usage is None:
+                usage = report[record.account] = {}
+            quotas = usage.get(record.user)
+            if quotas is None:
+                quotas = usage[record.user] = Quotas(schema=schema)
+            quotas.add_values(record.values)
 
         for usage in report.values():
-            quotas = usage.values()
-            total = reduce(operator.add, quotas)
+            total = Quotas(schema=schema)
+            for quotas in usage.values():
+                total += quotas
+                quotas.deposit = utils.cents_to_decimal(quotas.deposit)
+            total.deposit = utils.cents_to_decimal(total.deposit)
             usage['TOTAL_ACCOUNT_USAGE'] = total
 
         return report
 
-    @transaction.atomic()
-    def _update_quotas(self, allocation, usage):
-        quotas = usage.pop('TOTAL_ACCOUNT_USAGE')
-        allocation.cpu_usage = quotas.cpu
-        allocation.gpu_usage = quotas.gpu
-        allocation.ram_usage = quotas.ram
-        allocation.deposit_usage = quotas.deposit
-        allocation.save(update_fields=['cpu_usage', 'gpu_usage', 'ram_usage', 'deposit_usage'])
-
-        usernames = usage.keys()
-        usermap = {
-            profile.username: profile.user
-            for profile in freeipa_models.Profile.objects.filter(username__in=usernames)
-        }
-
-        for username, quotas in usage.items():
-            models.AllocationUsage.objects.update_or_create(
-                allocation=allocation,
-                username=username,
-                year=timezone.now().year,
-                month=timezone.now().month,
-                defaults={
-                    'cpu_usage': quotas.cpu,
-                    'gpu_usage': quotas.gpu,
-                    'ram_usage': quotas.ram,
-                    'deposit_usage': quotas.deposit,
-                    'user': usermap.get(username),
-                })
+    def _set_usage(self, allocations, changed):
+        """
+        Copy usage recalculated from job ledger to allocation instances.
+        :param changed: dictionary mapping allocation ID to usage values
+        """
+        for allocation in allocations:
+            for field, value in changed.get(allocation.pk, {}).items():
+                setattr(allocation, field, value)
 
     def create_customer(self, customer):
         customer_name = self.get_customer_name(customer)
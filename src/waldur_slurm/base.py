@@ -1,31 +1,159 @@
 from __future__ import absolute_import
 
 import abc
+import codecs
+import contextlib
 import logging
 import subprocess  # nosec
+import sys
+import tempfile
+import time
 
-from django.utils.functional import cached_property
 import six
 
-from .structures import Quotas
+from . import capabilities, locks, signals
 
 
 logger = logging.getLogger(__name__)
 
+# Exit status recorded for command which has failed without exit status, for example because of connection error
+UNKNOWN_EXIT_STATUS = -1
+
 
 class BatchError(Exception):
     pass
 
 
+class CommandError(BatchError):
+    """
+    Raised by transport if command has finished with non-zero exit status.
+    """
+
+    def __init__(self, message, exit_status=1, output=''):
+        super(CommandError, self).__init__(message)
+        self.exit_status = exit_status
+        self.output = output
+
+
+class SSHTransport(object):
+    """
+    Executes batch commands on the cluster head node over SSH.
+    """
+
+    def __init__(self, hostname, key_path, username='root', port=22, use_sudo=False):
+        self.hostname = hostname
+        self.key_path = key_path
+        self.username = username
+        self.port = port
+        self.use_sudo = use_sudo
+
+    # Number of bytes read at once from output of streamed command
+    CHUNK_SIZE = 64 * 1024
+
+    def get_ssh_command(self, command):
+        server = '%s@%s' % (self.username, self.hostname)
+        port = str(self.port)
+        if self.use_sudo:
+            account_command = ['sudo']
+        else:
+            account_command = []
+
+        account_command.extend(command)
+        return ['ssh', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
+                server, '-p', port, '-i', self.key_path, ' '.join(account_command)]
+
+    def execute(self, command):
+        ssh_command = self.get_ssh_command(command)
+        try:
+            logger.debug('Executing SSH command: %s', ' '.join(ssh_command))
+            return subprocess.check_output(ssh_command, stderr=subprocess.STDOUT)  # nosec
+        except subprocess.CalledProcessError as e:
+            logger.exception('Failed to execute command "%s".', ssh_command)
+            output = e.output or ''
+            six.reraise(CommandError, CommandError(strip_ssh_warning(output), e.returncode, output), sys.exc_info()[2])
+
+    def execute_stream(self, command):
+        """
+        Yield output of command as text chunks, so that large output is not loaded into memory.
+        Standard error is written to temporary file, so that SSH warnings do not corrupt output.
+        """
+        ssh_command = self.get_ssh_command(command)
+        logger.debug('Executing SSH command: %s', ' '.join(ssh_command))
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(ssh_command, stdout=subprocess.PIPE, stderr=stderr)  # nosec
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            try:
+                for data in iter(lambda: process.stdout.read(self.CHUNK_SIZE), b''):
+                    text = decoder.decode(data)
+                    if text:
+                        yield text
+                text = decoder.decode(b'', True)
+                if text:
+                    yield text
+            finally:
+                process.stdout.close()
+                exit_status = process.wait()
+
+            if exit_status:
+                stderr.seek(0)
+                output = stderr.read().decode('utf-8', 'replace')
+                logger.error('Failed to execute command "%s".', ssh_command)
+                raise CommandError(strip_ssh_warning(output), exit_status, output)
+
+
+def strip_ssh_warning(output):
+    lines = output.splitlines()
+    if len(lines) > 0 and lines[0].startswith('Warning: Permanently added'):
+        lines = lines[1:]
+    return '\n'.join(lines)
+
+
 @six.add_metaclass(abc.ABCMeta)
 class BaseBatchClient(object):
+    # Scope of cached capabilities, backend uses UUID of service settings, hostname is used by default
+    capabilities_scope = None
 
-    def __init__(self, hostname, key_path, username='root', port=22, use_sudo=False):
+    # Maximum number of commands executed on the cluster at once by all workers, it is unlimited by default
+    max_concurrency = None
+
+    # Number of seconds command waits for free slot if number of concurrent commands is limited
+    queue_timeout = 5 * 60
+
+    # Usage report contains only the part of usage of job within the report period,
+    # otherwise usage of the whole job is reported in each period when it was running
+    truncates_usage = True
+
+    def __init__(self, hostname, key_path, username='root', port=22, use_sudo=False, transport=None):
         self.hostname = hostname
         self.key_path = key_path
         self.username = username
         self.port = port
         self.use_sudo = use_sudo
+        self.transport = transport or SSHTransport(hostname, key_path, username, port, use_sudo)
+
+    def probe_capabilities(self):
+        """
+        Detect features of batch service which allow to use faster strategies of operations.
+        :return: dictionary of capabilities
+        """
+        return {}
+
+    def get_capabilities(self, probe=True):
+        """
+        :param probe: if False, cluster is not probed and only cached capabilities are returned
+        """
+        return capabilities.get_capabilities(
+            self.capabilities_scope or self.hostname, self._probe_capabilities if probe else None)
+
+    def update_capabilities(self, **changes):
+        capabilities.update_capabilities(self.capabilities_scope or self.hostname, **changes)
+
+    def _probe_capabilities(self):
+        try:
+            return self.probe_capabilities()
+        except BatchError:
+            logger.exception('Failed to probe capabilities of cluster %s.', self.hostname)
+            return None
 
     @abc.abstractmethod
     def list_accounts(self):
@@ -75,6 +203,23 @@ class BaseBatchClient(object):
         """
         raise NotImplementedError()
 
+    def set_resource_limits_bulk(self, limits):
+        """
+        Set limits for many accounts at once.
+        Default implementation applies limits one by one, subclasses may batch commands.
+        :param limits: list[tuple(string, structures.Quotas object)] pairs of account name and limits
+        :return: dict[string, string] maps account name to error message or None if limits are applied
+        """
+        results = {}
+        for account, quotas in limits:
+            try:
+                self.set_resource_limits(account, quotas)
+            except BatchError as e:
+                results[account] = six.text_type(e)
+            else:
+                results[account] = None
+        return results
+
     @abc.abstractmethod
     def get_association(self, user, account):
         """
@@ -107,77 +252,108 @@ class BaseBatchClient(object):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def get_usage_report(self, accounts):
+    def get_usage_report(self, accounts, start=None, end=None):
         """
         Get usages records.
         :param accounts: list[string]
-        :return: list[BaseReportLine]
+        :param start: start date of report formatted as YYYY-MM-DD, current month is used by default
+        :param end: end date of report formatted as YYYY-MM-DD
+        :return: iterable of UsageRecord
         """
         raise NotImplementedError()
 
-    def execute_command(self, command):
-        server = '%s@%s' % (self.username, self.hostname)
-        port = str(self.port)
-        if self.use_sudo:
-            account_command = ['sudo']
-        else:
-            account_command = []
+    @contextlib.contextmanager
+    def command_slot(self, kind):
+        """
+        Wait for free slot of semaphore shared by all workers executing commands on the cluster,
+        so that number of concurrent commands does not exceed max_concurrency.
+        """
+        if not self.max_concurrency:
+            yield
+            return
 
-        account_command.extend(command)
-        ssh_command = ['ssh', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
-                       server, '-p', port, '-i', self.key_path, ' '.join(account_command)]
+        semaphore = locks.Semaphore('commands:%s' % self.hostname, self.max_concurrency)
+        started = time.time()
+        acquired = semaphore.acquire(wait=self.queue_timeout)
+        signals.batch_command_queued.send(
+            sender=self.__class__,
+            cluster=self.hostname,
+            kind=kind,
+            wait=time.time() - started,
+        )
+        if not acquired:
+            raise BatchError('Timed out waiting for free slot to execute %s on cluster %s.' % (kind, self.hostname))
         try:
-            logger.debug('Executing SSH command: %s', ' '.join(ssh_command))
-            return subprocess.check_output(ssh_command, stderr=subprocess.STDOUT)  # nosec
-        except subprocess.CalledProcessError as e:
-            logger.exception('Failed to execute command "%s".', ssh_command)
-            stdout = e.output or ''
-            lines = stdout.splitlines()
-            if len(lines) > 0 and lines[0].startswith('Warning: Permanently added'):
-                lines = lines[1:]
-            stdout = '\n'.join(lines)
-            six.reraise(BatchError, stdout)
+            yield
+        finally:
+            semaphore.release()
 
+    def execute_command(self, command):
+        with self.command_slot(get_command_kind(command)):
+            started = time.time()
+            exit_status = 0
+            output = ''
+            try:
+                output = self.transport.execute(command)
+                return output
+            except CommandError as e:
+                exit_status = e.exit_status
+                output = e.output
+                raise
+            except Exception:
+                exit_status = UNKNOWN_EXIT_STATUS
+                raise
+            finally:
+                self._send_command_executed(command, started, exit_status, len(output), output.count('\n'))
 
-@six.add_metaclass(abc.ABCMeta)
-class BaseReportLine(object):
-    @abc.abstractproperty
-    def account(self):
-        pass
-
-    @abc.abstractproperty
-    def user(self):
-        pass
-
-    @property
-    def cpu(self):
-        return 0
-
-    @property
-    def gpu(self):
-        return 0
-
-    @property
-    def ram(self):
-        return 0
-
-    @property
-    def duration(self):
-        return 0
-
-    @property
-    def charge(self):
-        return 0
-
-    @property
-    def node(self):
-        return 0
-
-    @cached_property
-    def quotas(self):
-        return Quotas(
-            self.cpu * self.duration * self.node,
-            self.gpu * self.duration * self.node,
-            self.ram * self.duration * self.node,
-            self.charge
+    def execute_command_stream(self, command):
+        """
+        Yield output of command as text chunks. If transport does not support streaming,
+        the whole output is yielded as a single chunk.
+        """
+        with self.command_slot(get_command_kind(command)):
+            started = time.time()
+            exit_status = 0
+            output_bytes = output_lines = 0
+            try:
+                execute_stream = getattr(self.transport, 'execute_stream', None)
+                chunks = execute_stream(command) if execute_stream else [self.transport.execute(command)]
+                for chunk in chunks:
+                    output_bytes += len(chunk)
+                    output_lines += chunk.count('\n')
+                    yield chunk
+            except CommandError as e:
+                exit_status = e.exit_status
+                raise
+            except Exception:
+                exit_status = UNKNOWN_EXIT_STATUS
+                raise
+            finally:
+                self._send_command_executed(command, started, exit_status, output_bytes, output_lines)
+
+    def _send_command_executed(self, command, started, exit_status, output_bytes, output_lines):
+        signals.batch_command_executed.send(
+            sender=self.__class__,
+            cluster=self.hostname,
+            kind=get_command_kind(command),
+            duration=time.time() - started,
+            exit_status=exit_status,
+            output_bytes=output_bytes,
+            output_lines=output_lines,
         )
+
+
+def get_command_kind(command):
+    """
+    Return short command description suitable for metrics labels,
+    for example "sacctmgr list", "sacct" or "mam-list-accounts".
+    """
+    if not command:
+        return 'unknown'
+    name = command[0]
+    if name != 'sacctmgr':
+        return name
+    for part in command[1:]:
+        if not part.startswith('-'):
+            return '%s %s' % (name, part)
+    return name
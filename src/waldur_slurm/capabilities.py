@@ -0,0 +1,59 @@
+"""
+Features of batch service are probed once per cluster and cached, so that clients
+pick the fastest strategy supported by the cluster without probing it before each operation.
+Capabilities which are discovered at runtime, such as failure of bulk command, are cached as well.
+"""
+from __future__ import unicode_literals
+
+import logging
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CAPABILITIES_KEY = 'waldur_slurm:capabilities:%s'
+
+# Capabilities discovered at runtime are stored separately, so that they do not prevent probing
+LEARNED_CAPABILITIES_KEY = 'waldur_slurm:capabilities:%s:learned'
+
+# Failed probe is retried sooner, so that temporary outage does not disable fast paths for long
+FAILED_PROBE_TTL = 5 * 60
+
+
+def get_ttl():
+    return django_settings.WALDUR_SLURM.get('CAPABILITIES_TTL', 24 * 60 * 60)
+
+
+def get_capabilities(scope, probe=None):
+    """
+    Return cached capabilities of the cluster, they are probed if cache has expired.
+    :param scope: cache scope, UUID of service settings or hostname of the cluster
+    :param probe: callable returning dictionary of capabilities or None if cluster can not be probed.
+    If it is not specified, only cached capabilities are returned.
+    """
+    key = CAPABILITIES_KEY % scope
+    learned_key = LEARNED_CAPABILITIES_KEY % scope
+    values = cache.get_many([key, learned_key])
+    capabilities = values.get(key)
+
+    if capabilities is None and probe is not None:
+        ttl = get_ttl()
+        capabilities = probe()
+        if capabilities is None:
+            logger.warning('Unable to probe capabilities of cluster %s, default strategies are used.', scope)
+            capabilities = {}
+            ttl = min(ttl, FAILED_PROBE_TTL)
+        cache.set(key, capabilities, ttl)
+
+    return dict(capabilities or {}, **values.get(learned_key, {}))
+
+
+def update_capabilities(scope, **changes):
+    key = LEARNED_CAPABILITIES_KEY % scope
+    learned = dict(cache.get(key) or {}, **changes)
+    cache.set(key, learned, get_ttl())
+
+
+def clear_capabilities(scope):
+    cache.delete_many([CAPABILITIES_KEY % scope, LEARNED_CAPABILITIES_KEY % scope])
@@ -1,9 +1,13 @@
+import collections
 import logging
 import re
 
+import six
+
 from waldur_slurm.base import BatchError, BaseBatchClient
-from waldur_slurm.parser import SlurmReportLine
-from waldur_slurm.structures import Account, Association
+from waldur_slurm.parser import parse_report
+from waldur_slurm.parser_json import parse_report as parse_json_report
+from waldur_slurm.structures import Account, Association, get_tres_schema
 from waldur_slurm.utils import format_current_month
 
 
@@ -20,6 +24,41 @@ class SlurmClient(BaseBatchClient):
     See also: https://slurm.schedmd.com/sacctmgr.html
     """
 
+    # Maximum number of accounts modified by a single sacctmgr command
+    BULK_ACCOUNTS_LIMIT = 100
+
+    # Release of SLURM which has added JSON output of sacct
+    SACCT_JSON_VERSION = (21, 8)
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param use_json: if True, usage report is requested as JSON, if None, it is detected by sacct version
+        """
+        self.use_json = kwargs.pop('use_json', False)
+        super(SlurmClient, self).__init__(*args, **kwargs)
+
+    def get_version(self):
+        """
+        Return (major, minor) version of SLURM or None if it is not recognized.
+        """
+        output = self.execute_command(['sacct', '--version'])
+        match = re.match(r'\s*slurm[\w-]*\s+(\d+)\.(\d+)', output)
+        if not match:
+            return None
+        return int(match.group(1)), int(match.group(2))
+
+    def probe_capabilities(self):
+        version = self.get_version()
+        return {
+            'version': version,
+            'sacct_json': bool(version and version >= self.SACCT_JSON_VERSION),
+        }
+
+    def supports_json(self):
+        if self.use_json is None:
+            return self.get_capabilities().get('sacct_json', False)
+        return self.use_json
+
     def list_accounts(self):
         output = self._execute_command(['list', 'account'])
         return [self._parse_account(line) for line in output.splitlines() if '|' in line]
@@ -66,8 +105,56 @@ class SlurmClient(BaseBatchClient):
         return self._execute_command(['remove', 'account', 'where', 'name=%s' % name])
 
     def set_resource_limits(self, account, quotas):
-        quota = 'GrpTRESMins=cpu=%d,gres/gpu=%d,mem=%d' % (quotas.cpu, quotas.gpu, quotas.ram)
-        return self._execute_command(['modify', 'account', account, 'set', quota])
+        return self._execute_command(['modify', 'account', account, 'set', self._format_limits(quotas)])
+
+    def set_resource_limits_bulk(self, limits):
+        """
+        Accounts sharing the same limits are modified by a single sacctmgr command.
+        If batched command fails, limits of the batch are applied one by one
+        so that failed accounts are reported individually.
+        """
+        groups = collections.OrderedDict()
+        for account, quotas in limits:
+            groups.setdefault(self._format_limits(quotas), []).append(account)
+
+        bulk_modify = self.get_capabilities(probe=False).get('bulk_modify', True)
+        results = {}
+        for quota, accounts in groups.items():
+            for start in range(0, len(accounts), self.BULK_ACCOUNTS_LIMIT):
+                batch = accounts[start:start + self.BULK_ACCOUNTS_LIMIT]
+                if bulk_modify:
+                    try:
+                        self._execute_command(['modify', 'account', 'where', 'name=%s' % ','.join(batch), 'set', quota])
+                    except BatchError:
+                        logger.warning('Failed to set limits for accounts batch, falling back to one by one update.')
+                    else:
+                        results.update({account: None for account in batch})
+                        continue
+
+                batch_results = self._set_limits_one_by_one(batch, quota)
+                results.update(batch_results)
+                # Bulk modification is not supported if it has failed while each account is modified successfully
+                if bulk_modify and len(batch) > 1 and not any(batch_results.values()):
+                    logger.warning('Bulk modification of accounts is not supported by cluster %s.', self.hostname)
+                    self.update_capabilities(bulk_modify=False)
+                    bulk_modify = False
+        return results
+
+    def _set_limits_one_by_one(self, accounts, quota):
+        results = {}
+        for account in accounts:
+            try:
+                self._execute_command(['modify', 'account', account, 'set', quota])
+            except BatchError as e:
+                results[account] = six.text_type(e)
+            else:
+                results[account] = None
+        return results
+
+    def _format_limits(self, quotas):
+        limits = ['cpu=%d' % quotas.cpu, 'gres/gpu=%d' % quotas.gpu, 'mem=%d' % quotas.ram]
+        limits.extend('%s=%d' % (name, value) for name, value in sorted(quotas.extra.items()))
+        return 'GrpTRESMins=%s' % ','.join(limits)
 
     def get_association(self, user, account):
         output = self._execute_command([
@@ -100,21 +187,28 @@ class SlurmClient(BaseBatchClient):
             'remove', 'user', 'where', 'name=%s' % username, 'and', 'account=%s' % account
         ])
 
-    def get_usage_report(self, accounts):
-        month_start, month_end = format_current_month()
+    def get_usage_report(self, accounts, start=None, end=None):
+        if start is None:
+            start, end = format_current_month()
 
         args = [
             '--noconvert',
             '--truncate',
             '--allocations',
             '--allusers',
-            '--starttime=%s' % month_start,
-            '--endtime=%s' % month_end,
+            '--starttime=%s' % start,
+            '--endtime=%s' % end,
             '--accounts=%s' % ','.join(accounts),
-            '--format=Account,ReqTRES,Elapsed,User',
         ]
+        extra = get_tres_schema().extra
+        if self.supports_json():
+            # Report is parsed while it is received, so that the whole document is never kept in memory
+            chunks = self.execute_command_stream(['sacct', '--json'] + args)
+            return parse_json_report(chunks, extra)
+
+        args.append('--format=Account,ReqTRES,Elapsed,User,JobID,End,Start')
         output = self._execute_command(args, 'sacct', immediate=False)
-        return [SlurmReportLine(line) for line in output.splitlines() if '|' in line]
+        return parse_report(output, extra)
 
     def _execute_command(self, command, command_name='sacctmgr', immediate=True):
         account_command = [command_name, '--parsable2', '--noheader']
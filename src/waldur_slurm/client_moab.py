@@ -1,8 +1,9 @@
+import itertools
 import logging
 
 from waldur_slurm.base import BatchError, BaseBatchClient
-from waldur_slurm.parser_moab import MoabReportLine
-from waldur_slurm.structures import Account, Association
+from waldur_slurm.parser_moab import parse_report
+from waldur_slurm.structures import Account, Association, get_tres_schema
 from waldur_slurm.utils import format_current_month
 
 
@@ -19,6 +20,9 @@ class MoabClient(BaseBatchClient):
     See also MOAB Accounting Manager 9.1.1 Administrator Guide
     http://docs.adaptivecomputing.com/9-1-1/MAM/help.htm"""
 
+    # Usage record contains charge of the whole job
+    truncates_usage = False
+
     def list_accounts(self):
         output = self.execute_command(
             'mam-list-accounts --raw --quiet --show Name,Description,Organization'.split()
@@ -92,24 +96,23 @@ class MoabClient(BaseBatchClient):
         }
         return self.execute_command(command.split())
 
-    def get_usage_report(self, accounts):
+    def get_usage_report(self, accounts, start=None, end=None):
         template = (
             'mam-list-usagerecords --raw --quiet --show '
-            'Account,Processors,GPUs,Memory,Duration,User,Charge,Nodes '
+            'Account,Processors,GPUs,Memory,Duration,User,Charge,Nodes,Id,EndTime '
             '-a %(account)s -s %(start)s -e %(end)s'
         )
-        month_start, month_end = format_current_month()
+        if start is None:
+            start, end = format_current_month()
 
-        report_lines = []
+        outputs = []
         for account in accounts:
             command = template % {
                 'account': account,
-                'start': month_start,
-                'end': month_end,
+                'start': start,
+                'end': end,
             }
-            lines = self.execute_command(command.split()).splitlines()
-            for line in lines:
-                if '|' in line:
-                    report_lines.append(MoabReportLine(line))
+            outputs.append(self.execute_command(command.split()))
 
-        return report_lines
+        extra = get_tres_schema().extra
+        return itertools.chain.from_iterable(parse_report(output, extra) for output in outputs)
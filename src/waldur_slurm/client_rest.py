@@ -0,0 +1,229 @@
+"""
+Client for SLURM REST API daemon. It is used instead of SSH and sacctmgr
+if slurmrestd URL is configured for the cluster. Connections are kept alive
+and pooled per daemon, and usage report is decoded job by job as it is received.
+See also: https://slurm.schedmd.com/rest_api.html
+"""
+from __future__ import unicode_literals
+
+import itertools
+import logging
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+import six
+from six.moves.urllib.parse import quote, urlparse
+
+from waldur_slurm import signals
+from waldur_slurm.base import BatchError, BaseBatchClient
+from waldur_slurm.parser_json import format_tres, parse_report, parse_tres
+from waldur_slurm.structures import BASE_TRES_NAMES, Account, Association, get_tres_schema
+from waldur_slurm.utils import format_current_month, get_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+class SlurmRestError(BatchError):
+    def __init__(self, message, status_code=None):
+        super(SlurmRestError, self).__init__(message)
+        self.status_code = status_code
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url, username, token, pool_size):
+    """
+    Return HTTP session shared by clients of the same daemon, so that connections are reused.
+    """
+    key = (url, username, token)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({
+                'X-SLURM-USER-NAME': username,
+                'X-SLURM-USER-TOKEN': token,
+                'Accept': 'application/json',
+            })
+            _sessions[key] = session
+    return session
+
+
+class SlurmRestClient(BaseBatchClient):
+    """
+    This class implements Python client for slurmrestd.
+    :param url: base URL of slurmrestd, for example http://slurm.example.com:6820
+    :param token: JWT token of the user
+    """
+
+    API_VERSION = 'v0.0.38'
+
+    # Number of accounts requested by a single jobs query, so that query string is not too long
+    ACCOUNTS_PER_REQUEST = 100
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url, token, username='root', verify=True, timeout=60, pool_size=10):
+        self.url = url.rstrip('/')
+        self.hostname = urlparse(self.url).hostname
+        self.username = username
+        self.verify = verify
+        self.timeout = timeout
+        self.session = get_session(self.url, username, token, pool_size)
+
+    def list_accounts(self):
+        data = self._request('get', 'accounts')
+        return [self._parse_account(item) for item in data.get('accounts', [])]
+
+    def _parse_account(self, item):
+        return Account(
+            name=item['name'],
+            description=item.get('description', ''),
+            organization=item.get('organization', ''),
+        )
+
+    def get_account(self, name):
+        try:
+            data = self._request('get', 'account/%s' % quote(name))
+        except SlurmRestError as e:
+            if e.status_code == 404:
+                return None
+            raise
+        accounts = data.get('accounts', [])
+        if not accounts:
+            return None
+        return self._parse_account(accounts[0])
+
+    def create_account(self, name, description, organization, parent_name=None):
+        self._request('post', 'accounts', {'accounts': [{
+            'name': name,
+            'description': description,
+            'organization': organization,
+        }]})
+        association = {'account': name}
+        if parent_name:
+            association['parent_account'] = parent_name
+        self._request('post', 'associations', {'associations': [association]})
+
+    def delete_account(self, name):
+        data = self._request('get', 'associations', params={'account': name})
+        for association in data.get('associations', []):
+            if association.get('user'):
+                self.delete_association(association['user'], name)
+        self._request('delete', 'account/%s' % quote(name))
+
+    def set_resource_limits(self, account, quotas):
+        values = (quotas.cpu, quotas.gpu, quotas.ram)
+        minutes = [format_tres(name, value) for name, value in zip(BASE_TRES_NAMES, values)]
+        minutes.extend(format_tres(name, value) for name, value in sorted(quotas.extra.items()))
+        self._request('post', 'associations', {'associations': [{
+            'account': account,
+            'max': {'tres': {'group': {'minutes': minutes}}},
+        }]})
+
+    def get_association(self, user, account):
+        data = self._request('get', 'associations', params={'user': user, 'account': account})
+        associations = [item for item in data.get('associations', []) if item.get('user') == user]
+        if not associations:
+            return None
+        return self._parse_association(associations[0])
+
+    def _parse_association(self, item):
+        limits = parse_tres(item.get('max', {}).get('tres', {}).get('group', {}).get('minutes'))
+        return Association(
+            account=item['account'],
+            user=item.get('user', ''),
+            value=limits.get('cpu', ''),
+        )
+
+    def create_association(self, username, account, default_account=''):
+        if default_account:
+            self._request('post', 'users', {'users': [{
+                'name': username,
+                'default': {'account': default_account},
+            }]})
+        self._request('post', 'associations', {'associations': [{'account': account, 'user': username}]})
+
+    def delete_association(self, username, account):
+        self._request('delete', 'association', params={'user': username, 'account': account})
+
+    def get_usage_report(self, accounts, start=None, end=None):
+        if start is None:
+            start, end = format_current_month()
+
+        accounts = list(accounts)
+        extra = get_tres_schema().extra
+        return itertools.chain.from_iterable(
+            self._get_jobs(accounts[index:index + self.ACCOUNTS_PER_REQUEST], start, end, extra)
+            for index in range(0, len(accounts), self.ACCOUNTS_PER_REQUEST)
+        )
+
+    def _get_jobs(self, accounts, start, end, extra):
+        params = {
+            'account': ','.join(accounts),
+            'start_time': start,
+            'end_time': end,
+        }
+        # Unlike sacct --truncate, slurmrestd reports whole jobs, so that usage is truncated while it is parsed
+        window = (get_timestamp(start), get_timestamp(end))
+        response = self._send('get', 'jobs', params=params, stream=True)
+        try:
+            response.encoding = 'utf-8'
+            chunks = response.iter_content(self.CHUNK_SIZE, decode_unicode=True)
+            for record in parse_report(chunks, extra, window):
+                yield record
+        finally:
+            response.close()
+
+    def _request(self, method, endpoint, payload=None, params=None):
+        response = self._send(method, endpoint, payload=payload, params=params)
+        if not response.content:
+            return {}
+        try:
+            data = response.json()
+        except ValueError:
+            raise SlurmRestError('Unable to parse response of slurmrestd: %s' % response.text)
+        errors = [error for error in data.get('errors', []) if error.get('error')]
+        if errors:
+            raise SlurmRestError('; '.join(error['error'] for error in errors))
+        return data
+
+    def _send(self, method, endpoint, payload=None, params=None, stream=False):
+        url = '%s/slurmdb/%s/%s' % (self.url, self.API_VERSION, endpoint)
+        kind = 'slurmrestd %s %s' % (method, endpoint.split('/')[0])
+        output_bytes = 0
+        with self.command_slot(kind):
+            started = time.time()
+            try:
+                response = self.session.request(
+                    method, url, json=payload, params=params, stream=stream, verify=self.verify, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.exception('Failed to send request to slurmrestd %s.', url)
+                six.reraise(SlurmRestError, SlurmRestError(six.text_type(e)), sys.exc_info()[2])
+
+        status_code = response.status_code
+        if not stream:
+            output_bytes = len(response.content)
+        signals.batch_command_executed.send(
+            sender=self.__class__,
+            cluster=self.hostname,
+            kind=kind,
+            duration=time.time() - started,
+            exit_status=0 if response.ok else status_code,
+            output_bytes=output_bytes,
+            output_lines=0,
+        )
+
+        if not response.ok:
+            message = response.text if not stream else response.reason
+            response.close()
+            raise SlurmRestError('slurmrestd has returned status %s: %s' % (status_code, message), status_code)
+        return response
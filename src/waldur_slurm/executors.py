@@ -1,50 +1,70 @@
 from waldur_core.core import executors as core_executors, tasks as core_tasks
 from waldur_core.structure import executors as structure_executors
 
-from . import models
+from . import models, utils
+
+
+def route_to_cluster(signature, allocation):
+    """
+    Send task to queue of the cluster if queue routing is enabled.
+    """
+    queue = utils.get_queue_name(allocation.service_project_link.service.settings)
+    if queue:
+        return signature.set(queue=queue)
+    return signature
 
 
 class AllocationCreateExecutor(core_executors.CreateExecutor):
 
     @classmethod
-    def get_task_signature(cls, volume, serialized_allocation, **kwargs):
-        return core_tasks.BackendMethodTask().si(
+    def get_task_signature(cls, allocation, serialized_allocation, **kwargs):
+        return route_to_cluster(core_tasks.BackendMethodTask().si(
             serialized_allocation,
             'create_allocation',
             state_transition='begin_creating'
-        )
+        ), allocation)
 
 
 class AllocationUpdateExecutor(core_executors.UpdateExecutor):
 
     @classmethod
-    def get_task_signature(cls, volume, serialized_volume, **kwargs):
-        return core_tasks.BackendMethodTask().si(
-            serialized_volume,
+    def get_task_signature(cls, allocation, serialized_allocation, **kwargs):
+        return route_to_cluster(core_tasks.BackendMethodTask().si(
+            serialized_allocation,
             'set_resource_limits',
             state_transition='begin_updating'
-        )
+        ), allocation)
 
 
 class AllocationPullExecutor(core_executors.ActionExecutor):
     action = 'Pull'
 
     @classmethod
-    def get_task_signature(cls, volume, serialized_volume, **kwargs):
-        return core_tasks.BackendMethodTask().si(
-            serialized_volume, 'pull_allocation',
-            state_transition='begin_updating')
+    def get_task_signature(cls, allocation, serialized_allocation, **kwargs):
+        return route_to_cluster(core_tasks.BackendMethodTask().si(
+            serialized_allocation, 'pull_allocation',
+            state_transition='begin_updating'), allocation)
+
+
+class AllocationCancelExecutor(core_executors.ActionExecutor):
+    action = 'Cancel'
+
+    @classmethod
+    def get_task_signature(cls, allocation, serialized_allocation, **kwargs):
+        return route_to_cluster(core_tasks.BackendMethodTask().si(
+            serialized_allocation, 'cancel_allocation',
+            state_transition='begin_updating'), allocation)
 
 
 class AllocationDeleteExecutor(core_executors.DeleteExecutor):
 
     @classmethod
-    def get_task_signature(cls, volume, serialized_allocation, **kwargs):
-        return core_tasks.BackendMethodTask().si(
+    def get_task_signature(cls, allocation, serialized_allocation, **kwargs):
+        return route_to_cluster(core_tasks.BackendMethodTask().si(
             serialized_allocation,
             'delete_allocation',
             state_transition='begin_deleting'
-        )
+        ), allocation)
 
 
 class SlurmCleanupExecutor(structure_executors.BaseCleanupExecutor):
@@ -0,0 +1,96 @@
+from __future__ import unicode_literals
+
+import collections
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+import six
+
+# Flat representation of allocation usage row used for export.
+# Each item is a pair of output column name and queryset lookup.
+USAGE_EXPORT_FIELDS = (
+    ('allocation_uuid', 'allocation__uuid'),
+    ('allocation_name', 'allocation__name'),
+    ('year', 'year'),
+    ('month', 'month'),
+    ('username', 'username'),
+    ('user_uuid', 'user__uuid'),
+    ('full_name', 'user__full_name'),
+    ('cpu_usage', 'cpu_usage'),
+    ('gpu_usage', 'gpu_usage'),
+    ('ram_usage', 'ram_usage'),
+    ('deposit_usage', 'deposit_usage'),
+)
+
+EXPORT_COLUMNS = [column for column, _ in USAGE_EXPORT_FIELDS]
+
+EXPORT_LOOKUPS = [lookup for _, lookup in USAGE_EXPORT_FIELDS]
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class EchoBuffer(object):
+    """
+    File-like object which returns written value instead of storing it.
+    It allows to use csv.writer for rendering of a single row.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_usage_rows(queryset):
+    """
+    Yield plain tuples for allocation usage rows.
+    Server-side cursor is used so that memory consumption does not depend on queryset size.
+    """
+    return queryset.values_list(*EXPORT_LOOKUPS).iterator()
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, six.text_type):
+        return value
+    return six.text_type(value)
+
+
+def write_csv_row(writer, values):
+    values = [format_value(value) for value in values]
+    if six.PY2:
+        values = [value.encode('utf-8') for value in values]
+        return writer.writerow(values).decode('utf-8')
+    return writer.writerow(values)
+
+
+def iter_csv(rows):
+    writer = csv.writer(EchoBuffer())
+    yield write_csv_row(writer, EXPORT_COLUMNS)
+    for row in rows:
+        yield write_csv_row(writer, row)
+
+
+def iter_ndjson(rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(collections.OrderedDict(zip(EXPORT_COLUMNS, row))) + '\n'
+
+
+def iter_chunks(lines, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Join rendered lines into bigger chunks to reduce number of writes to the socket.
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
@@ -8,6 +8,41 @@ class SlurmExtension(WaldurExtension):
             'PROJECT_PREFIX': 'waldur_project_',
             'ALLOCATION_PREFIX': 'waldur_allocation_',
             'PRIVATE_KEY_PATH': '/etc/waldur/id_rsa',
+            'COMMAND_METRICS_ENABLED': True,
+            'SYNC_PROFILING_ENABLED': False,
+            'SYNC_PROFILE_HISTORY': 10,
+            'SYNC_PROFILE_DIR': None,
+            'COMMAND_TRACE_DIR': None,
+            # Additional TRES accounted and limited per allocation, for example ('billing', 'gres/gpu:tesla')
+            'EXTRA_TRES': (),
+            # If enabled, usage of each allocation is synchronized according to its activity
+            # instead of synchronizing all allocations of the cluster at once
+            'ADAPTIVE_SYNC_ENABLED': False,
+            'ADAPTIVE_SYNC_MIN_INTERVAL': 5 * 60,
+            'ADAPTIVE_SYNC_MAX_INTERVAL': 6 * 60 * 60,
+            # Velocity in CPU minutes per hour which halves synchronization interval
+            'ADAPTIVE_SYNC_REFERENCE_VELOCITY': 60,
+            # Lifetime in seconds of cached capabilities of cluster, such as SLURM version
+            'CAPABILITIES_TTL': 24 * 60 * 60,
+            # Number of allocations which usage is fetched from cluster and committed at once
+            'SYNC_CHUNK_SIZE': 500,
+            # Lifetime in seconds of lock preventing concurrent usage synchronization of the same cluster
+            'LOCK_TIMEOUT': 30 * 60,
+            # Number of seconds pull of allocation waits for usage synchronization in progress
+            'LOCK_WAIT': 60,
+            # Maximum number of commands executed on the same cluster at once by all workers,
+            # it can be overridden per cluster, concurrency is not limited if it is not set
+            'MAX_CONCURRENT_COMMANDS': None,
+            # Number of seconds command waits for free slot before it fails
+            'COMMAND_QUEUE_TIMEOUT': 5 * 60,
+            # If enabled, tasks of each cluster are sent to its own Celery queue named by QUEUE_PREFIX
+            # and UUID of service settings or queue option of the cluster, see slurm_queues command
+            'QUEUE_ROUTING_ENABLED': False,
+            'QUEUE_PREFIX': 'waldur_slurm_',
+            # If enabled, allocation, usage and rollup endpoints respond with 304 Not Modified if ETag is not changed.
+            # ETag is based on version stamps kept in cache, so that it is used only if cache is shared
+            # by API and Celery workers, such as Redis or Memcached, but not local memory cache.
+            'CONDITIONAL_GET_ENABLED': True,
         }
 
     @staticmethod
@@ -19,6 +54,17 @@ class SlurmExtension(WaldurExtension):
         from .urls import register_in
         return register_in
 
+    @staticmethod
+    def celery_tasks():
+        from datetime import timedelta
+        return {
+            'waldur-slurm-sync-due-usage': {
+                'task': 'waldur_slurm.sync_due_usage',
+                'schedule': timedelta(minutes=5),
+                'args': (),
+            },
+        }
+
     @staticmethod
     def get_cleanup_executor():
         from waldur_slurm.executors import SlurmCleanupExecutor
@@ -29,3 +29,21 @@ class AllocationUsageFilter(django_filters.FilterSet):
     class Meta(object):
         model = models.AllocationUsage
         fields = ('year', 'month')
+
+
+class UsageRollupFilter(django_filters.FilterSet):
+    allocation = core_filters.URLFilter(view_name='slurm-allocation-detail', name='allocation__uuid')
+    allocation_uuid = django_filters.UUIDFilter(name='allocation__uuid')
+
+    project = core_filters.URLFilter(view_name='project-detail', name='project__uuid')
+    project_uuid = django_filters.UUIDFilter(name='project__uuid')
+
+    customer = core_filters.URLFilter(view_name='customer-detail', name='customer__uuid')
+    customer_uuid = django_filters.UUIDFilter(name='customer__uuid')
+
+    date_from = django_filters.DateFilter(name='date', lookup_expr='gte')
+    date_to = django_filters.DateFilter(name='date', lookup_expr='lte')
+
+    class Meta(object):
+        model = models.UsageRollup
+        fields = ('level', 'period')
@@ -1,10 +1,14 @@
+import logging
+
 from django.db import transaction
 from django.db.models import Sum
 
 from waldur_core.core import utils as core_utils
 from waldur_freeipa import models as freeipa_models
 
-from . import models, tasks, utils
+from . import metrics, models, tasks, utils
+
+logger = logging.getLogger(__name__)
 
 
 def process_user_creation(sender, instance, created=False, **kwargs):
@@ -49,6 +53,10 @@ def update_quotas_on_allocation_usage_update(sender, instance, created=False, **
     if not allocation.usage_changed():
         return
 
+    # Quotas of allocations saved by usage synchronization are updated in batch by ledger.update_quotas
+    if getattr(allocation, 'skip_quota_update', False):
+        return
+
     project = allocation.service_project_link.project
     update_quotas(project, models.Allocation.Permissions.project_path)
     update_quotas(project.customer, models.Allocation.Permissions.customer_path)
@@ -62,3 +70,32 @@ def update_quotas(scope, path):
 
     for quota in utils.FIELD_NAMES:
         scope.set_quota_usage(utils.MAPPING[quota], qs['total_%s' % quota])
+
+
+def bump_version_stamp_on_allocation_change(sender, instance, **kwargs):
+    scope = instance.service_project_link.service.settings_id
+    transaction.on_commit(lambda: utils.bump_version_stamp(scope))
+
+
+def bump_global_version_stamp(sender, **kwargs):
+    transaction.on_commit(utils.bump_version_stamp)
+
+
+def record_command_metrics(sender, cluster, kind, duration, exit_status, output_bytes, output_lines, **kwargs):
+    # Signal is sent when command is finished, so that failure of metrics storage
+    # must neither mask error of the command nor fail successful command
+    if not metrics.is_enabled():
+        return
+    try:
+        metrics.record_command(cluster, kind, duration, exit_status, output_bytes, output_lines)
+    except Exception:
+        logger.exception('Unable to record metrics of %s command on cluster %s.', kind, cluster)
+
+
+def record_command_wait_metrics(sender, cluster, kind, wait, **kwargs):
+    if not metrics.is_enabled():
+        return
+    try:
+        metrics.record_wait(cluster, kind, wait)
+    except Exception:
+        logger.exception('Unable to record wait metrics of %s command on cluster %s.', kind, cluster)
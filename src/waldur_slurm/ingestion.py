@@ -0,0 +1,155 @@
+"""
+Ingestion of completed jobs pushed by agent running on the cluster.
+Jobs are stored in job ledger and usage of affected allocations and months is recalculated,
+so that near real-time usage is available without polling cluster accounting database.
+"""
+from __future__ import unicode_literals
+
+import collections
+import datetime
+import re
+
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import ledger, models, parser, rollups, utils
+from .structures import get_tres_schema
+
+UUID_PATTERN = re.compile('^[0-9a-f]{32}$')
+
+# Order of fields in job row is the same as in sacct report
+JOB_FIELDS = ('Account', 'ReqTRES', 'Elapsed', 'User', 'JobID', 'End')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def split_record(record, end, duration):
+    """
+    Split usage of the whole job into parts within months when it was running,
+    like sacct --truncate reports them. Usage is proportional to the number of minutes
+    within the month, the last part receives the remainder of rounding.
+    :param end: datetime of job end
+    :param duration: job duration in minutes
+    :return: list of ((year, month), usage record) pairs
+    """
+    start = end - datetime.timedelta(minutes=duration)
+    if not duration or (start.year, start.month) == (end.year, end.month):
+        return [((end.year, end.month), record)]
+
+    parts = []
+    remainder = list(record.values)
+    left = duration
+    part_start = start
+    while (part_start.year, part_start.month) != (end.year, end.month):
+        _, next_month = rollups.get_month_bounds(part_start.year, part_start.month)
+        part_end = datetime.datetime.combine(next_month, datetime.time())
+        minutes = int((part_end - part_start).total_seconds()) // 60
+        values = [value * minutes // duration for value in record.values]
+        remainder = [rest - value for rest, value in zip(remainder, values)]
+        left -= minutes
+        day = (next_month - datetime.timedelta(days=1)).isoformat()
+        parts.append(((part_start.year, part_start.month), record._replace(
+            values=values, day=day, start=part_start.strftime(TIME_FORMAT), minutes=minutes)))
+        part_start = part_end
+    parts.append(((end.year, end.month), record._replace(
+        values=remainder, start=part_start.strftime(TIME_FORMAT), minutes=left)))
+    return parts
+
+
+def parse_end(value, day):
+    """
+    Parse job end time, date of job end is used if time is not reported.
+    """
+    try:
+        end = parse_datetime(value)
+    except ValueError:
+        end = None
+    if end is None:
+        return datetime.datetime.strptime(day, '%Y-%m-%d')
+    return end.replace(tzinfo=None)
+
+
+def parse_jobs(rows):
+    """
+    Convert job rows to usage records split by months. If job is reported several times, the first row is used.
+    :return: dictionary mapping (year, month) pair to list of usage records
+    """
+    extra = get_tres_schema().extra
+    job_ids = set()
+    periods = collections.defaultdict(list)
+    for row in rows:
+        record = parser.parse_fields(row, extra)
+        if record.job_id in job_ids:
+            continue
+        job_ids.add(record.job_id)
+        if not record.day:
+            # Job is still running, its usage is attributed to the current month
+            today = timezone.now()
+            periods[(today.year, today.month)].append(record)
+            continue
+        end = parse_end(row[5], record.day)
+        for period, part in split_record(record, end, record.minutes):
+            periods[period].append(part)
+    return periods
+
+
+def get_allocations(service_settings, accounts):
+    """
+    Return allocations of the cluster matching account names. Allocations are locked
+    until the end of transaction, so that concurrent batches do not lose updates.
+    """
+    prefix = django_settings.WALDUR_SLURM['ALLOCATION_PREFIX']
+    uuids = {account[len(prefix):] for account in accounts if account.startswith(prefix)}
+    queryset = models.Allocation.objects.filter(
+        service_project_link__service__settings=service_settings,
+        uuid__in=[uuid for uuid in uuids if UUID_PATTERN.match(uuid)],
+    ).select_for_update().order_by('pk')
+    return {prefix + allocation.uuid.hex: allocation for allocation in queryset}
+
+
+class IngestionConflict(Exception):
+    pass
+
+
+def ingest_jobs(service_settings, rows):
+    """
+    Store completed jobs in job ledger and recalculate usage of allocations of the cluster.
+    Jobs which are already stored are skipped, so that agent can safely deliver the same batch again.
+    Usage of job running across the boundary of months is split between them,
+    like usage reported by sacct --truncate, and daily usage is spread between the days when job was running.
+    Usage lock of the cluster is held, so that concurrent deliveries and synchronization
+    do not write the same jobs at once.
+    :param rows: list of job fields, see JOB_FIELDS
+    :return: number of ingested, updated and skipped jobs
+    """
+    wait = django_settings.WALDUR_SLURM.get('LOCK_WAIT', 60)
+    with ledger.usage_lock(service_settings, wait=wait) as lease:
+        if not lease.acquired:
+            raise IngestionConflict('Usage of %s is being synchronized.' % service_settings)
+        return _ingest_jobs(service_settings, rows)
+
+
+@transaction.atomic()
+def _ingest_jobs(service_settings, rows):
+    periods = parse_jobs(rows)
+    accounts = {record.account for records in periods.values() for record in records}
+    allocations = get_allocations(service_settings, accounts)
+    groups, created, updated, unchanged = set(), set(), set(), set()
+    for period, records in sorted(periods.items()):
+        result = ledger.apply_records(service_settings, records, allocations, period)
+        groups |= result.groups
+        created |= result.created
+        updated |= result.updated
+        unchanged |= result.unchanged
+
+    changed = ledger.update_usage(groups)
+    ledger.update_quotas(changed.keys())
+    transaction.on_commit(lambda: ledger.update_rollups(groups))
+    transaction.on_commit(lambda: utils.bump_version_stamp(service_settings.pk))
+
+    # Job split between months is ingested if any of its parts is new and updated if any of them has changed
+    updated -= created
+    unchanged -= created | updated
+    return len(created), len(updated), len(unchanged)
@@ -0,0 +1,448 @@
+"""
+Job-level usage ledger. Usage records from any source (sacct polling, push ingestion, backfill)
+are upserted by cluster, job ID and month, so that applying the same records again changes nothing.
+Per-user, daily and allocation usage is then recalculated as indexed sums over ledger
+for changed allocations and months only.
+"""
+from __future__ import unicode_literals
+
+import collections
+import datetime
+import decimal
+import itertools
+import logging
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from waldur_core.structure import models as structure_models
+from waldur_freeipa import models as freeipa_models
+
+from . import handlers, locks, models, rollups, utils
+from .structures import BASE_TRES, Quotas, get_tres_schema
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+USAGE_FIELDS = ('cpu_usage', 'gpu_usage', 'ram_usage', 'deposit_usage')
+
+JOB_FIELDS = ('allocation_id', 'account', 'username', 'end', 'start', 'minutes', 'year', 'month',
+              'tres_usage') + USAGE_FIELDS
+
+# Sets of IDs of created, updated and unchanged jobs and set of (allocation ID, year, month) groups to recalculate
+LedgerResult = collections.namedtuple('LedgerResult', ['groups', 'created', 'updated', 'unchanged'])
+
+
+def get_job_fields(record, allocation, schema, period, truncated):
+    """
+    Truncated record is attributed to the month of the report, its end date is not later than
+    the last day of the month. Record of the whole job is attributed to the month of its end,
+    running job is attributed to the month of the report until it ends.
+    """
+    year, month = period
+    end = parse_date(record.day) if record.day else None
+    if end and truncated:
+        end = min(end, rollups.get_month_bounds(year, month)[1] - datetime.timedelta(days=1))
+    elif end:
+        year, month = end.year, end.month
+    start = parse_datetime(record.start) if record.start else None
+    if start:
+        start = timezone.make_aware(start, is_dst=False)
+    extra = record.values[len(BASE_TRES):]
+    return {
+        'allocation_id': allocation.pk,
+        'account': record.account,
+        'username': record.user,
+        'end': end,
+        'start': start,
+        'minutes': record.minutes,
+        'year': year,
+        'month': month,
+        'cpu_usage': record.values[0],
+        'gpu_usage': record.values[1],
+        'ram_usage': record.values[2],
+        'deposit_usage': utils.cents_to_decimal(record.values[3]),
+        'tres_usage': {name: value for name, value in zip(schema.extra, extra) if value},
+    }
+
+
+def get_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def merge_records(first, second):
+    """
+    Sum parts of usage of the same job reported in adjacent time windows.
+    Job is considered to be running if it is running in any of the windows.
+    """
+    values = [a + b for a, b in zip(first.values, second.values)]
+    day = max(first.day, second.day) if first.day and second.day else ''
+    start = min(first.start, second.start) if first.start and second.start else first.start or second.start
+    return first._replace(values=values, day=day, start=start, minutes=first.minutes + second.minutes)
+
+
+def collect_jobs(service_settings, records, allocations, truncated):
+    """
+    Group usage records by job ID. Truncated records of the same job are summed,
+    otherwise each record contains usage of the whole job and the last one is used.
+    :return: ordered dictionary mapping job ID to pair of usage record and allocation
+    """
+    jobs = collections.OrderedDict()
+    anonymous = 0
+    for record in records:
+        if not record.job_id:
+            anonymous += 1
+            continue
+        allocation = allocations.get(record.account)
+        if allocation is None:
+            logger.debug('Skipping usage of job %s because account %s is not managed under Waldur',
+                         record.job_id, record.account)
+            continue
+        job = jobs.get(record.job_id)
+        if job is not None and truncated:
+            record = merge_records(job[0], record)
+        jobs[record.job_id] = (record, allocation)
+
+    if anonymous:
+        logger.warning('Skipping usage of %s jobs of cluster %s because job ID is not reported.',
+                       anonymous, service_settings.name)
+    return jobs
+
+
+@transaction.atomic()
+def apply_records(service_settings, records, allocations, period=None, truncated=True):
+    """
+    Store usage records in job ledger. New jobs are created, jobs with changed usage are updated
+    and jobs which are already stored with the same usage are skipped.
+    :param allocations: dictionary mapping account name to allocation, records of other accounts are skipped
+    :param period: (year, month) pair of the usage report, current month is used by default
+    :param truncated: records contain parts of usage of job within time windows of the report,
+    see BaseBatchClient.truncates_usage
+    :return: LedgerResult
+    """
+    schema = get_tres_schema()
+    if period is None:
+        today = timezone.now().date()
+        period = (today.year, today.month)
+    groups = set()
+    created, updated, unchanged = set(), set(), set()
+    jobs = collect_jobs(service_settings, records, allocations, truncated)
+
+    for chunk in get_chunks(jobs.items(), CHUNK_SIZE):
+        queryset = models.Job.objects.filter(settings=service_settings, job_id__in=[job_id for job_id, _ in chunk])
+        if truncated:
+            # Job has a row for each month, while record of the whole job is moved to the month of its end
+            queryset = queryset.filter(year=period[0], month=period[1])
+        existing = {row[0]: row[1:] for row in queryset.values_list('job_id', 'pk', *JOB_FIELDS)}
+
+        new_jobs = []
+        for job_id, (record, allocation) in chunk:
+            fields = get_job_fields(record, allocation, schema, period, truncated)
+            group = (fields['allocation_id'], fields['year'], fields['month'])
+            row = existing.get(job_id)
+            if row is None:
+                new_jobs.append(models.Job(settings=service_settings, job_id=job_id, **fields))
+                groups.add(group)
+                created.add(job_id)
+                continue
+
+            pk, stored = row[0], dict(zip(JOB_FIELDS, row[1:]))
+            if stored == fields:
+                unchanged.add(job_id)
+                continue
+
+            models.Job.objects.filter(pk=pk).update(**fields)
+            groups.add((stored['allocation_id'], stored['year'], stored['month']))
+            groups.add(group)
+            updated.add(job_id)
+
+        try:
+            with transaction.atomic():
+                models.Job.objects.bulk_create(new_jobs, batch_size=CHUNK_SIZE)
+        except IntegrityError:
+            # Some of the jobs have been stored by concurrent writer, so that they are updated instead
+            for job in new_jobs:
+                if not create_job(job):
+                    created.discard(job.job_id)
+                    updated.add(job.job_id)
+
+    return LedgerResult(groups, created, updated, unchanged)
+
+
+def create_job(job):
+    """
+    Store new job or update job with the same key stored concurrently.
+    :return: True if job has been created
+    """
+    try:
+        with transaction.atomic():
+            job.save(force_insert=True)
+        return True
+    except IntegrityError:
+        models.Job.objects.filter(
+            settings=job.settings, job_id=job.job_id, year=job.year, month=job.month,
+        ).update(**{field: getattr(job, field) for field in JOB_FIELDS})
+        return False
+
+
+def usage_lock(service_settings, wait=0):
+    """
+    Cluster-wide lock held while usage of the cluster is written to job ledger,
+    so that synchronization, backfill and ingestion do not write the same jobs concurrently.
+    """
+    return locks.single_flight('usage:%s' % service_settings.uuid.hex, wait=wait)
+
+
+def get_usage_fields(quotas):
+    return {
+        'cpu_usage': quotas.cpu,
+        'gpu_usage': quotas.gpu,
+        'ram_usage': quotas.ram,
+        'deposit_usage': decimal.Decimal(quotas.deposit).quantize(decimal.Decimal('0.01')),
+        'tres_usage': {name: value for name, value in quotas.extra.items() if value},
+    }
+
+
+def get_share(value, seconds, total):
+    if isinstance(value, decimal.Decimal):
+        return value * seconds / total
+    return value * seconds // total
+
+
+def spread_usage(values, start, minutes, day, bounds):
+    """
+    Split usage of job between days when it was running proportionally to its time within each day.
+    Usage grows linearly with time, so that shares of past days do not change while job keeps running,
+    the last day receives the remainder of rounding. Days outside of the month are attributed to its
+    first or last day. Usage of job which start time is not known is attributed to the given day.
+    :param bounds: first and last day of the month
+    :return: list of (date, values) pairs
+    """
+    if start is None or not minutes:
+        return [(day, values)]
+
+    first, last = bounds
+    current = timezone.localtime(start)
+    end = current + datetime.timedelta(minutes=minutes)
+    total = minutes * 60
+    parts = []
+    remainder = list(values)
+    while True:
+        midnight = datetime.datetime.combine(current.date() + datetime.timedelta(days=1), datetime.time())
+        midnight = timezone.make_aware(midnight, is_dst=False)
+        if midnight >= end:
+            break
+        seconds = int((midnight - current).total_seconds())
+        share = [get_share(value, seconds, total) for value in values]
+        remainder = [rest - value for rest, value in zip(remainder, share)]
+        parts.append((min(max(current.date(), first), last), share))
+        current = timezone.localtime(midnight)
+    parts.append((min(max(current.date(), first), last), remainder))
+    return parts
+
+
+def sum_usage(allocation_ids, year, month, schema, default_day):
+    """
+    Sum ledger of allocations for the given month per user and per user and day.
+    Usage of job is spread between the days when it was running, see spread_usage.
+    Job which start time is not known is attributed to the day when it has ended
+    or, if it is still running, to the default day, that is today or the last day of the past month.
+    """
+    start, end = rollups.get_month_bounds(year, month)
+    bounds = (start, end - datetime.timedelta(days=1))
+    rows = models.Job.objects.filter(allocation_id__in=allocation_ids, year=year, month=month).values_list(
+        'allocation_id', 'username', 'end', 'start', 'minutes', 'tres_usage', *USAGE_FIELDS).iterator()
+
+    monthly = {}
+    daily = {}
+
+    def add(usage, key, values):
+        quotas = usage.get(key)
+        if quotas is None:
+            quotas = usage[key] = Quotas(schema=schema)
+        quotas.add_values(values)
+
+    for row in rows:
+        allocation_id, username, job_end, job_start, minutes, tres_usage = row[:6]
+        values = list(row[6:]) + [tres_usage.get(name, 0) for name in schema.extra]
+        key = (allocation_id, username)
+        add(monthly, key, values)
+        for day, part in spread_usage(values, job_start, minutes, job_end or default_day, bounds):
+            add(daily, key + (day,), part)
+
+    return monthly, daily
+
+
+def get_usermap(usernames):
+    return {
+        profile.username: profile.user
+        for profile in freeipa_models.Profile.objects.filter(username__in=usernames)
+    }
+
+
+def update_monthly_usage(allocation_ids, year, month, monthly, usermap):
+    existing = {
+        (usage.allocation_id, usage.username): usage
+        for usage in models.AllocationUsage.objects.filter(allocation_id__in=allocation_ids, year=year, month=month)
+    }
+    new_rows = []
+    for (allocation_id, username), quotas in monthly.items():
+        values = get_usage_fields(quotas)
+        usage = existing.get((allocation_id, username))
+        if usage is None:
+            new_rows.append(models.AllocationUsage(
+                allocation_id=allocation_id,
+                username=username,
+                user=usermap.get(username),
+                year=year,
+                month=month,
+                **values
+            ))
+        elif any(getattr(usage, field) != value for field, value in values.items()):
+            models.AllocationUsage.objects.filter(pk=usage.pk).update(**values)
+    # Usage of user is removed if all jobs of the user have been moved to another month or allocation
+    stale = [usage.pk for key, usage in existing.items() if key not in monthly]
+    if stale:
+        models.AllocationUsage.objects.filter(pk__in=stale).delete()
+    models.AllocationUsage.objects.bulk_create(new_rows, batch_size=CHUNK_SIZE)
+
+
+def update_daily_usage(allocation_ids, year, month, daily, usermap):
+    """
+    Store daily usage of allocations for the month. Only rows with changed usage are written,
+    so that usage of past days is kept as is while jobs keep running.
+    :return: number of created, updated and deleted rows
+    """
+    start, end = rollups.get_month_bounds(year, month)
+    existing = {
+        (usage.allocation_id, usage.username, usage.date): usage
+        for usage in models.AllocationDailyUsage.objects.filter(
+            allocation_id__in=allocation_ids, date__gte=start, date__lt=end)
+    }
+    new_rows = []
+    updated = 0
+    for (allocation_id, username, date), quotas in daily.items():
+        values = get_usage_fields(quotas)
+        usage = existing.get((allocation_id, username, date))
+        if usage is None:
+            new_rows.append(models.AllocationDailyUsage(
+                allocation_id=allocation_id,
+                username=username,
+                user=usermap.get(username),
+                date=date,
+                **values
+            ))
+        elif any(getattr(usage, field) != value for field, value in values.items()):
+            models.AllocationDailyUsage.objects.filter(pk=usage.pk).update(**values)
+            updated += 1
+    stale = [usage.pk for key, usage in existing.items() if key not in daily]
+    if stale:
+        models.AllocationDailyUsage.objects.filter(pk__in=stale).delete()
+    models.AllocationDailyUsage.objects.bulk_create(new_rows, batch_size=CHUNK_SIZE)
+    return len(new_rows) + updated + len(stale)
+
+
+def update_totals(allocation_ids, monthly, schema):
+    totals = {allocation_id: Quotas(schema=schema) for allocation_id in allocation_ids}
+    for (allocation_id, _), quotas in monthly.items():
+        totals[allocation_id] += quotas
+
+    changed = {}
+    queryset = models.Allocation.objects.filter(pk__in=allocation_ids).select_related('service_project_link__service')
+    for allocation in queryset:
+        values = get_usage_fields(totals[allocation.pk])
+        if any(getattr(allocation, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(allocation, field, value)
+            # Allocation is saved, so that post_save handlers are notified, while project
+            # and customer quotas are updated once for all allocations by update_quotas
+            allocation.skip_quota_update = True
+            allocation.save(update_fields=list(values.keys()))
+            changed[allocation.pk] = values
+    return changed
+
+
+def update_quotas(allocation_ids):
+    """
+    Recalculate quotas of projects and customers owning the given allocations,
+    each project and customer is recalculated once.
+    :return: number of updated projects and customers
+    """
+    if not allocation_ids:
+        return 0
+    project_ids = models.Allocation.objects.filter(pk__in=allocation_ids).values(
+        'service_project_link__project_id')
+    projects = list(structure_models.Project.objects.filter(pk__in=project_ids).select_related('customer'))
+    customers = {project.customer for project in projects}
+    for project in projects:
+        handlers.update_quotas(project, models.Allocation.Permissions.project_path)
+    for customer in customers:
+        handlers.update_quotas(customer, models.Allocation.Permissions.customer_path)
+    return len(projects) + len(customers)
+
+
+@transaction.atomic()
+def update_usage(groups):
+    """
+    Recalculate per-user monthly and daily usage of allocations from job ledger.
+    Allocation totals are recalculated for the current month only,
+    quotas of their projects and customers should be updated by update_quotas.
+    :param groups: set of (allocation ID, year, month) returned by apply_records
+    :return: dictionary mapping ID of allocation with changed totals to new usage values
+    """
+    schema = get_tres_schema()
+    today = timezone.now().date()
+    months = collections.defaultdict(set)
+    for allocation_id, year, month in groups:
+        # Jobs stored before ledger has tracked usage are not attributed to any month
+        if allocation_id and year:
+            months[(year, month)].add(allocation_id)
+
+    changed = {}
+    for (year, month), allocation_ids in sorted(months.items()):
+        start, end = rollups.get_month_bounds(year, month)
+        default_day = min(today, end - datetime.timedelta(days=1))
+        monthly, daily = sum_usage(allocation_ids, year, month, schema, default_day)
+        usermap = get_usermap({username for _, username in monthly})
+        update_monthly_usage(allocation_ids, year, month, monthly, usermap)
+        update_daily_usage(allocation_ids, year, month, daily, usermap)
+        if (year, month) == (today.year, today.month):
+            changed.update(update_totals(allocation_ids, monthly, schema))
+    return changed
+
+
+def get_rollup_customers(groups):
+    """
+    :return: dictionary mapping (year, month) pair to set of IDs of customers owning allocations of the groups
+    """
+    allocation_ids = {allocation_id for allocation_id, year, _ in groups if allocation_id and year}
+    customers = dict(models.Allocation.objects.filter(pk__in=allocation_ids).values_list(
+        'pk', 'service_project_link__project__customer_id'))
+    months = collections.defaultdict(set)
+    for allocation_id, year, month in groups:
+        if allocation_id in customers and year:
+            months[(year, month)].add(customers[allocation_id])
+    return months
+
+
+def update_customer_rollups(months):
+    """
+    :param months: dictionary mapping (year, month) pair to set of IDs of customers
+    :return: number of stored rollups
+    """
+    return sum(rollups.update_usage_rollups(customer_ids, year, month)
+               for (year, month), customer_ids in sorted(months.items()))
+
+
+def update_rollups(groups):
+    """
+    Recalculate usage rollups of customers owning allocations for the months of the given groups.
+    """
+    return update_customer_rollups(get_rollup_customers(groups))
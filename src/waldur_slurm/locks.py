@@ -0,0 +1,166 @@
+"""
+Cluster-wide single-flight locks for heavy operations, such as usage synchronization,
+and semaphores limiting number of concurrent commands executed on the cluster.
+Locks and slots of semaphores are leases stored in cache shared by all workers. They expire
+automatically, so that lease held by crashed worker does not block the cluster forever.
+"""
+from __future__ import unicode_literals
+
+import contextlib
+import logging
+import time
+import uuid
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'waldur_slurm:lock:%s'
+
+# Number of seconds between attempts to acquire lease held by another worker
+POLL_INTERVAL = 1
+
+
+def get_timeout():
+    return django_settings.WALDUR_SLURM.get('LOCK_TIMEOUT', 30 * 60)
+
+
+class Lease(object):
+    """
+    :param name: name of the lock, for example operation and UUID of service settings
+    :param timeout: lifetime of the lease in seconds, long running operation should extend it
+    """
+
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.key = LOCK_KEY % name
+        self.timeout = timeout or get_timeout()
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+
+    def acquire(self, wait=0):
+        """
+        Try to acquire lease, waiting up to the given number of seconds if it is held by another worker.
+        :return: True if lease has been acquired
+        """
+        deadline = time.time() + wait
+        while not cache.add(self.key, self.token, self.timeout):
+            if time.time() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+        self.acquired = True
+        return True
+
+    def extend(self):
+        """
+        Restart lifetime of the lease, so that it does not expire while operation makes progress.
+        """
+        if not self.acquired:
+            return
+        if cache.get(self.key) == self.token:
+            cache.set(self.key, self.token, self.timeout)
+        elif not cache.add(self.key, self.token, self.timeout):
+            logger.warning('Lease %s has expired and it has been acquired by another worker.', self.name)
+
+    def release(self):
+        # Lease which has expired and has been acquired by another worker is not released
+        if self.acquired and cache.get(self.key) == self.token:
+            cache.delete(self.key)
+        self.acquired = False
+
+
+@contextlib.contextmanager
+def single_flight(name, timeout=None, wait=0):
+    """
+    Acquire lease for the duration of the block. Caller should skip operation
+    if lease has not been acquired, because the same operation is in flight.
+    Usage:
+
+        with single_flight('sync_usage:%s' % uuid) as lease:
+            if lease.acquired:
+                sync_usage()
+    """
+    lease = Lease(name, timeout)
+    lease.acquire(wait)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+SLOT_KEY = 'waldur_slurm:semaphore:%s:slot:%s'
+
+TICKETS_KEY = 'waldur_slurm:semaphore:%s:tickets'
+
+WAITER_KEY = 'waldur_slurm:semaphore:%s:waiter:%s'
+
+# Number of seconds between attempts to acquire slot of semaphore
+SLOT_POLL_INTERVAL = 0.2
+
+# Waiter which has not polled for this number of seconds is considered to be gone
+WAITER_TIMEOUT = 10
+
+# Number of preceding tickets checked by waiter, so that cost of the check does not grow with the queue
+MAX_QUEUE_LOOKBEHIND = 100
+
+
+class Semaphore(object):
+    """
+    Distributed semaphore limiting number of concurrent holders across all workers.
+    Each slot is a lease, so that slot of crashed worker is released when the lease expires.
+    Waiters are served approximately in order of arrival: each waiter takes a ticket and
+    it may take free slot only if it is not reserved for live waiters with earlier tickets.
+    :param name: name of the semaphore, for example hostname of the cluster
+    :param limit: maximum number of concurrent holders
+    :param timeout: lifetime of slot lease in seconds
+    """
+
+    def __init__(self, name, limit, timeout=None):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout or get_timeout()
+        self.token = uuid.uuid4().hex
+        self.slot_key = None
+
+    def acquire(self, wait=0):
+        """
+        Wait up to the given number of seconds for free slot.
+        :return: True if slot has been acquired
+        """
+        deadline = time.time() + wait
+        ticket = self.get_ticket()
+        waiter_key = WAITER_KEY % (self.name, ticket)
+        slot_keys = [SLOT_KEY % (self.name, slot) for slot in range(self.limit)]
+        earlier_keys = [WAITER_KEY % (self.name, earlier)
+                        for earlier in range(max(ticket - MAX_QUEUE_LOOKBEHIND, 1), ticket)]
+        try:
+            while True:
+                cache.set(waiter_key, True, WAITER_TIMEOUT)
+                busy = cache.get_many(slot_keys)
+                free_keys = [key for key in slot_keys if key not in busy]
+                if free_keys:
+                    ahead = len(cache.get_many(earlier_keys))
+                    for key in free_keys[ahead:]:
+                        if cache.add(key, self.token, self.timeout):
+                            self.slot_key = key
+                            return True
+                if time.time() >= deadline:
+                    return False
+                time.sleep(SLOT_POLL_INTERVAL)
+        finally:
+            cache.delete(waiter_key)
+
+    def get_ticket(self):
+        key = TICKETS_KEY % self.name
+        try:
+            return cache.incr(key)
+        except ValueError:
+            if cache.add(key, 1, None):
+                return 1
+            return cache.incr(key)
+
+    def release(self):
+        if self.slot_key and cache.get(self.slot_key) == self.token:
+            cache.delete(self.slot_key)
+        self.slot_key = None
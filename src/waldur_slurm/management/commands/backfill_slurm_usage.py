@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from waldur_core.structure import models as structure_models
+from waldur_slurm import models, tasks, utils
+from waldur_slurm.apps import SlurmConfig
+
+
+class Command(BaseCommand):
+    help = ('Recalculate per-user usage of SLURM allocations for past months. '
+            'Completed months are skipped, so that interrupted backfill can be resumed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('start', help='First month formatted as YYYY-MM.')
+        parser.add_argument('end', nargs='?', help='Last month formatted as YYYY-MM. Start month is used by default.')
+        parser.add_argument('--settings-uuid', dest='settings_uuids', action='append', default=[],
+                            help='UUID of SLURM service settings. All SLURM clusters are processed by default.')
+        parser.add_argument('--windows', type=int, default=1,
+                            help='Number of time windows each month is split into.')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Process months which are already backfilled.')
+
+    def handle(self, *args, **options):
+        try:
+            start = utils.parse_month(options['start'])
+            end = utils.parse_month(options['end'] or options['start'])
+        except ValueError:
+            raise CommandError('Month should be formatted as YYYY-MM.')
+        months = utils.get_month_range(start, end)
+        if not months:
+            raise CommandError('Start month should not be later than end month.')
+
+        queryset = structure_models.ServiceSettings.objects.filter(type=SlurmConfig.service_name)
+        if options['settings_uuids']:
+            queryset = queryset.filter(uuid__in=options['settings_uuids'])
+
+        for service_settings in queryset:
+            self.stdout.write('Backfilling usage of %s.' % service_settings)
+            tasks.backfill_usage(service_settings.uuid.hex, months, options['windows'], options['force'])
+            failed = models.UsageBackfill.objects.filter(
+                settings=service_settings, state=models.UsageBackfill.States.ERRED)
+            for backfill in failed:
+                if (backfill.year, backfill.month) in months:
+                    self.stderr.write('%s-%02d: %s' % (backfill.year, backfill.month, backfill.error_message))
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+import collections
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from waldur_core.structure import models as structure_models
+from waldur_slurm import utils
+from waldur_slurm.apps import SlurmConfig
+
+
+class Command(BaseCommand):
+    help = ('List Celery queues of SLURM clusters if queue routing is enabled. '
+            'Dedicated workers can be started for each queue, for example: '
+            'celery worker -Q <queue> --concurrency <number of workers>.')
+
+    def handle(self, *args, **options):
+        if not settings.WALDUR_SLURM.get('QUEUE_ROUTING_ENABLED', False):
+            self.stdout.write('Queue routing is disabled, tasks of all clusters are sent to default queue.')
+            return
+
+        queues = collections.defaultdict(list)
+        for service_settings in structure_models.ServiceSettings.objects.filter(type=SlurmConfig.service_name):
+            queues[utils.get_queue_name(service_settings)].append(service_settings.name)
+
+        for queue, names in sorted(queues.items()):
+            self.stdout.write('%s\t%s' % (queue, ', '.join(sorted(names))))
@@ -0,0 +1,165 @@
+"""
+Batch command metrics are accumulated in Django cache so that observations
+made by Celery workers are visible to API nodes, which render them
+using Prometheus text exposition format.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+# Upper bounds of command duration histogram buckets in seconds
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Each series is stored under its own index, so that concurrent workers registering series do not overwrite each other
+SERIES_COUNT_KEY = 'waldur_slurm:metrics:series'
+
+SERIES_ITEM_KEY = 'waldur_slurm:metrics:series:%s'
+
+# Durations are stored in microseconds because cache supports only integer increments
+MICROSECONDS = 10 ** 6
+
+# Number of observations is not stored separately, it is the sum of histogram buckets,
+# so that each observation costs one cache round-trip less
+COUNTERS = (
+    ('command_failures_total', 'counter', 'Number of batch commands finished with non-zero exit status.'),
+    ('command_output_bytes_total', 'counter', 'Size of batch commands output in bytes.'),
+    ('command_output_lines_total', 'counter', 'Number of lines in batch commands output.'),
+)
+
+
+def is_enabled():
+    return django_settings.WALDUR_SLURM.get('COMMAND_METRICS_ENABLED', True)
+
+
+def get_metric_key(cluster, kind, metric):
+    return 'waldur_slurm:metrics:%s:%s:%s' % (cluster, kind.replace(' ', '_'), metric)
+
+
+def increment(key, delta=1):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, None):
+            cache.incr(key, delta)
+
+
+def register_series(cluster, kind):
+    if not cache.add(get_metric_key(cluster, kind, 'registered'), True, None):
+        return
+    try:
+        index = cache.incr(SERIES_COUNT_KEY)
+    except ValueError:
+        index = 1 if cache.add(SERIES_COUNT_KEY, 1, None) else cache.incr(SERIES_COUNT_KEY)
+    cache.set(SERIES_ITEM_KEY % index, [cluster, kind], None)
+
+
+def get_bucket(duration):
+    for bound in DURATION_BUCKETS:
+        if duration <= bound:
+            return str(bound)
+    return '+Inf'
+
+
+def record_command(cluster, kind, duration, exit_status, output_bytes, output_lines):
+    register_series(cluster, kind)
+    if exit_status != 0:
+        increment(get_metric_key(cluster, kind, 'command_failures_total'))
+    # Empty output does not change counters, so that its increments are skipped
+    if output_bytes:
+        increment(get_metric_key(cluster, kind, 'command_output_bytes_total'), int(output_bytes))
+    if output_lines:
+        increment(get_metric_key(cluster, kind, 'command_output_lines_total'), int(output_lines))
+    increment(get_metric_key(cluster, kind, 'command_duration_microseconds_sum'), int(duration * MICROSECONDS))
+    increment(get_metric_key(cluster, kind, 'command_duration_bucket:%s' % get_bucket(duration)))
+
+
+def record_wait(cluster, kind, duration):
+    register_series(cluster, kind)
+    increment(get_metric_key(cluster, kind, 'command_wait_microseconds_sum'), int(duration * MICROSECONDS))
+    increment(get_metric_key(cluster, kind, 'command_wait_bucket:%s' % get_bucket(duration)))
+
+
+def get_series():
+    keys = [SERIES_ITEM_KEY % index for index in range(1, (cache.get(SERIES_COUNT_KEY) or 0) + 1)]
+    items = cache.get_many(keys)
+    return [tuple(items[key]) for key in keys if key in items]
+
+
+def render_metrics():
+    """
+    Render collected metrics using Prometheus text exposition format.
+    """
+    series = get_series()
+    lines = [
+        '# HELP waldur_slurm_commands_total Number of executed batch commands.',
+        '# TYPE waldur_slurm_commands_total counter',
+    ]
+    counts = get_histogram_counts(series, 'command_duration')
+    for cluster, kind in series:
+        lines.append('waldur_slurm_commands_total{%s} %s' % (format_labels(cluster, kind), counts[(cluster, kind)]))
+
+    for metric, metric_type, description in COUNTERS:
+        name = 'waldur_slurm_%s' % metric
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        values = cache.get_many([get_metric_key(cluster, kind, metric) for cluster, kind in series])
+        for cluster, kind in series:
+            value = values.get(get_metric_key(cluster, kind, metric), 0)
+            lines.append('%s{%s} %s' % (name, format_labels(cluster, kind), value))
+
+    lines.extend(render_histogram(
+        series, 'command_duration', 'Wall time of batch commands execution.'))
+    lines.extend(render_histogram(
+        series, 'command_wait', 'Time spent by batch commands waiting for free slot.'))
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_bounds():
+    return [str(bound) for bound in DURATION_BUCKETS] + ['+Inf']
+
+
+def get_histogram_counts(series, metric):
+    """
+    Return number of observations of each series, which is the sum of its histogram buckets.
+    """
+    keys = {
+        (cluster, kind): [get_metric_key(cluster, kind, '%s_bucket:%s' % (metric, bound)) for bound in get_bounds()]
+        for cluster, kind in series
+    }
+    values = cache.get_many([key for series_keys in keys.values() for key in series_keys])
+    return {item: sum(values.get(key, 0) for key in series_keys) for item, series_keys in keys.items()}
+
+
+def render_histogram(series, metric, description):
+    name = 'waldur_slurm_%s_seconds' % metric
+    lines = [
+        '# HELP %s %s' % (name, description),
+        '# TYPE %s histogram' % name,
+    ]
+    bounds = get_bounds()
+    for cluster, kind in series:
+        keys = {bound: get_metric_key(cluster, kind, '%s_bucket:%s' % (metric, bound)) for bound in bounds}
+        sum_key = get_metric_key(cluster, kind, '%s_microseconds_sum' % metric)
+        values = cache.get_many(list(keys.values()) + [sum_key])
+        if not values:
+            continue
+        labels = format_labels(cluster, kind)
+
+        total = 0
+        for bound in bounds:
+            total += values.get(keys[bound], 0)
+            lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, total))
+        lines.append('%s_sum{%s} %s' % (name, labels, float(values.get(sum_key, 0)) / MICROSECONDS))
+        lines.append('%s_count{%s} %s' % (name, labels, total))
+
+    return lines
+
+
+def format_labels(cluster, kind):
+    return 'cluster="%s",kind="%s"' % (escape_label(cluster), escape_label(kind))
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def remove_duplicate_usage(apps, schema_editor):
+    AllocationUsage = apps.get_model('waldur_slurm', 'AllocationUsage')
+    duplicates = (AllocationUsage.objects
+                  .order_by()
+                  .values('allocation', 'year', 'month', 'username')
+                  .annotate(last_id=models.Max('id'), count=models.Count('id'))
+                  .filter(count__gt=1))
+
+    for item in duplicates:
+        AllocationUsage.objects.filter(
+            allocation=item['allocation'],
+            year=item['year'],
+            month=item['month'],
+            username=item['username'],
+        ).exclude(id=item['last_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waldur_slurm', '0006_allocationusage_deposit_usage'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_usage, reverse_code=migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='allocationusage',
+            unique_together=set([('allocation', 'year', 'month', 'username')]),
+        ),
+        migrations.AddIndex(
+            model_name='allocationusage',
+            index=models.Index(fields=['year', 'month'], name='slurm_usage_year_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='allocationusage',
+            index=models.Index(fields=['username'], name='slurm_usage_username_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import waldur_core.core.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waldur_slurm', '0007_allocationusage_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allocation',
+            name='tres_limits',
+            field=waldur_core.core.fields.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='allocation',
+            name='tres_usage',
+            field=waldur_core.core.fields.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='allocationusage',
+            name='tres_usage',
+            field=waldur_core.core.fields.JSONField(blank=True, default=dict),
+        ),
+    ]
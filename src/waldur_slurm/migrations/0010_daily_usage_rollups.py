@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import waldur_core.core.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('structure', '0052_customer_subnets'),
+        ('waldur_slurm', '0009_usagebackfill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationDailyUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=32)),
+                ('date', models.DateField()),
+                ('cpu_usage', models.BigIntegerField(default=0)),
+                ('ram_usage', models.BigIntegerField(default=0)),
+                ('gpu_usage', models.BigIntegerField(default=0)),
+                ('deposit_usage', models.DecimalField(decimal_places=2, default=0, max_digits=8)),
+                ('tres_usage', waldur_core.core.fields.JSONField(blank=True, default=dict)),
+                ('allocation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_usages', to='waldur_slurm.Allocation')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['allocation', 'date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.CharField(choices=[('allocation', 'Allocation'), ('project', 'Project'), ('customer', 'Organization')], max_length=10)),
+                ('period', models.CharField(choices=[('day', 'Day'), ('month', 'Month')], max_length=5)),
+                ('date', models.DateField()),
+                ('cpu_usage', models.BigIntegerField(default=0)),
+                ('ram_usage', models.BigIntegerField(default=0)),
+                ('gpu_usage', models.BigIntegerField(default=0)),
+                ('deposit_usage', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('tres_usage', waldur_core.core.fields.JSONField(blank=True, default=dict)),
+                ('allocation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='waldur_slurm.Allocation')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='structure.Customer')),
+                ('project', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='structure.Project')),
+            ],
+            options={
+                'ordering': ['date'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='allocationdailyusage',
+            unique_together=set([('allocation', 'username', 'date')]),
+        ),
+        migrations.AddIndex(
+            model_name='allocationdailyusage',
+            index=models.Index(fields=['date'], name='slurm_daily_usage_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usagerollup',
+            index=models.Index(fields=['level', 'period', 'date'], name='slurm_rollup_level_date_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waldur_slurm', '0010_daily_usage_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allocation',
+            name='usage_velocity',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='allocation',
+            name='last_usage_sync',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='allocation',
+            name='next_usage_sync',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import waldur_core.core.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waldur_slurm', '0012_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='account',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='year',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='month',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='cpu_usage',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='ram_usage',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='gpu_usage',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='deposit_usage',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='tres_usage',
+            field=waldur_core.core.fields.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['allocation', 'year', 'month'], name='slurm_job_allocation_month_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waldur_slurm', '0014_usagesynccheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='job',
+            options={'ordering': ['settings', 'job_id', 'year', 'month']},
+        ),
+        migrations.AlterUniqueTogether(
+            name='job',
+            unique_together=set([('settings', 'job_id', 'year', 'month')]),
+        ),
+    ]
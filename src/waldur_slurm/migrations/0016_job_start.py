@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waldur_slurm', '0015_job_month'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='start',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='minutes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
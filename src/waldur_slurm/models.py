@@ -3,7 +3,9 @@ from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from model_utils import FieldTracker
+from model_utils.models import TimeStampedModel
 
+from waldur_core.core.fields import JSONField
 from waldur_core.structure import models as structure_models
 from waldur_slurm import utils
 
@@ -59,6 +61,15 @@ class Allocation(structure_models.NewResource):
     deposit_limit = models.DecimalField(max_digits=6, decimal_places=0, default=-1)
     deposit_usage = models.DecimalField(max_digits=8, decimal_places=2, default=0)
 
+    # Limits and usage of extra TRES configured in WALDUR_SLURM['EXTRA_TRES'], keyed by TRES name
+    tres_limits = JSONField(default=dict, blank=True)
+    tres_usage = JSONField(default=dict, blank=True)
+
+    # Adaptive usage synchronization schedule, velocity is measured in CPU minutes per hour
+    usage_velocity = models.FloatField(default=0)
+    last_usage_sync = models.DateTimeField(blank=True, null=True)
+    next_usage_sync = models.DateTimeField(blank=True, null=True, db_index=True)
+
     @classmethod
     def get_url_name(cls):
         return 'slurm-allocation'
@@ -69,7 +80,7 @@ class Allocation(structure_models.NewResource):
     @classmethod
     def get_backend_fields(cls):
         return super(Allocation, cls).get_backend_fields() + (
-            'cpu_usage', 'gpu_usage', 'ram_usage', 'deposit_usage'
+            'cpu_usage', 'gpu_usage', 'ram_usage', 'deposit_usage', 'tres_usage'
         )
 
     @property
@@ -85,6 +96,11 @@ class AllocationUsage(models.Model):
 
     class Meta(object):
         ordering = ['allocation']
+        unique_together = ('allocation', 'year', 'month', 'username')
+        indexes = [
+            models.Index(fields=['year', 'month'], name='slurm_usage_year_month_idx'),
+            models.Index(fields=['username'], name='slurm_usage_username_idx'),
+        ]
 
     allocation = models.ForeignKey(Allocation)
     username = models.CharField(max_length=32)
@@ -97,3 +113,163 @@ class AllocationUsage(models.Model):
     ram_usage = models.BigIntegerField(default=0)
     gpu_usage = models.BigIntegerField(default=0)
     deposit_usage = models.DecimalField(max_digits=8, decimal_places=2, default=0)
+    tres_usage = JSONField(default=dict, blank=True)
+
+
+class AllocationDailyUsage(models.Model):
+    """
+    Usage of allocation by user for a single day. Usage of job is spread between the days
+    when it was running proportionally to its time within each day.
+    """
+    class Permissions(object):
+        customer_path = 'allocation__service_project_link__project__customer'
+        project_path = 'allocation__service_project_link__project'
+        service_path = 'allocation__service_project_link__service'
+
+    class Meta(object):
+        ordering = ['allocation', 'date']
+        unique_together = ('allocation', 'username', 'date')
+        indexes = [
+            models.Index(fields=['date'], name='slurm_daily_usage_date_idx'),
+        ]
+
+    allocation = models.ForeignKey(Allocation, related_name='daily_usages', on_delete=models.CASCADE)
+    username = models.CharField(max_length=32)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
+                             related_name='+', on_delete=models.SET_NULL)
+    date = models.DateField()
+
+    cpu_usage = models.BigIntegerField(default=0)
+    ram_usage = models.BigIntegerField(default=0)
+    gpu_usage = models.BigIntegerField(default=0)
+    deposit_usage = models.DecimalField(max_digits=8, decimal_places=2, default=0)
+    tres_usage = JSONField(default=dict, blank=True)
+
+
+class UsageRollup(models.Model):
+    """
+    Usage of allocation, project or customer summed over a day or a month.
+    Rollups are recalculated from daily usage after synchronization.
+    Monthly rollup is dated by the first day of the month.
+    """
+    class Permissions(object):
+        customer_path = 'customer'
+        project_path = 'project'
+
+    class Levels(object):
+        ALLOCATION = 'allocation'
+        PROJECT = 'project'
+        CUSTOMER = 'customer'
+
+        CHOICES = (
+            (ALLOCATION, _('Allocation')),
+            (PROJECT, _('Project')),
+            (CUSTOMER, _('Organization')),
+        )
+
+    class Periods(object):
+        DAY = 'day'
+        MONTH = 'month'
+
+        CHOICES = (
+            (DAY, _('Day')),
+            (MONTH, _('Month')),
+        )
+
+    class Meta(object):
+        ordering = ['date']
+        indexes = [
+            models.Index(fields=['level', 'period', 'date'], name='slurm_rollup_level_date_idx'),
+        ]
+
+    level = models.CharField(max_length=10, choices=Levels.CHOICES)
+    period = models.CharField(max_length=5, choices=Periods.CHOICES)
+    date = models.DateField()
+
+    allocation = models.ForeignKey(Allocation, blank=True, null=True, related_name='+', on_delete=models.CASCADE)
+    project = models.ForeignKey(structure_models.Project, blank=True, null=True,
+                                related_name='+', on_delete=models.CASCADE)
+    customer = models.ForeignKey(structure_models.Customer, related_name='+', on_delete=models.CASCADE)
+
+    cpu_usage = models.BigIntegerField(default=0)
+    ram_usage = models.BigIntegerField(default=0)
+    gpu_usage = models.BigIntegerField(default=0)
+    deposit_usage = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    tres_usage = JSONField(default=dict, blank=True)
+
+
+class Job(models.Model):
+    """
+    Usage of single job within a month reported by cluster. Ledger of jobs is keyed by cluster,
+    job ID and month, so that the same job reported by polling, push ingestion or backfill
+    is accounted only once. Job running across the boundary of months has a row for each month
+    with the part of its usage within that month. End date is the last day of the job within
+    the month, it is empty while the job is running. Start time and number of minutes describe
+    when the job was running, they are used to spread its usage between days.
+    """
+    class Meta(object):
+        ordering = ['settings', 'job_id', 'year', 'month']
+        unique_together = ('settings', 'job_id', 'year', 'month')
+        indexes = [
+            models.Index(fields=['allocation', 'year', 'month'], name='slurm_job_allocation_month_idx'),
+        ]
+
+    settings = models.ForeignKey(structure_models.ServiceSettings, related_name='+', on_delete=models.CASCADE)
+    job_id = models.CharField(max_length=64)
+    allocation = models.ForeignKey(Allocation, blank=True, null=True, related_name='jobs', on_delete=models.SET_NULL)
+    account = models.CharField(max_length=255, blank=True)
+    username = models.CharField(max_length=32)
+    end = models.DateField(blank=True, null=True)
+    start = models.DateTimeField(blank=True, null=True)
+    minutes = models.PositiveIntegerField(default=0)
+    year = models.PositiveSmallIntegerField(default=0)
+    month = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    cpu_usage = models.BigIntegerField(default=0)
+    ram_usage = models.BigIntegerField(default=0)
+    gpu_usage = models.BigIntegerField(default=0)
+    deposit_usage = models.DecimalField(max_digits=10, decimal_places=4, default=0)
+    tres_usage = JSONField(default=dict, blank=True)
+
+
+class UsageBackfill(TimeStampedModel):
+    """
+    Progress of usage backfill for particular month of the cluster.
+    It allows to resume interrupted backfill without processing completed months again.
+    """
+    class States(object):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DONE = 'done'
+        ERRED = 'erred'
+
+        CHOICES = (
+            (PENDING, _('Pending')),
+            (RUNNING, _('Running')),
+            (DONE, _('Done')),
+            (ERRED, _('Erred')),
+        )
+
+    class Meta(object):
+        ordering = ['settings', 'year', 'month']
+        unique_together = ('settings', 'year', 'month')
+
+    settings = models.ForeignKey(structure_models.ServiceSettings, related_name='+', on_delete=models.CASCADE)
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField(validators=[MinValueValidator(1), MaxValueValidator(12)])
+    state = models.CharField(max_length=10, choices=States.CHOICES, default=States.PENDING)
+    error_message = models.TextField(blank=True)
+
+
+class UsageSyncCheckpoint(TimeStampedModel):
+    """
+    Progress of usage synchronization of the cluster. It is updated in the same transaction
+    as usage of each chunk of allocations, so that interrupted synchronization is resumed
+    after the last committed chunk instead of starting from scratch.
+    Zero ID of the last allocation means that the last synchronization has been completed.
+    """
+    settings = models.OneToOneField(structure_models.ServiceSettings, related_name='+', on_delete=models.CASCADE)
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField(validators=[MinValueValidator(1), MaxValueValidator(12)])
+    last_allocation_id = models.PositiveIntegerField(default=0)
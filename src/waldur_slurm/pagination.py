@@ -0,0 +1,57 @@
+from rest_framework import pagination, response
+from rest_framework.settings import api_settings
+
+
+class LinkHeaderCursorPagination(pagination.CursorPagination):
+    """
+    Keyset pagination which keeps response format compatible with the rest of API:
+    response body contains list of items and links to adjacent pages are rendered in Link header.
+    Unlike offset pagination, cost of fetching a page does not depend on its position.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = '-id'
+
+    def get_paginated_response(self, data):
+        links = [
+            '<%s>; rel="%s"' % (url, rel)
+            for url, rel in ((self.get_next_link(), 'next'), (self.get_previous_link(), 'prev'))
+            if url
+        ]
+        headers = {'Link': ', '.join(links)} if links else None
+        return response.Response(data, headers=headers)
+
+
+class OptionalCursorPagination(pagination.BasePagination):
+    """
+    Default pagination of API is used unless keyset pagination is requested with ?pagination=cursor,
+    so that existing clients still get page numbers and X-Result-Count header.
+    Links to adjacent pages of keyset pagination keep the query parameter.
+    """
+    query_param = 'pagination'
+    cursor_pagination_class = LinkHeaderCursorPagination
+
+    def __init__(self):
+        self.paginator = None
+
+    def is_cursor_requested(self, request):
+        return (request.query_params.get(self.query_param) == 'cursor' or
+                self.cursor_pagination_class.cursor_query_param in request.query_params)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.is_cursor_requested(request):
+            self.paginator = self.cursor_pagination_class()
+        else:
+            self.paginator = api_settings.DEFAULT_PAGINATION_CLASS()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    @property
+    def display_page_controls(self):
+        return bool(self.paginator and self.paginator.display_page_controls)
+
+    def to_html(self):
+        return self.paginator.to_html()
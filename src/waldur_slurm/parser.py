@@ -1,9 +1,9 @@
 import datetime
 import re
 
-from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
 
-from .base import BaseReportLine
+from .structures import UsageRecord
 
 SLURM_UNIT_PATTERN = re.compile('(\d+)([KMGTP]?)')
 
@@ -19,6 +19,8 @@ def parse_int(value):
     """
     Convert 5K to 5000.
     """
+    if not value:
+        return 0
     match = re.match(SLURM_UNIT_PATTERN, value)
     if not match:
         return 0
@@ -34,51 +36,74 @@ def parse_int(value):
 def parse_duration(value):
     """
     Returns duration in minutes as an integer number.
-    For example 00:01:00 is equal to 1
+    For example 00:01:00 is equal to 1, 1-00:00:00 is equal to 1440.
+    Elapsed time is reported by sacct as [DD-[HH:]]MM:SS.
     """
-    dt = datetime.datetime.strptime(value, '%H:%M:%S')
-    delta = datetime.timedelta(hours=dt.hour, minutes=dt.minute, seconds=dt.second)
-    return int(delta.total_seconds()) // 60
-
+    days, _, value = value.rpartition('-')
+    seconds = 0
+    for part in value.split(':'):
+        seconds = seconds * 60 + int(part)
+    if days:
+        seconds += int(days) * 24 * 60 * 60
+    return seconds // 60
 
-class SlurmReportLine(BaseReportLine):
-    def __init__(self, line):
-        self._parts = line.split('|')
 
-    @cached_property
-    def account(self):
-        return self._parts[0].strip()
+def parse_tres(value):
+    """
+    Convert "cpu=1,mem=100M,node=1" to dictionary.
+    """
+    return dict(pair.split('=', 1) for pair in value.split(',') if '=' in pair)
 
-    @cached_property
-    def user(self):
-        return self._parts[3]
 
-    @cached_property
-    def cpu(self):
-        return self.parse_field('cpu')
+def parse_time(value):
+    """
+    Return job time formatted as YYYY-MM-DDTHH:MM:SS or empty string if it is unknown.
+    """
+    return value[:19] if value[:1].isdigit() else ''
 
-    @cached_property
-    def gpu(self):
-        return self.parse_field('gres/gpu')
 
-    @cached_property
-    def ram(self):
-        return self.parse_field('mem')
+def get_start(end, duration):
+    """
+    Return start time of job which has ended at the given time after running for the given number of minutes.
+    """
+    end = parse_datetime(end) if end else None
+    if end is None:
+        return ''
+    return (end - datetime.timedelta(minutes=duration)).strftime('%Y-%m-%dT%H:%M:%S')
 
-    @cached_property
-    def node(self):
-        return self.parse_field('node')
 
-    @cached_property
-    def duration(self):
-        return parse_duration(self._parts[2])
+def parse_line(line, extra=()):
+    """
+    Convert line of sacct report with format Account,ReqTRES,Elapsed,User,JobID,End,Start into usage record.
+    """
+    return parse_fields(line.split('|'), extra)
 
-    @cached_property
-    def _resources(self):
-        pairs = self._parts[1].split(',')
-        return dict(pair.split('=') for pair in pairs)
 
-    def parse_field(self, field):
-        if field not in self._resources:
-            return 0
-        return parse_int(self._resources[field])
+def parse_fields(parts, extra=()):
+    """
+    Convert fields of sacct report line into usage record.
+    Requested TRES are multiplied by number of nodes and duration in minutes.
+    Extra TRES use the same factor as base resources, so that their usage is comparable.
+    """
+    tres = parse_tres(parts[1])
+    duration = parse_duration(parts[2])
+    factor = duration * parse_int(tres.get('node'))
+    values = [
+        parse_int(tres.get('cpu')) * factor,
+        parse_int(tres.get('gres/gpu')) * factor,
+        parse_int(tres.get('mem')) * factor,
+        0,
+    ]
+    for name in extra:
+        values.append(parse_int(tres.get(name)) * factor)
+    job_id = parts[4] if len(parts) > 4 else ''
+    end = parse_time(parts[5]) if len(parts) > 5 else ''
+    # Start is not reported by older agents, it is calculated from end of completed job
+    start = (parse_time(parts[6]) if len(parts) > 6 else '') or get_start(end, duration)
+    return UsageRecord(parts[0].strip(), parts[3], values, job_id, end[:10], start, duration)
+
+
+def parse_report(output, extra=()):
+    for line in output.splitlines():
+        if '|' in line:
+            yield parse_line(line, extra)
@@ -0,0 +1,120 @@
+"""
+Parser of JSON usage report produced by sacct --json and slurmrestd.
+Jobs are decoded one by one as the report is received,
+so that memory usage does not depend on the size of the report.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+from django.utils import timezone
+import six
+
+from .structures import UsageRecord
+from .utils import iter_json_array
+
+
+def get_number(value):
+    """
+    Newer data parser versions wrap numbers into {"set": true, "number": 10} objects.
+    """
+    if isinstance(value, dict):
+        return value.get('number', 0) if value.get('set', True) else 0
+    return value or 0
+
+
+def format_tres(name, count):
+    tres_type, _, tres_name = name.partition('/')
+    return {'type': tres_type, 'name': tres_name, 'count': count}
+
+
+def parse_tres(items):
+    """
+    Convert list of TRES objects to dictionary keyed by TRES name as it is reported by sacct,
+    for example {"type": "gres", "name": "gpu", "count": 2} is converted to {"gres/gpu": 2}.
+    """
+    result = {}
+    for item in items or []:
+        name = item['type']
+        if item.get('name'):
+            name = '%s/%s' % (name, item['name'])
+        result[name] = get_number(item.get('count'))
+    return result
+
+
+def get_local_time(timestamp):
+    """
+    Return datetime of UNIX timestamp in the project time zone,
+    so that it does not depend on time zone of the worker.
+    """
+    return timezone.localtime(datetime.datetime.fromtimestamp(timestamp, timezone.utc))
+
+
+def get_day(timestamp):
+    """
+    Return date of UNIX timestamp in the project time zone formatted as YYYY-MM-DD.
+    """
+    return get_local_time(timestamp).date().isoformat()
+
+
+def get_time(timestamp):
+    """
+    Return UNIX timestamp in the project time zone formatted as YYYY-MM-DDTHH:MM:SS like sacct does.
+    """
+    return get_local_time(timestamp).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def truncate_time(start, elapsed, end, window):
+    """
+    Keep only the part of job time within the window, like sacct --truncate does.
+    :param window: (start, end) pair of UNIX timestamps
+    :return: start timestamp, elapsed seconds and end timestamp within the window
+    """
+    window_start, window_end = window
+    job_start = start or end - elapsed
+    job_end = job_start + elapsed
+    start = max(job_start, window_start)
+    elapsed = max(min(job_end, window_end) - start, 0)
+    if end:
+        end = min(end, window_end)
+    return start, elapsed, end
+
+
+def parse_job(job, extra=(), window=None):
+    """
+    Convert job object into usage record.
+    Memory is reported in megabytes, it is converted to bytes like in sacct text report.
+    :param window: optional (start, end) pair of UNIX timestamps, usage outside of it is not counted
+    """
+    tres = parse_tres(job.get('tres', {}).get('requested'))
+    time = job.get('time', {})
+    elapsed = get_number(time.get('elapsed'))
+    start = get_number(time.get('start'))
+    end = get_number(time.get('end'))
+    if window:
+        start, elapsed, end = truncate_time(start, elapsed, end, window)
+    elif not start and end:
+        start = end - elapsed
+    duration = elapsed // 60
+    factor = duration * tres.get('node', 0)
+    values = [
+        tres.get('cpu', 0) * factor,
+        tres.get('gres/gpu', 0) * factor,
+        tres.get('mem', 0) * 2**20 * factor,
+        0,
+    ]
+    for name in extra:
+        values.append(tres.get(name, 0) * factor)
+    day = get_day(end) if end else ''
+    start = get_time(start) if start else ''
+    return UsageRecord(job['account'], job['user'], values, six.text_type(job['job_id']), day, start, duration)
+
+
+def parse_report(chunks, extra=(), window=None):
+    """
+    :param chunks: iterable of text chunks of JSON document with "jobs" array
+    :param window: optional (start, end) pair of UNIX timestamps, see parse_job
+    :return: iterator of UsageRecord
+    """
+    for job in iter_json_array(chunks, 'jobs'):
+        yield parse_job(job, extra, window)
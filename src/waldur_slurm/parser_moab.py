@@ -1,50 +1,55 @@
 from __future__ import division
 
 import decimal
-import math
 
-from django.utils.functional import cached_property
-
-from .base import BaseReportLine
-
-
-class MoabReportLine(BaseReportLine):
-    def __init__(self, line):
-        self._parts = line.split('|')
-
-    @cached_property
-    def account(self):
-        return self._parts[0].strip()
-
-    @cached_property
-    def user(self):
-        return self._parts[5]
-
-    @cached_property
-    def cpu(self):
-        return self.get_int(1)
-
-    @cached_property
-    def gpu(self):
-        return self.get_int(2)
-
-    @cached_property
-    def ram(self):
-        return self.get_int(3)
-
-    @cached_property
-    def duration(self):
-        # convert seconds to minutes
-        return int(math.ceil(self.get_int(4) / 60))
-
-    @cached_property
-    def charge(self):
-        return decimal.Decimal(self._parts[6])
-
-    @cached_property
-    def node(self):
-        return int(self._parts[7])
-
-    def get_int(self, index):
-        value = self._parts[index] or 0
-        return int(value)
+from .parser import get_start, parse_time
+from .structures import UsageRecord
+
+
+def get_int(value):
+    return int(value or 0)
+
+
+def parse_charge(value):
+    """
+    Convert charge to integer number of cents, for example 12.34 to 1234.
+    Charges with more than two decimal places are kept exact as Decimal number of cents.
+    """
+    value = value.strip()
+    sign = 1
+    if value[:1] in ('-', '+'):
+        sign = -1 if value[0] == '-' else 1
+        value = value[1:]
+    whole, _, fraction = value.partition('.')
+    if len(fraction) > 2 or not (whole or fraction).isdigit() or (fraction and not fraction.isdigit()):
+        return decimal.Decimal(value).scaleb(2) * sign
+    return sign * (int(whole or 0) * 100 + int(fraction.ljust(2, '0')))
+
+
+def parse_line(line, extra=()):
+    """
+    Convert line of mam-list-usagerecords report with format
+    Account,Processors,GPUs,Memory,Duration,User,Charge,Nodes,Id,EndTime into usage record.
+    MOAB does not report extra TRES, so that their usage is always zero.
+    Charge is reported in cents, see parse_charge.
+    """
+    parts = line.split('|')
+    # convert seconds to minutes rounding up
+    duration = -(-get_int(parts[4]) // 60)
+    factor = duration * int(parts[7])
+    values = [
+        get_int(parts[1]) * factor,
+        get_int(parts[2]) * factor,
+        get_int(parts[3]) * factor,
+        parse_charge(parts[6]),
+    ]
+    values.extend(0 for _ in extra)
+    job_id = parts[8] if len(parts) > 8 else ''
+    end = parse_time(parts[9]) if len(parts) > 9 else ''
+    return UsageRecord(parts[0].strip(), parts[5], values, job_id, end[:10], get_start(end, duration), duration)
+
+
+def parse_report(output, extra=()):
+    for line in output.splitlines():
+        if '|' in line:
+            yield parse_line(line, extra)
@@ -0,0 +1,193 @@
+from __future__ import unicode_literals
+
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import resource
+import time
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.utils import timezone
+import six
+
+from . import signals
+
+logger = logging.getLogger(__name__)
+
+PROFILES_KEY = 'waldur_slurm:sync_profiles:%s'
+DUMP_REQUEST_KEY = 'waldur_slurm:sync_profile_dump:%s'
+
+# Number of functions included into cProfile report
+CPROFILE_REPORT_LIMIT = 40
+
+
+class PhaseStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.duration = 0
+        self.remote_duration = 0
+        self.remote_commands = 0
+        self.max_rss_kb = 0
+
+    def add(self, other):
+        if other.rows is not None:
+            self.rows = (self.rows or 0) + other.rows
+        self.duration += other.duration
+        self.remote_duration += other.remote_duration
+        self.remote_commands += other.remote_commands
+        self.max_rss_kb = max(self.max_rss_kb, other.max_rss_kb)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'duration': self.duration,
+            'rows': self.rows,
+            'remote_duration': self.remote_duration,
+            'remote_commands': self.remote_commands,
+            'max_rss_kb': self.max_rss_kb,
+        }
+
+
+class NullProfiler(object):
+    """
+    Profiler used when profiling is disabled, it does not collect anything.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield PhaseStats(name)
+
+
+class SyncProfiler(object):
+    """
+    Collects duration, number of processed rows and memory high-water mark
+    for each phase of usage synchronization. Time spent on remote commands
+    is reported separately so that parsing cost can be told apart from network latency.
+    """
+
+    def __init__(self, service_settings, cluster, use_cprofile=False):
+        self.service_settings = service_settings
+        self.cluster = cluster
+        self.use_cprofile = use_cprofile
+        self.phases = []
+        self.current_phase = None
+        self.started = None
+        self.profile = None
+
+    def __enter__(self):
+        self.started = timezone.now()
+        self.start_time = time.time()
+        signals.batch_command_executed.connect(self.on_command_executed, weak=False)
+        if self.use_cprofile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        signals.batch_command_executed.disconnect(self.on_command_executed)
+        cprofile_report = None
+        if self.profile:
+            self.profile.disable()
+            cprofile_report = self.get_cprofile_report()
+
+        summary = {
+            'started': self.started.isoformat(),
+            'duration': time.time() - self.start_time,
+            'phases': [phase.as_dict() for phase in self.phases],
+            'max_rss_kb': get_max_rss(),
+            'error': exc_val and six.text_type(exc_val) or None,
+            'cprofile': cprofile_report,
+        }
+        save_sync_profile(self.service_settings, summary)
+        return False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stats = PhaseStats(name)
+        self.current_phase = stats
+        started = time.time()
+        try:
+            yield stats
+        finally:
+            stats.duration = time.time() - started
+            stats.max_rss_kb = get_max_rss()
+            self.current_phase = None
+            self.add_phase(stats)
+
+    def add_phase(self, stats):
+        """
+        Phase repeated for each chunk of allocations is reported once with summed up statistics.
+        """
+        for phase in self.phases:
+            if phase.name == stats.name:
+                phase.add(stats)
+                return
+        self.phases.append(stats)
+
+    def on_command_executed(self, sender, cluster, duration, **kwargs):
+        if self.current_phase and cluster == self.cluster:
+            self.current_phase.remote_duration += duration
+            self.current_phase.remote_commands += 1
+
+    def get_cprofile_report(self):
+        stream = six.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(CPROFILE_REPORT_LIMIT)
+
+        dump_dir = django_settings.WALDUR_SLURM.get('SYNC_PROFILE_DIR')
+        if dump_dir:
+            path = os.path.join(dump_dir, 'sync_%s_%s.prof' % (
+                self.service_settings.uuid.hex, self.started.strftime('%Y%m%d%H%M%S')))
+            try:
+                self.profile.dump_stats(path)
+            except (IOError, OSError):
+                logger.exception('Unable to dump sync profile to %s.', path)
+
+        return stream.getvalue()
+
+
+def get_max_rss():
+    """
+    Return memory high-water mark of the current process in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_sync_profiler(service_settings, cluster):
+    dump_requested = cache.get(DUMP_REQUEST_KEY % service_settings.uuid.hex)
+    if dump_requested:
+        cache.delete(DUMP_REQUEST_KEY % service_settings.uuid.hex)
+
+    enabled = django_settings.WALDUR_SLURM.get('SYNC_PROFILING_ENABLED', False)
+    if not enabled and not dump_requested:
+        return NullProfiler()
+    return SyncProfiler(service_settings, cluster, use_cprofile=bool(dump_requested))
+
+
+def request_profile_dump(service_settings):
+    """
+    Ask to run next synchronization of the given service settings under cProfile.
+    """
+    cache.set(DUMP_REQUEST_KEY % service_settings.uuid.hex, True, None)
+
+
+def save_sync_profile(service_settings, summary):
+    key = PROFILES_KEY % service_settings.uuid.hex
+    limit = django_settings.WALDUR_SLURM.get('SYNC_PROFILE_HISTORY', 10)
+    profiles = cache.get(key) or []
+    profiles = ([summary] + profiles)[:limit]
+    cache.set(key, profiles, None)
+
+
+def get_sync_profiles(service_settings):
+    return cache.get(PROFILES_KEY % service_settings.uuid.hex) or []
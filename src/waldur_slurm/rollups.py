@@ -0,0 +1,94 @@
+"""
+Usage rollups are pre-computed sums of daily usage per allocation, project and customer,
+so that usage charts are rendered from indexed reads instead of aggregation on request.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import transaction
+
+from . import models
+
+Levels = models.UsageRollup.Levels
+Periods = models.UsageRollup.Periods
+
+DAILY_USAGE_FIELDS = ('cpu_usage', 'gpu_usage', 'ram_usage', 'deposit_usage')
+
+
+def get_month_bounds(year, month):
+    start = datetime.date(year, month, 1)
+    if month == 12:
+        end = datetime.date(year + 1, 1, 1)
+    else:
+        end = datetime.date(year, month + 1, 1)
+    return start, end
+
+
+def update_usage_rollups(customer_ids, year, month):
+    """
+    Recalculate daily and monthly rollups of the given customers for the given month.
+    Rollups of all allocations of the customer are recalculated, because customer totals
+    include allocations of other clusters as well.
+    """
+    if not customer_ids:
+        return 0
+
+    start, end = get_month_bounds(year, month)
+    rows = models.AllocationDailyUsage.objects.filter(
+        allocation__service_project_link__project__customer_id__in=customer_ids,
+        date__gte=start,
+        date__lt=end,
+    ).values_list(
+        'allocation_id',
+        'allocation__service_project_link__project_id',
+        'allocation__service_project_link__project__customer_id',
+        'date',
+        'tres_usage',
+        *DAILY_USAGE_FIELDS
+    ).iterator()
+
+    totals = {}
+    for row in rows:
+        allocation_id, project_id, customer_id, date, tres_usage = row[:5]
+        values = row[5:]
+        scopes = (
+            (Levels.ALLOCATION, allocation_id, project_id, customer_id),
+            (Levels.PROJECT, None, project_id, customer_id),
+            (Levels.CUSTOMER, None, None, customer_id),
+        )
+        for scope in scopes:
+            for key in (scope + (Periods.DAY, date), scope + (Periods.MONTH, start)):
+                total = totals.get(key)
+                if total is None:
+                    total = totals[key] = [0] * len(values) + [{}]
+                for index, value in enumerate(values):
+                    total[index] += value
+                extra = total[-1]
+                for name, value in tres_usage.items():
+                    extra[name] = extra.get(name, 0) + value
+
+    rollups = []
+    for (level, allocation_id, project_id, customer_id, period, date), total in totals.items():
+        rollup = models.UsageRollup(
+            level=level,
+            period=period,
+            date=date,
+            allocation_id=allocation_id,
+            project_id=project_id,
+            customer_id=customer_id,
+            tres_usage=total[-1],
+        )
+        for field, value in zip(DAILY_USAGE_FIELDS, total):
+            setattr(rollup, field, value)
+        rollups.append(rollup)
+
+    with transaction.atomic():
+        models.UsageRollup.objects.filter(
+            customer_id__in=customer_ids,
+            date__gte=start,
+            date__lt=end,
+        ).delete()
+        models.UsageRollup.objects.bulk_create(rollups, batch_size=1000)
+
+    return len(rollups)
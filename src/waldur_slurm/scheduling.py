@@ -0,0 +1,120 @@
+"""
+Adaptive usage synchronization schedule. Velocity of CPU usage is tracked per allocation,
+so that active and nearly exhausted allocations are synchronized frequently
+and dormant ones rarely, but never less often than the maximum interval.
+"""
+from __future__ import division, unicode_literals
+
+import datetime
+
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import models
+
+# Weight of the latest observation in exponentially smoothed velocity
+VELOCITY_SMOOTHING = 0.5
+
+# Allocation which has consumed this share of any limit is synchronized with minimal interval
+NEAR_LIMIT_RATIO = 0.9
+
+LIMIT_FIELDS = (
+    ('cpu_usage', 'cpu_limit'),
+    ('gpu_usage', 'gpu_limit'),
+    ('ram_usage', 'ram_limit'),
+    ('deposit_usage', 'deposit_limit'),
+)
+
+
+def is_enabled():
+    return django_settings.WALDUR_SLURM.get('ADAPTIVE_SYNC_ENABLED', False)
+
+
+def get_interval_bounds():
+    options = django_settings.WALDUR_SLURM
+    return options.get('ADAPTIVE_SYNC_MIN_INTERVAL', 5 * 60), options.get('ADAPTIVE_SYNC_MAX_INTERVAL', 6 * 60 * 60)
+
+
+def get_usage_velocity(allocation, previous_usage, now):
+    """
+    Return smoothed CPU usage velocity in CPU minutes per hour.
+    :param previous_usage: CPU usage of allocation before synchronization
+    """
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    last_sync = allocation.last_usage_sync
+    if last_sync is None or last_sync < month_start:
+        # Usage is reset at the beginning of month
+        since, delta = month_start, allocation.cpu_usage
+    else:
+        since, delta = last_sync, allocation.cpu_usage - previous_usage
+
+    hours = (now - since).total_seconds() / 3600
+    if hours <= 0:
+        return allocation.usage_velocity
+
+    current = max(delta, 0) / hours
+    if last_sync is None:
+        return current
+    return VELOCITY_SMOOTHING * current + (1 - VELOCITY_SMOOTHING) * allocation.usage_velocity
+
+
+def get_usage_ratio(allocation):
+    """
+    Return the largest share of limit consumed by allocation, unlimited resources are skipped.
+    """
+    ratios = [
+        float(getattr(allocation, usage_field)) / float(getattr(allocation, limit_field))
+        for usage_field, limit_field in LIMIT_FIELDS
+        if getattr(allocation, limit_field) > 0
+    ]
+    return max(ratios) if ratios else 0
+
+
+def get_sync_interval(allocation):
+    """
+    Return number of seconds until the next usage synchronization of allocation.
+    Interval decreases as velocity grows and it is never longer than half of the time
+    remaining until CPU limit is exhausted.
+    """
+    min_interval, max_interval = get_interval_bounds()
+    velocity = allocation.usage_velocity
+
+    if velocity <= 0:
+        interval = max_interval
+    else:
+        reference = django_settings.WALDUR_SLURM.get('ADAPTIVE_SYNC_REFERENCE_VELOCITY', 60)
+        interval = max_interval * reference / (reference + velocity)
+        if allocation.cpu_limit > 0:
+            remaining_hours = max(allocation.cpu_limit - allocation.cpu_usage, 0) / velocity
+            interval = min(interval, remaining_hours * 3600 / 2)
+
+    if get_usage_ratio(allocation) >= NEAR_LIMIT_RATIO:
+        interval = min_interval
+
+    return int(min(max(interval, min_interval), max_interval))
+
+
+@transaction.atomic()
+def update_schedule(allocations, previous_usage, now):
+    """
+    Store velocity and time of the next synchronization of allocations.
+    :param previous_usage: dictionary mapping allocation ID to CPU usage before synchronization
+    """
+    for allocation in allocations:
+        allocation.usage_velocity = get_usage_velocity(allocation, previous_usage[allocation.pk], now)
+        allocation.last_usage_sync = now
+        allocation.next_usage_sync = now + datetime.timedelta(seconds=get_sync_interval(allocation))
+        models.Allocation.objects.filter(pk=allocation.pk).update(
+            usage_velocity=allocation.usage_velocity,
+            last_usage_sync=allocation.last_usage_sync,
+            next_usage_sync=allocation.next_usage_sync,
+        )
+
+
+def get_due_allocations(now):
+    """
+    Return allocations which should be synchronized, including ones which have never been synchronized.
+    """
+    return models.Allocation.objects.filter(
+        Q(next_usage_sync__isnull=True) | Q(next_usage_sync__lte=now))
@@ -1,4 +1,5 @@
 from django.core.validators import MinValueValidator
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import serializers as rf_serializers
 from rest_framework import exceptions as rf_exceptions
@@ -8,7 +9,16 @@ from waldur_core.structure import serializers as structure_serializers
 from waldur_core.structure.permissions import _has_owner_access
 from waldur_freeipa import models as freeipa_models
 
-from . import models
+from . import ingestion, models, utils
+from .structures import get_tres_schema
+
+
+def validate_tres_limits(tres_limits):
+    unknown = set(tres_limits) - set(get_tres_schema().extra)
+    if unknown:
+        raise rf_serializers.ValidationError(
+            _('These TRES are not supported: %s.') % ', '.join(sorted(unknown)))
+    return tres_limits
 
 
 class ServiceSerializer(core_serializers.ExtraFieldOptionsMixin,
@@ -16,6 +26,7 @@ class ServiceSerializer(core_serializers.ExtraFieldOptionsMixin,
                         structure_serializers.BaseServiceSerializer):
     SERVICE_ACCOUNT_FIELDS = {
         'username': '',
+        'token': _('JWT token of slurmrestd user'),
     }
     SERVICE_ACCOUNT_EXTRA_FIELDS = {
         'hostname': _('Hostname or IP address of master node'),
@@ -23,7 +34,13 @@ class ServiceSerializer(core_serializers.ExtraFieldOptionsMixin,
         'use_sudo': _('Set to true to activate privilege escalation'),
         'gateway': _('Hostname or IP address of gateway node'),
         'default_account': _('Default SLURM account for user'),
-        'batch_service': _('Batch service, SLURM or MOAB')
+        'batch_service': _('Batch service, SLURM or MOAB'),
+        'slurmrestd_url': _('URL of SLURM REST API daemon, if it is set, it is used instead of SSH'),
+        'verify_ssl': _('Set to false to skip verification of slurmrestd certificate'),
+        'sacct_json': _('Set to true or false to enable or disable JSON usage report, '
+                        'by default it is enabled if it is supported by SLURM'),
+        'max_concurrent_commands': _('Maximum number of commands executed on the cluster at once'),
+        'queue': _('Name of Celery queue for tasks of the cluster, clusters with the same queue share workers'),
     }
 
     class Meta(structure_serializers.BaseServiceSerializer.Meta):
@@ -71,6 +88,8 @@ class AllocationSerializer(structure_serializers.BaseResourceSerializer,
     batch_service = rf_serializers.ReadOnlyField()
     homepage = rf_serializers.ReadOnlyField(
         source='service_project_link.service.settings.homepage')
+    tres_limits = rf_serializers.DictField(
+        child=rf_serializers.IntegerField(min_value=0), required=False, validators=[validate_tres_limits])
 
     def get_username(self, allocation):
         request = self.context['request']
@@ -94,12 +113,14 @@ class AllocationSerializer(structure_serializers.BaseResourceSerializer,
             'gpu_limit', 'gpu_usage',
             'ram_limit', 'ram_usage',
             'deposit_limit', 'deposit_usage',
+            'tres_limits', 'tres_usage',
+            'last_usage_sync',
             'username', 'gateway',
             'is_active', 'batch_service', 'homepage'
         )
         read_only_fields = structure_serializers.BaseResourceSerializer.Meta.read_only_fields + (
             'cpu_usage', 'gpu_usage', 'ram_usage', 'is_active',
-            'deposit_limit', 'deposit_usage',
+            'deposit_limit', 'deposit_usage', 'tres_usage', 'last_usage_sync',
         )
         extra_kwargs = dict(
             url={'lookup_field': 'uuid', 'view_name': 'slurm-allocation-detail'},
@@ -130,7 +151,7 @@ class AllocationUsageSerializer(rf_serializers.HyperlinkedModelSerializer):
         model = models.AllocationUsage
         fields = ('allocation', 'year', 'month',
                   'username', 'user', 'full_name',
-                  'cpu_usage', 'ram_usage', 'gpu_usage', 'deposit_usage')
+                  'cpu_usage', 'ram_usage', 'gpu_usage', 'deposit_usage', 'tres_usage')
         extra_kwargs = {
             'allocation': {
                 'lookup_field': 'uuid',
@@ -141,3 +162,119 @@ class AllocationUsageSerializer(rf_serializers.HyperlinkedModelSerializer):
                 'view_name': 'user-detail',
             }
         }
+
+
+class UsageRollupSerializer(rf_serializers.HyperlinkedModelSerializer):
+    allocation_uuid = rf_serializers.ReadOnlyField(source='allocation.uuid')
+    project_uuid = rf_serializers.ReadOnlyField(source='project.uuid')
+    customer_uuid = rf_serializers.ReadOnlyField(source='customer.uuid')
+
+    class Meta(object):
+        model = models.UsageRollup
+        fields = ('level', 'period', 'date',
+                  'allocation', 'allocation_uuid',
+                  'project', 'project_uuid',
+                  'customer', 'customer_uuid',
+                  'cpu_usage', 'ram_usage', 'gpu_usage', 'deposit_usage', 'tres_usage')
+        extra_kwargs = {
+            'allocation': {'lookup_field': 'uuid', 'view_name': 'slurm-allocation-detail'},
+            'project': {'lookup_field': 'uuid', 'view_name': 'project-detail'},
+            'customer': {'lookup_field': 'uuid', 'view_name': 'customer-detail'},
+        }
+
+
+class AllocationLimitsSerializer(rf_serializers.Serializer):
+    allocation = rf_serializers.HyperlinkedRelatedField(
+        view_name='slurm-allocation-detail',
+        lookup_field='uuid',
+        queryset=models.Allocation.objects.all(),
+    )
+    # -1 means that resource is not limited, like default value of allocation limits
+    cpu_limit = rf_serializers.IntegerField(min_value=-1, required=False)
+    gpu_limit = rf_serializers.IntegerField(min_value=-1, required=False)
+    ram_limit = rf_serializers.IntegerField(min_value=-1, required=False)
+    deposit_limit = rf_serializers.DecimalField(max_digits=6, decimal_places=0, min_value=-1, required=False)
+    tres_limits = rf_serializers.DictField(
+        child=rf_serializers.IntegerField(min_value=0), required=False, validators=[validate_tres_limits])
+
+    def validate_allocation(self, allocation):
+        if allocation.state != models.Allocation.States.OK:
+            raise rf_serializers.ValidationError(_('Allocation should be in OK state.'))
+        return allocation
+
+
+class AllocationLimitsBulkSerializer(rf_serializers.Serializer):
+    limits = AllocationLimitsSerializer(many=True)
+
+    def validate_limits(self, limits):
+        if not limits:
+            raise rf_serializers.ValidationError(_('At least one allocation should be specified.'))
+
+        allocations = [item['allocation'] for item in limits]
+        if len(set(allocations)) != len(allocations):
+            raise rf_serializers.ValidationError(_('Each allocation should be specified only once.'))
+        return limits
+
+
+class UsageBackfillSerializer(rf_serializers.ModelSerializer):
+    class Meta(object):
+        model = models.UsageBackfill
+        fields = ('year', 'month', 'state', 'error_message', 'created', 'modified')
+
+
+class UsageBackfillRequestSerializer(rf_serializers.Serializer):
+    start = rf_serializers.CharField(help_text=_('First month formatted as YYYY-MM.'))
+    end = rf_serializers.CharField(help_text=_('Last month formatted as YYYY-MM.'))
+    windows = rf_serializers.IntegerField(
+        min_value=1, max_value=31, default=1,
+        help_text=_('Number of time windows each month is split into. Windows are fetched in parallel.'))
+    force = rf_serializers.BooleanField(
+        default=False, help_text=_('Process months which are already backfilled.'))
+
+    def _parse_month(self, value):
+        try:
+            return utils.parse_month(value)
+        except ValueError:
+            raise rf_serializers.ValidationError(_('Month should be formatted as YYYY-MM.'))
+
+    def validate_start(self, value):
+        return self._parse_month(value)
+
+    def validate_end(self, value):
+        return self._parse_month(value)
+
+    def validate(self, attrs):
+        today = timezone.now()
+        if attrs['start'] > attrs['end']:
+            raise rf_serializers.ValidationError(_('Start month should not be later than end month.'))
+        if attrs['end'] > (today.year, today.month):
+            raise rf_serializers.ValidationError(_('Future months can not be backfilled.'))
+        attrs['months'] = utils.get_month_range(attrs['start'], attrs['end'])
+        return attrs
+
+
+class JobsIngestSerializer(rf_serializers.Serializer):
+    # Maximum number of jobs accepted in a single batch
+    BATCH_LIMIT = 10000
+
+    jobs = rf_serializers.ListField(
+        child=rf_serializers.ListField(child=rf_serializers.CharField(allow_blank=True)),
+        help_text=_('List of completed jobs, each job is a list of fields: %s.') % ', '.join(ingestion.JOB_FIELDS),
+    )
+
+    def validate_jobs(self, jobs):
+        if not jobs:
+            raise rf_serializers.ValidationError(_('At least one job should be specified.'))
+        if len(jobs) > self.BATCH_LIMIT:
+            raise rf_serializers.ValidationError(
+                _('Batch should not contain more than %s jobs.') % self.BATCH_LIMIT)
+
+        for index, job in enumerate(jobs):
+            if len(job) not in (len(ingestion.JOB_FIELDS) - 1, len(ingestion.JOB_FIELDS)) or not job[4]:
+                raise rf_serializers.ValidationError(_('Job %s should contain fields %s.') % (
+                    index, ', '.join(ingestion.JOB_FIELDS)))
+            try:
+                ingestion.parse_jobs([job])
+            except (ValueError, KeyError):
+                raise rf_serializers.ValidationError(_('Job %s can not be parsed.') % index)
+        return jobs
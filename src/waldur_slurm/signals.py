@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# Sent after each command is executed on the batch cluster head node
+batch_command_executed = Signal(providing_args=[
+    'cluster', 'kind', 'duration', 'exit_status', 'output_bytes', 'output_lines'])
+
+# Sent after command has waited for free slot of cluster-wide concurrency limit
+batch_command_queued = Signal(providing_args=['cluster', 'kind', 'wait'])
@@ -1,20 +1,108 @@
 import collections
 
+from django.conf import settings as django_settings
+
 Account = collections.namedtuple('Account', ['name', 'description', 'organization'])
 Association = collections.namedtuple('Association', ['account', 'user', 'value'])
 
+# Usage of single job, values are laid out according to TRES schema.
+# Day is the date of job end formatted as YYYY-MM-DD or empty string if job is still running.
+# Start is the local time when job has started formatted as YYYY-MM-DDTHH:MM:SS or empty string
+# if it is not known, job has been running for the given number of minutes since then.
+UsageRecord = collections.namedtuple('UsageRecord', ['account', 'user', 'values', 'job_id', 'day', 'start', 'minutes'])
+
+# Resources tracked for every allocation, they are stored in dedicated model fields
+BASE_TRES = ('cpu', 'gpu', 'ram', 'deposit')
+
+# SLURM TRES names of base resources
+BASE_TRES_NAMES = ('cpu', 'gres/gpu', 'mem')
+
+
+class TresSchema(object):
+    """
+    Layout of quotas vector: base resources followed by extra TRES configured
+    in WALDUR_SLURM['EXTRA_TRES'], for example ('billing', 'gres/gpu:tesla').
+    """
+    __slots__ = ('extra', 'names', 'index', 'size')
+
+    def __init__(self, extra=()):
+        self.extra = tuple(extra)
+        self.names = BASE_TRES + self.extra
+        self.index = {name: index for index, name in enumerate(self.names)}
+        self.size = len(self.names)
+
+
+_schemas = {}
+
+
+def get_tres_schema():
+    extra = tuple(django_settings.WALDUR_SLURM.get('EXTRA_TRES', ()))
+    schema = _schemas.get(extra)
+    if schema is None:
+        schema = _schemas[extra] = TresSchema(extra)
+    return schema
+
+
+def _vector_item(index):
+    def getter(self):
+        return self.values[index]
+
+    def setter(self, value):
+        self.values[index] = value
+
+    return property(getter, setter)
+
 
 class Quotas(object):
-    def __init__(self, cpu=0, gpu=0, ram=0, deposit=0):
-        self.cpu = cpu
-        self.gpu = gpu
-        self.ram = ram
-        self.deposit = deposit
+    """
+    Fixed-layout vector of resource amounts. It supports in-place accumulation
+    so that aggregation of usage report does not allocate new objects.
+    """
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, cpu=0, gpu=0, ram=0, deposit=0, extra=None, schema=None):
+        self.schema = schema or get_tres_schema()
+        self.values = [cpu, gpu, ram, deposit] + [0] * len(self.schema.extra)
+        if extra:
+            for name, value in extra.items():
+                if name in self.schema.index:
+                    self.values[self.schema.index[name]] = value
+
+    @classmethod
+    def from_values(cls, values, schema=None):
+        quotas = cls.__new__(cls)
+        quotas.schema = schema or get_tres_schema()
+        quotas.values = list(values)
+        return quotas
+
+    cpu = _vector_item(0)
+    gpu = _vector_item(1)
+    ram = _vector_item(2)
+    deposit = _vector_item(3)
+
+    @property
+    def extra(self):
+        return dict(zip(self.schema.extra, self.values[len(BASE_TRES):]))
+
+    def add_values(self, values):
+        own = self.values
+        for index, value in enumerate(values):
+            own[index] += value
+
+    def __iadd__(self, other):
+        self.add_values(other.values)
+        return self
 
     def __add__(self, other):
-        return Quotas(
-            self.cpu + other.cpu,
-            self.gpu + other.gpu,
-            self.ram + other.ram,
-            self.deposit + other.deposit,
-        )
+        result = Quotas.from_values(self.values, self.schema)
+        result.add_values(other.values)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, Quotas) and self.values == other.values
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Quotas(%s)' % ', '.join('%s=%s' % pair for pair in zip(self.schema.names, self.values))
@@ -1,9 +1,16 @@
+import collections
 import itertools
+import logging
+
 from celery import shared_task
+from django.utils import timezone
+import six
 
 from waldur_core.core import utils as core_utils
 from waldur_core.structure import models as structure_models
-from . import models
+from . import models, scheduling, utils
+
+logger = logging.getLogger(__name__)
 
 
 def get_user_allocations(user):
@@ -27,18 +34,42 @@ def get_structure_allocations(structure):
         return []
 
 
+def send_to_cluster(task, service_settings, args, inline=False):
+    """
+    Send task to queue of the cluster if queue routing is enabled, so that backlog of slow cluster
+    does not delay operations of other clusters. Otherwise task is sent to default queue
+    or it is executed by the current worker if inline is True.
+    """
+    queue = utils.get_queue_name(service_settings)
+    if queue:
+        return task.apply_async(args=args, queue=queue)
+    if inline:
+        return task(*args)
+    return task.delay(*args)
+
+
+def send_to_clusters(task, allocations, *args):
+    """
+    Run task for allocations of each cluster, UUIDs of allocations are passed as the first argument.
+    """
+    groups = collections.defaultdict(list)
+    for allocation in allocations:
+        groups[allocation.service_project_link.service.settings].append(allocation.uuid.hex)
+
+    for service_settings, allocation_uuids in groups.items():
+        send_to_cluster(task, service_settings, (allocation_uuids,) + args, inline=True)
+
+
 @shared_task(name='waldur_slurm.add_user')
 def add_user(serialized_profile):
     profile = core_utils.deserialize_instance(serialized_profile)
-    for allocation in get_user_allocations(profile.user):
-        allocation.get_backend().add_user(allocation, profile.username)
+    send_to_clusters(add_allocations_user, get_user_allocations(profile.user), profile.username)
 
 
 @shared_task(name='waldur_slurm.delete_user')
 def delete_user(serialized_profile):
     profile = core_utils.deserialize_instance(serialized_profile)
-    for allocation in get_user_allocations(profile.user):
-        allocation.get_backend().delete_user(allocation, profile.username)
+    send_to_clusters(delete_allocations_user, get_user_allocations(profile.user), profile.username)
 
 
 @shared_task(name='waldur_slurm.process_role_granted')
@@ -47,9 +78,7 @@ def process_role_granted(serialized_profile, serialized_structure):
     structure = core_utils.deserialize_instance(serialized_structure)
 
     allocations = get_structure_allocations(structure)
-
-    for allocation in allocations:
-        allocation.get_backend().add_user(allocation, profile.username)
+    send_to_clusters(add_allocations_user, allocations, profile.username)
 
 
 @shared_task(name='waldur_slurm.process_role_revoked')
@@ -58,6 +87,120 @@ def process_role_revoked(serialized_profile, serialized_structure):
     structure = core_utils.deserialize_instance(serialized_structure)
 
     allocations = get_structure_allocations(structure)
+    send_to_clusters(delete_allocations_user, allocations, profile.username)
+
+
+@shared_task(name='waldur_slurm.add_allocations_user')
+def add_allocations_user(allocation_uuids, username):
+    for allocation in models.Allocation.objects.filter(uuid__in=allocation_uuids):
+        allocation.get_backend().add_user(allocation, username)
+
+
+@shared_task(name='waldur_slurm.delete_allocations_user')
+def delete_allocations_user(allocation_uuids, username):
+    for allocation in models.Allocation.objects.filter(uuid__in=allocation_uuids):
+        allocation.get_backend().delete_user(allocation, username)
+
+
+@shared_task(name='waldur_slurm.set_resource_limits_bulk')
+def set_resource_limits_bulk(allocation_uuids):
+    """
+    Apply limits of allocations belonging to the same service settings.
+    Result for each allocation is reported via its state and error message.
+    """
+    allocations = list(models.Allocation.objects.filter(
+        uuid__in=allocation_uuids,
+        state=models.Allocation.States.UPDATE_SCHEDULED,
+    ))
+    if not allocations:
+        return
+
+    for allocation in allocations:
+        allocation.begin_updating()
+        allocation.save(update_fields=['state'])
+
+    backend = allocations[0].get_backend()
+    try:
+        results = backend.set_resource_limits_bulk(allocations)
+    except Exception as e:
+        for allocation in allocations:
+            _save_limits_result(allocation, six.text_type(e))
+        raise
 
     for allocation in allocations:
-        allocation.get_backend().delete_user(allocation, profile.username)
+        _save_limits_result(allocation, results.get(allocation))
+
+
+def _save_limits_result(allocation, error_message):
+    if error_message:
+        allocation.set_erred()
+        allocation.error_message = error_message
+    else:
+        allocation.set_ok()
+        allocation.error_message = ''
+    allocation.save(update_fields=['state', 'error_message'])
+
+
+@shared_task(name='waldur_slurm.backfill_usage')
+def backfill_usage(settings_uuid, months, windows=1, force=False):
+    """
+    Recalculate usage of past months of the cluster. Progress is stored per month,
+    so that restarted backfill skips months which are already done unless force is used.
+    :param months: list of (year, month) pairs
+    :param windows: number of time windows each month is split into
+    """
+    service_settings = structure_models.ServiceSettings.objects.get(uuid=settings_uuid)
+    backend = service_settings.get_backend()
+    States = models.UsageBackfill.States
+
+    for year, month in months:
+        backfill, _ = models.UsageBackfill.objects.get_or_create(
+            settings=service_settings, year=year, month=month)
+        if backfill.state == States.DONE and not force:
+            continue
+
+        backfill.state = States.RUNNING
+        backfill.error_message = ''
+        backfill.save(update_fields=['state', 'error_message', 'modified'])
+        try:
+            backend.backfill_usage(year, month, windows)
+        except Exception as e:
+            logger.exception('Unable to backfill usage of %s for %s-%02d.', service_settings, year, month)
+            backfill.state = States.ERRED
+            backfill.error_message = six.text_type(e)
+        else:
+            backfill.state = States.DONE
+        backfill.save(update_fields=['state', 'error_message', 'modified'])
+
+
+@shared_task(name='waldur_slurm.sync_due_usage')
+def sync_due_usage():
+    """
+    Synchronize usage of allocations which are due according to adaptive schedule.
+    Separate task is sent for each cluster even if queue routing is disabled,
+    so that clusters are synchronized in parallel by workers instead of one after another.
+    """
+    if not scheduling.is_enabled():
+        return
+
+    due_allocations = scheduling.get_due_allocations(timezone.now())
+    settings_ids = due_allocations.values_list('service_project_link__service__settings_id', flat=True).distinct()
+    for service_settings in structure_models.ServiceSettings.objects.filter(id__in=settings_ids):
+        allocations = due_allocations.filter(service_project_link__service__settings=service_settings)
+        allocation_uuids = [uuid.hex for uuid in allocations.values_list('uuid', flat=True)]
+        send_to_cluster(sync_usage, service_settings, (service_settings.uuid.hex, allocation_uuids))
+
+
+@shared_task(name='waldur_slurm.sync_usage')
+def sync_usage(settings_uuid, allocation_uuids=None):
+    """
+    Synchronize usage of the given allocations of the cluster or all of them if allocations are not specified.
+    """
+    service_settings = structure_models.ServiceSettings.objects.get(uuid=settings_uuid)
+    allocations = None
+    if allocation_uuids is not None:
+        allocations = list(models.Allocation.objects.filter(uuid__in=allocation_uuids))
+    try:
+        service_settings.get_backend().sync_usage(allocations)
+    except Exception:
+        logger.exception('Unable to synchronize usage of allocations of %s.', service_settings)
@@ -0,0 +1,226 @@
+"""
+End-to-end benchmarks of usage synchronization and account management
+against in-process fake cluster. All database changes are rolled back
+when benchmark is finished. Benchmarks depend on test factories, so that
+they are run in development environment, for example from Django shell:
+
+    from waldur_slurm.tests.benchmarks import SyncBenchmark, format_results
+    print(format_results(SyncBenchmark(allocations=1000, jobs=100000).run()))
+"""
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import datetime
+import random
+import time
+
+from django.conf import settings as django_settings
+from django.db import transaction
+
+from waldur_core.core import utils as core_utils
+from waldur_core.structure import models as structure_models
+from waldur_core.structure.tests import factories as structure_factories
+from waldur_freeipa import models as freeipa_models
+
+from .. import models, signals, tasks, transport
+from . import factories
+from .fake_cluster import FakeCluster
+
+HOSTNAME = 'benchmark.cluster'
+
+TRES_POOL = (
+    'cpu=1,mem=4096M,node=1',
+    'cpu=4,mem=16384M,node=1',
+    'cpu=16,mem=65536M,node=1',
+    'cpu=32,mem=131072M,node=2,gres/gpu=2',
+    'cpu=64,mem=262144M,node=4,gres/gpu=8,gres/gpu:tesla=8',
+)
+
+BenchmarkResult = collections.namedtuple('BenchmarkResult', ['name', 'duration', 'operations', 'commands'])
+
+
+class SyncBenchmark(object):
+    """
+    :param allocations: number of allocations managed by Waldur
+    :param users: number of users having FreeIPA profile and association with each allocation
+    :param jobs: number of jobs reported by sacct for the current month
+    :param latency: delay in seconds applied to each command by fake cluster
+    """
+
+    def __init__(self, allocations=10000, users=50, jobs=1000000, latency=0, burst=100, seed=0):
+        self.allocations_count = allocations
+        self.users_count = users
+        self.jobs_count = jobs
+        self.latency = latency
+        self.burst = burst
+        self.random = random.Random(seed)
+        self.cluster = FakeCluster(HOSTNAME)
+        self.results = []
+
+    def run(self):
+        transport.register_transport(HOSTNAME, self.cluster)
+        try:
+            with transaction.atomic():
+                self.setup()
+                # Latency is not applied while fake cluster is populated
+                self.cluster.latency = self.latency
+                self.benchmark_sync_usage()
+                self.benchmark_create_allocation_burst()
+                self.benchmark_role_granted_fan_out()
+                transaction.set_rollback(True)
+        finally:
+            transport.unregister_transport(HOSTNAME)
+        return self.results
+
+    def setup(self):
+        self.settings = structure_factories.ServiceSettingsFactory(
+            type='SLURM', options={'hostname': HOSTNAME, 'batch_service': 'SLURM'})
+        self.customer = structure_factories.CustomerFactory()
+        self.project = structure_factories.ProjectFactory(customer=self.customer)
+        service = factories.SlurmServiceFactory(settings=self.settings, customer=self.customer)
+        self.spl = factories.SlurmServiceProjectLinkFactory(service=service, project=self.project)
+
+        models.Allocation.objects.bulk_create([
+            models.Allocation(
+                name='allocation%s' % index,
+                service_project_link=self.spl,
+                state=models.Allocation.States.OK,
+            )
+            for index in range(self.allocations_count)
+        ], batch_size=1000)
+        self.allocations = list(models.Allocation.objects.filter(service_project_link=self.spl))
+
+        self.usernames = ['user%s' % index for index in range(self.users_count)]
+        for username in self.usernames:
+            user = structure_factories.UserFactory()
+            freeipa_models.Profile.objects.create(user=user, username=username)
+
+        backend = self.settings.get_backend()
+        self.accounts = [backend.get_allocation_name(allocation) for allocation in self.allocations]
+        for account in self.accounts:
+            self.cluster.add_account(account)
+            for username in self.usernames:
+                self.cluster.add_association(username, account)
+
+        now = datetime.datetime.now()
+        for job_id in range(self.jobs_count):
+            self.cluster.add_job(
+                job_id=job_id,
+                account=self.random.choice(self.accounts),
+                user=self.random.choice(self.usernames),
+                req_tres=self.random.choice(TRES_POOL),
+                elapsed=self.random.randint(60, 23 * 60 * 60),
+                start=now,
+                end=now,
+            )
+
+    def measure(self, name, operations):
+        return measure(self.results, name, operations)
+
+    def benchmark_sync_usage(self):
+        backend = self.settings.get_backend()
+        with self.measure('sync_usage', self.jobs_count):
+            backend.sync_usage()
+
+    def benchmark_create_allocation_burst(self):
+        backend = self.settings.get_backend()
+        allocations = [
+            factories.AllocationFactory(service_project_link=self.spl)
+            for _ in range(self.burst)
+        ]
+        with self.measure('create_allocation', len(allocations)):
+            for allocation in allocations:
+                backend.create_allocation(allocation)
+
+    def benchmark_role_granted_fan_out(self):
+        user = structure_factories.UserFactory()
+        profile = freeipa_models.Profile.objects.create(user=user, username='benchmark_user')
+        self.customer.add_user(user, structure_models.CustomerRole.OWNER)
+        allocations = models.Allocation.objects.filter(service_project_link__project__customer=self.customer)
+
+        with self.measure('role_granted', allocations.count()):
+            tasks.process_role_granted(
+                core_utils.serialize_instance(profile),
+                core_utils.serialize_instance(self.customer),
+            )
+
+
+class ReplaySyncBenchmark(object):
+    """
+    Benchmark usage synchronization against command trace recorded on production cluster.
+    Allocations are created for accounts found in the trace, so that the whole report is processed.
+    """
+
+    def __init__(self, trace_path, realtime=False):
+        self.trace_path = trace_path
+        self.realtime = realtime
+        self.results = []
+
+    def run(self):
+        replay = transport.ReplayTransport(self.trace_path, realtime=self.realtime)
+        transport.register_transport(HOSTNAME, replay)
+        try:
+            with transaction.atomic():
+                self.setup()
+                with measure(self.results, 'replayed_sync_usage', len(self.allocation_uuids)):
+                    self.settings.get_backend().sync_usage()
+                transaction.set_rollback(True)
+        finally:
+            transport.unregister_transport(HOSTNAME)
+        return self.results
+
+    def setup(self):
+        prefix = django_settings.WALDUR_SLURM['ALLOCATION_PREFIX']
+        accounts = set()
+        batch_service = 'SLURM'
+        for record in transport.read_trace(self.trace_path):
+            command = record['command']
+            if command[0].startswith('mam-'):
+                batch_service = 'MOAB'
+            for index, part in enumerate(command):
+                if part.startswith('--accounts='):
+                    accounts.update(part[len('--accounts='):].split(','))
+                elif part == '-a' and index + 1 < len(command):
+                    accounts.add(command[index + 1])
+        self.allocation_uuids = [account[len(prefix):] for account in accounts if account.startswith(prefix)]
+
+        self.settings = structure_factories.ServiceSettingsFactory(
+            type='SLURM', options={'hostname': HOSTNAME, 'batch_service': batch_service})
+        service = factories.SlurmServiceFactory(settings=self.settings)
+        spl = factories.SlurmServiceProjectLinkFactory(service=service)
+        models.Allocation.objects.bulk_create([
+            models.Allocation(
+                uuid=allocation_uuid,
+                name='allocation%s' % index,
+                service_project_link=spl,
+                state=models.Allocation.States.OK,
+            )
+            for index, allocation_uuid in enumerate(self.allocation_uuids)
+        ], batch_size=1000)
+
+
+@contextlib.contextmanager
+def measure(results, name, operations):
+    commands = []
+
+    def on_command_executed(sender, **kwargs):
+        commands.append(kwargs['kind'])
+
+    signals.batch_command_executed.connect(on_command_executed, weak=False)
+    started = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - started
+        signals.batch_command_executed.disconnect(on_command_executed)
+    results.append(BenchmarkResult(name, duration, operations, len(commands)))
+
+
+def format_results(results):
+    lines = ['%-20s %12s %12s %12s %14s' % ('benchmark', 'seconds', 'operations', 'commands', 'ops/second')]
+    for result in results:
+        rate = result.operations / result.duration if result.duration else 0
+        lines.append('%-20s %12.3f %12d %12d %14.1f' % (
+            result.name, result.duration, result.operations, result.commands, rate))
+    return '\n'.join(lines)
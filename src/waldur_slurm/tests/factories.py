@@ -87,7 +87,7 @@ class AllocationUsageFactory(factory.DjangoModelFactory):
         if allocation_usage is None:
             allocation_usage = AllocationUsageFactory()
         return 'http://testserver' + reverse('slurm-allocation-usage-detail', kwargs={
-            'uuid': allocation_usage.uuid.hex
+            'pk': allocation_usage.pk
         })
 
     @classmethod
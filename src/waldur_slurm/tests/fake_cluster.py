@@ -0,0 +1,381 @@
+"""
+In-process fake of SLURM and MOAB accounting commands.
+It implements the subset of sacctmgr, sacct and mam-* commands used by batch clients
+against in-memory state, so that client and backend can be exercised without SSH.
+"""
+from __future__ import unicode_literals
+
+import calendar
+import collections
+import datetime
+import json
+import re
+import shlex
+import threading
+import time
+
+from django.utils import timezone
+import six
+
+from ..base import CommandError
+
+Job = collections.namedtuple('Job', ['job_id', 'account', 'user', 'req_tres', 'elapsed', 'start', 'end', 'charge'])
+
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date %s' % value)
+
+
+def get_timestamp(value):
+    """
+    Convert naive datetime in the project time zone to UNIX timestamp.
+    """
+    return calendar.timegm(timezone.make_aware(value).utctimetuple())
+
+
+def format_elapsed(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%02d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def parse_tres(value):
+    """
+    Parse "cpu=2,mem=100M,node=1" into dictionary.
+    """
+    if not value:
+        return {}
+    return dict(pair.split('=', 1) for pair in value.split(','))
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class FakeAccount(object):
+    def __init__(self, name, description='', organization='', parent=None):
+        self.name = name
+        self.description = description
+        self.organization = organization
+        self.parent = parent
+        self.limits = ''
+        self.deposit = 0
+
+
+class FakeCluster(object):
+    """
+    Fake cluster accounting database. It can be used as a transport of batch client.
+    :param latency: delay in seconds applied to every command to emulate network round trip.
+    """
+
+    def __init__(self, name='fake', latency=0, version='20.11.9'):
+        self.name = name
+        self.latency = latency
+        self.version = version
+        self.accounts = collections.OrderedDict()
+        self.associations = collections.OrderedDict()
+        self.jobs = []
+        self.executed_commands = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add_account(self, name, description='', organization='', parent=None):
+        self.accounts[name] = FakeAccount(name, description, organization, parent)
+
+    def add_association(self, user, account, default_account=''):
+        self.associations[(user, account)] = default_account
+
+    def add_job(self, job_id, account, user, req_tres, elapsed, start=None, end=None, charge='0.00'):
+        """
+        :param elapsed: job duration in seconds
+        :param start: job start time, current time is used by default
+        :param end: job end time, None means that job is still running
+        """
+        start = start or datetime.datetime.now()
+        self.jobs.append(Job(job_id, account, user, req_tres, elapsed, start, end, charge))
+
+    def execute(self, command):
+        if self.latency:
+            time.sleep(self.latency)
+
+        tokens = shlex.split(' '.join(command))
+        name = tokens[0]
+        self.executed_commands[name] += 1
+
+        with self.lock:
+            if name == 'sacctmgr':
+                return self.sacctmgr(tokens[1:])
+            elif name == 'sacct':
+                return self.sacct(tokens[1:])
+            elif name.startswith('mam-'):
+                handler = getattr(self, name.replace('-', '_'), None)
+                if handler:
+                    return handler(tokens[1:])
+        raise CommandError('Unknown command: %s' % ' '.join(command))
+
+    # SLURM
+
+    def sacctmgr(self, args):
+        args = [arg for arg in args if not arg.startswith('--')]
+        verb, entity, params = args[0], args[1], args[2:]
+        conditions = self.parse_conditions(params)
+
+        if verb in ('list', 'show') and entity == 'account':
+            names = params[:1] or list(self.accounts.keys())
+            return self.render(self.format_account(self.accounts[name]) for name in names if name in self.accounts)
+
+        if verb in ('list', 'show') and entity == 'association':
+            return self.render(
+                self.format_association(user, account)
+                for user, account in self.get_associations(conditions)
+            )
+
+        if verb == 'add' and entity == 'account':
+            name = params[0]
+            if name in self.accounts:
+                raise CommandError(' Nothing new added.')
+            self.add_account(name, conditions.get('description', ''),
+                             conditions.get('organization', ''), conditions.get('parent'))
+            return ' Adding Account(s)\n  %s\n' % name
+
+        if verb == 'add' and entity == 'user':
+            account = conditions['account']
+            if account not in self.accounts:
+                raise CommandError(' Account %s does not exist' % account)
+            self.add_association(params[0], account, conditions.get('defaultaccount', ''))
+            return ' Associations =\n  U = %s A = %s\n' % (params[0], account)
+
+        if verb == 'remove' and entity == 'account':
+            for name in conditions['name'].split(','):
+                self.accounts.pop(name, None)
+                for user, account in list(self.associations.keys()):
+                    if account == name:
+                        del self.associations[(user, account)]
+            return ' Deleting account(s)...\n'
+
+        if verb == 'remove' and entity == 'user':
+            for key in self.get_associations(conditions):
+                if key[0]:
+                    del self.associations[key]
+            return ' Deleting user associations...\n'
+
+        if verb == 'modify' and entity == 'account':
+            if 'set' not in params:
+                raise CommandError(' Nothing to modify')
+            position = params.index('set')
+            names = conditions.get('name') or params[0]
+            values = self.parse_conditions(params[position + 1:])
+            for name in names.split(','):
+                if name not in self.accounts:
+                    raise CommandError(' Account %s does not exist' % name)
+            for name in names.split(','):
+                self.accounts[name].limits = values.get('grptresmins', '')
+            return ' Modified account associations...\n'
+
+        raise CommandError('Unknown sacctmgr command: %s' % ' '.join(args))
+
+    def parse_conditions(self, params):
+        conditions = {}
+        for param in params:
+            if '=' in param:
+                key, value = param.split('=', 1)
+                conditions[key.lower()] = value
+        return conditions
+
+    def get_associations(self, conditions):
+        account = conditions.get('account')
+        user = conditions.get('user') or conditions.get('name')
+        result = []
+        if not user:
+            # Account level association
+            result.extend(('', name) for name in self.accounts if account in (None, name))
+        for association_user, association_account in self.associations:
+            if account and association_account != account:
+                continue
+            if user and association_user != user:
+                continue
+            result.append((association_user, association_account))
+        return result
+
+    def format_account(self, account):
+        return '%s|%s|%s' % (account.name, account.description, account.organization)
+
+    def format_association(self, user, account):
+        limits = self.accounts[account].limits if account in self.accounts else ''
+        fields = [self.name, account, user, '', '1', '', '', '', '', limits, '', '']
+        return '|'.join(fields)
+
+    def sacct(self, args):
+        if '--version' in args:
+            return 'slurm %s\n' % self.version
+
+        options = {}
+        for arg in args:
+            if arg.startswith('--') and '=' in arg:
+                key, value = arg[2:].split('=', 1)
+                options[key] = value
+
+        accounts = set(options['accounts'].split(',')) if 'accounts' in options else None
+        start = parse_date(options['starttime']) if 'starttime' in options else None
+        end = parse_date(options['endtime']) if 'endtime' in options else None
+        jobs = self.filter_jobs(accounts, start, end)
+        if '--truncate' in args:
+            jobs = [self.truncate_job(job, start, end) for job in jobs]
+
+        if '--json' in args:
+            return json.dumps({'meta': {}, 'errors': [], 'jobs': [self.format_json_job(job) for job in jobs]})
+
+        fields = options.get('format', 'Account,ReqTRES,Elapsed,User').split(',')
+        formatters = [self.get_job_formatter(field) for field in fields]
+        return self.render('|'.join(formatter(job) for formatter in formatters) + '|' for job in jobs)
+
+    def filter_jobs(self, accounts, start, end):
+        jobs = []
+        for job in self.jobs:
+            if accounts is not None and job.account not in accounts:
+                continue
+            if end and job.start > end:
+                continue
+            if start and job.end and job.end < start:
+                continue
+            jobs.append(job)
+        return jobs
+
+    def truncate_job(self, job, start, end):
+        """
+        Keep only the part of the job within the report period, like sacct --truncate does.
+        Job is running for elapsed seconds until its end or since its start if it is still running.
+        """
+        duration = datetime.timedelta(seconds=job.elapsed)
+        job_start = job.end - duration if job.end else job.start
+        job_end = job_start + duration
+        if start and job_start < start:
+            job_start = start
+        if end and job_end > end:
+            job_end = end
+        elapsed = max(int((job_end - job_start).total_seconds()), 0)
+        job_end = min(job.end, end) if job.end and end else job.end
+        return job._replace(elapsed=elapsed, start=job_start, end=job_end)
+
+    def format_json_job(self, job):
+        """
+        Format job like sacct --json and slurmrestd do, memory is reported in megabytes.
+        """
+        requested = []
+        for name, value in parse_tres(job.req_tres).items():
+            tres_type, _, tres_name = name.partition('/')
+            count = int(re.match(r'\d+', value).group(0))
+            requested.append({'type': tres_type, 'name': tres_name, 'count': count})
+        return {
+            'job_id': job.job_id,
+            'account': job.account,
+            'user': job.user,
+            'time': {
+                'elapsed': job.elapsed,
+                'start': get_timestamp(job.start),
+                'end': get_timestamp(job.end) if job.end else 0,
+            },
+            'tres': {'requested': requested},
+        }
+
+    def get_job_formatter(self, field):
+        formatters = {
+            'account': lambda job: job.account,
+            'reqtres': lambda job: job.req_tres,
+            'elapsed': lambda job: format_elapsed(job.elapsed),
+            'user': lambda job: job.user,
+            'jobid': lambda job: six.text_type(job.job_id),
+            'start': lambda job: job.start.strftime('%Y-%m-%dT%H:%M:%S'),
+            'end': lambda job: job.end.strftime('%Y-%m-%dT%H:%M:%S') if job.end else 'Unknown',
+        }
+        return formatters.get(field.lower(), lambda job: '')
+
+    # MOAB
+
+    def parse_moab_args(self, args):
+        options = {}
+        key = None
+        for arg in args:
+            if arg.startswith('-'):
+                key = arg.lstrip('-')
+                options[key] = True
+            elif key:
+                options[key] = arg
+                key = None
+        return options
+
+    def mam_list_accounts(self, args):
+        options = self.parse_moab_args(args)
+        names = [options['a']] if 'a' in options else list(self.accounts.keys())
+        return self.render(self.format_account(self.accounts[name]) for name in names if name in self.accounts)
+
+    def mam_create_account(self, args):
+        options = self.parse_moab_args(args)
+        self.add_account(options['a'], options.get('d', ''), options.get('o', ''))
+        return 'Successfully created 1 account\n'
+
+    def mam_delete_account(self, args):
+        options = self.parse_moab_args(args)
+        self.accounts.pop(options['a'], None)
+        return 'Successfully deleted 1 account\n'
+
+    def mam_deposit(self, args):
+        options = self.parse_moab_args(args)
+        if options['a'] not in self.accounts:
+            raise CommandError('Account %s does not exist' % options['a'])
+        self.accounts[options['a']].deposit = options['z']
+        return 'Successfully deposited %s credits\n' % options['z']
+
+    def mam_list_funds(self, args):
+        options = self.parse_moab_args(args)
+        key = (options.get('u'), options.get('a'))
+        if key not in self.associations:
+            return ''
+        return self.render(['User=%s|%s' % (key[0], self.accounts[key[1]].deposit)])
+
+    def mam_modify_account(self, args):
+        options = self.parse_moab_args(args)
+        if 'add-user' in options:
+            self.add_association(options['add-user'], options['a'])
+        elif 'del-user' in options:
+            self.associations.pop((options['del-user'], options['a']), None)
+        return 'Successfully modified 1 account\n'
+
+    def mam_list_usagerecords(self, args):
+        options = self.parse_moab_args(args)
+        start = parse_date(options['s']) if 's' in options else None
+        end = parse_date(options['e']) if 'e' in options else None
+        lines = []
+        for job in self.jobs:
+            if job.account != options.get('a'):
+                continue
+            if end and job.start > end:
+                continue
+            if start and job.end and job.end < start:
+                continue
+            tres = parse_tres(job.req_tres)
+            lines.append('|'.join([
+                job.account,
+                tres.get('cpu', ''),
+                tres.get('gres/gpu', ''),
+                tres.get('mem', '').rstrip('M'),
+                six.text_type(job.elapsed),
+                job.user,
+                job.charge,
+                tres.get('node', '1'),
+                six.text_type(job.job_id),
+                job.end.strftime('%Y-%m-%d %H:%M:%S') if job.end else '',
+            ]))
+        return self.render(lines)
+
+    def render(self, lines):
+        return ''.join(line + '\n' for line in lines)
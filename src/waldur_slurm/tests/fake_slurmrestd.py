@@ -0,0 +1,173 @@
+"""
+Local stub of slurmrestd serving accounting endpoints used by REST client.
+State is kept in FakeCluster, so that the same scenarios can be exercised over SSH commands and HTTP.
+"""
+from __future__ import unicode_literals
+
+import json
+import threading
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, unquote, urlparse
+
+from .fake_cluster import parse_date, parse_tres
+
+TOKEN = 'secret'
+
+API_PREFIX = '/slurmdb/v0.0.38/'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeSlurmRestServer(object):
+    """
+    :param cluster: FakeCluster instance holding accounts, associations and jobs
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.connections = 0
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.get_handler_class())
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                stub.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.dispatch('get')
+
+            def do_POST(self):
+                self.dispatch('post')
+
+            def do_DELETE(self):
+                self.dispatch('delete')
+
+            def dispatch(self, method):
+                stub.requests += 1
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if self.headers.get('X-SLURM-USER-TOKEN') != TOKEN:
+                    return self.respond(401, {'errors': [{'error': 'Authentication failure'}]})
+
+                url = urlparse(self.path)
+                if not url.path.startswith(API_PREFIX):
+                    return self.respond(404, {'errors': [{'error': 'Unknown path'}]})
+                endpoint = unquote(url.path[len(API_PREFIX):])
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                payload = json.loads(body.decode('utf-8')) if body else {}
+
+                with stub.cluster.lock:
+                    status, data = stub.handle(method, endpoint, params, payload)
+                self.respond(status, data)
+
+            def respond(self, status, data):
+                content = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+    def handle(self, method, endpoint, params, payload):
+        cluster = self.cluster
+        name, _, argument = endpoint.partition('/')
+        cluster.executed_commands['slurmrestd %s %s' % (method, name)] += 1
+
+        if (method, name) == ('get', 'accounts'):
+            return 200, {'accounts': [self.format_account(account) for account in cluster.accounts.values()]}
+
+        if (method, name) == ('get', 'account'):
+            account = cluster.accounts.get(argument)
+            if account is None:
+                return 404, {'errors': [{'error': 'Nothing found'}]}
+            return 200, {'accounts': [self.format_account(account)]}
+
+        if (method, name) == ('post', 'accounts'):
+            for item in payload['accounts']:
+                cluster.add_account(item['name'], item.get('description', ''), item.get('organization', ''))
+            return 200, {'errors': []}
+
+        if (method, name) == ('delete', 'account'):
+            cluster.accounts.pop(argument, None)
+            return 200, {'errors': []}
+
+        if (method, name) == ('get', 'associations'):
+            conditions = {key: value for key, value in params.items() if key in ('user', 'account')}
+            return 200, {'associations': [
+                self.format_association(user, account)
+                for user, account in cluster.get_associations(conditions)
+            ]}
+
+        if (method, name) == ('post', 'associations'):
+            for item in payload['associations']:
+                account = cluster.accounts.get(item['account'])
+                if account is None:
+                    return 400, {'errors': [{'error': 'Account %s does not exist' % item['account']}]}
+                if item.get('user'):
+                    cluster.add_association(item['user'], item['account'])
+                if 'parent_account' in item:
+                    account.parent = item['parent_account']
+                minutes = item.get('max', {}).get('tres', {}).get('group', {}).get('minutes')
+                if minutes is not None:
+                    account.limits = ','.join(self.format_tres_name(tres) + '=%s' % tres['count'] for tres in minutes)
+            return 200, {'errors': []}
+
+        if (method, name) == ('delete', 'association'):
+            cluster.associations.pop((params.get('user'), params.get('account')), None)
+            return 200, {'errors': []}
+
+        if (method, name) == ('post', 'users'):
+            return 200, {'errors': []}
+
+        if (method, name) == ('get', 'jobs'):
+            return 200, {'meta': {'plugin': {'type': 'openapi/v0.0.38'}}, 'errors': [], 'jobs': self.get_jobs(params)}
+
+        return 404, {'errors': [{'error': 'Unknown endpoint %s' % endpoint}]}
+
+    def format_account(self, account):
+        return {'name': account.name, 'description': account.description, 'organization': account.organization}
+
+    def format_tres_name(self, tres):
+        return '%s/%s' % (tres['type'], tres['name']) if tres.get('name') else tres['type']
+
+    def format_association(self, user, account):
+        limits = self.cluster.accounts[account].limits if account in self.cluster.accounts else ''
+        minutes = []
+        for name, count in parse_tres(limits).items():
+            tres_type, _, tres_name = name.partition('/')
+            minutes.append({'type': tres_type, 'name': tres_name, 'count': int(count)})
+        return {'account': account, 'user': user, 'max': {'tres': {'group': {'minutes': minutes}}}}
+
+    def get_jobs(self, params):
+        accounts = set(params['account'].split(',')) if 'account' in params else None
+        start = parse_date(params['start_time']) if 'start_time' in params else None
+        end = parse_date(params['end_time']) if 'end_time' in params else None
+        return [self.cluster.format_json_job(job) for job in self.cluster.filter_jobs(accounts, start, end)]
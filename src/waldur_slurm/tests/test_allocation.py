@@ -6,6 +6,7 @@ from rest_framework import status, test
 
 from waldur_freeipa import models as freeipa_models
 
+from .. import models
 from . import factories, fixtures
 
 
@@ -109,9 +110,20 @@ class AllocationCancelTest(test.APITransactionTestCase):
     def test_authorized_user_can_cancel_allocation(self, user):
         self.client.force_login(getattr(self.fixture, user))
 
-        with mock.patch('subprocess.check_output'):
+        with mock.patch('waldur_slurm.executors.AllocationCancelExecutor') as mock_executor:
             response = self.client.post(self.url)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+            mock_executor.execute.assert_called_once_with(self.fixture.allocation)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+    def test_cancel_is_not_allowed_for_inactive_allocation(self):
+        self.fixture.allocation.is_active = False
+        self.fixture.allocation.save()
+        self.client.force_login(self.fixture.owner)
+
+        with mock.patch('waldur_slurm.executors.AllocationCancelExecutor') as mock_executor:
+            response = self.client.post(self.url)
+            self.assertFalse(mock_executor.execute.called)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
     @data('admin', 'manager')
     def test_non_authorized_user_can_not_cancel_allocation(self, user):
@@ -151,3 +163,141 @@ class AllocationUpdateTest(test.APITransactionTestCase):
             'gpu_limit': 200,
             'ram_limit': 300,
         }
+
+
+class AllocationConditionalGetTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.allocation = self.fixture.allocation
+        self.client.force_login(self.fixture.owner)
+        # Test cache is local to the process, but it is shared by API and handlers running in the same process
+        patcher = mock.patch('waldur_slurm.utils.is_cache_shared', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_not_modified(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_list_is_not_rendered_if_data_is_not_changed(self):
+        self.assert_not_modified(factories.AllocationFactory.get_list_url())
+
+    def test_detail_is_not_rendered_if_data_is_not_changed(self):
+        self.assert_not_modified(factories.AllocationFactory.get_url(self.allocation))
+
+    def test_etag_is_changed_when_allocation_is_updated(self):
+        url = factories.AllocationFactory.get_url(self.allocation)
+        etag = self.client.get(url)['ETag']
+
+        self.allocation.cpu_usage += 100
+        self.allocation.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['cpu_usage'], self.allocation.cpu_usage)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_detail_etag_is_changed_when_project_is_updated(self):
+        url = factories.AllocationFactory.get_url(self.allocation)
+        etag = self.client.get(url)['ETag']
+
+        self.fixture.project.name = 'New project name'
+        self.fixture.project.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_etag_depends_on_user(self):
+        url = factories.AllocationFactory.get_list_url()
+        etag = self.client.get(url)['ETag']
+
+        self.client.force_login(self.fixture.staff)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_modification_time_is_not_used_as_validator(self):
+        url = factories.AllocationFactory.get_url(self.allocation)
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response)
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_conditional_get_is_disabled_if_cache_is_local_to_process(self):
+        url = factories.AllocationFactory.get_url(self.allocation)
+        with mock.patch('waldur_slurm.utils.is_cache_shared', return_value=False):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('ETag', response)
+
+
+class AllocationBulkLimitsTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.allocation1 = self.fixture.allocation
+        self.allocation2 = factories.AllocationFactory(service_project_link=self.fixture.spl)
+        self.url = factories.AllocationFactory.get_list_url() + 'set_limits/'
+
+    def get_payload(self, *allocations):
+        return {
+            'limits': [{
+                'allocation': factories.AllocationFactory.get_url(allocation),
+                'cpu_limit': 1000,
+                'ram_limit': 2000,
+            } for allocation in allocations]
+        }
+
+    @mock.patch('waldur_slurm.views.tasks.set_resource_limits_bulk')
+    def test_staff_can_update_limits_of_many_allocations(self, mock_task):
+        self.client.force_login(self.fixture.staff)
+        response = self.client.post(self.url, self.get_payload(self.allocation1, self.allocation2), format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.allocation1.refresh_from_db()
+        self.assertEqual(self.allocation1.cpu_limit, 1000)
+        self.assertEqual(self.allocation1.state, models.Allocation.States.UPDATE_SCHEDULED)
+
+        mock_task.delay.assert_called_once_with(mock.ANY)
+        uuids = mock_task.delay.call_args[0][0]
+        self.assertEqual(set(uuids), {self.allocation1.uuid.hex, self.allocation2.uuid.hex})
+
+    @mock.patch('waldur_slurm.views.tasks.set_resource_limits_bulk')
+    def test_limit_can_be_removed_in_bulk(self, mock_task):
+        self.allocation1.cpu_limit = 1000
+        self.allocation1.save()
+        payload = {'limits': [{'allocation': factories.AllocationFactory.get_url(self.allocation1), 'cpu_limit': -1}]}
+
+        self.client.force_login(self.fixture.staff)
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.allocation1.refresh_from_db()
+        self.assertEqual(self.allocation1.cpu_limit, -1)
+
+    @mock.patch('waldur_slurm.views.tasks.set_resource_limits_bulk')
+    def test_limit_should_not_be_less_than_minus_one(self, mock_task):
+        payload = {'limits': [{'allocation': factories.AllocationFactory.get_url(self.allocation1), 'cpu_limit': -2}]}
+
+        self.client.force_login(self.fixture.staff)
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(mock_task.delay.called)
+
+    @mock.patch('waldur_slurm.views.tasks.set_resource_limits_bulk')
+    def test_owner_can_not_update_limits_in_bulk(self, mock_task):
+        self.client.force_login(self.fixture.owner)
+        response = self.client.post(self.url, self.get_payload(self.allocation1), format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(mock_task.delay.called)
+
+    @mock.patch('waldur_slurm.views.tasks.set_resource_limits_bulk')
+    def test_allocation_should_be_in_ok_state(self, mock_task):
+        self.allocation1.state = models.Allocation.States.ERRED
+        self.allocation1.save()
+
+        self.client.force_login(self.fixture.staff)
+        response = self.client.post(self.url, self.get_payload(self.allocation1), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
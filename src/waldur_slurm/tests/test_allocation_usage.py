@@ -1,8 +1,13 @@
 from __future__ import unicode_literals
 
+import datetime
+import json
+
 from ddt import ddt, data
+from django.urls import reverse
 from rest_framework import status, test
 
+from .. import models
 from . import factories, fixtures
 
 
@@ -32,3 +37,113 @@ class AllocationUsageGetTest(test.APITransactionTestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 0)
+
+
+class AllocationUsageExportTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.usage = self.fixture.allocation_usage
+        self.url = factories.AllocationUsageFactory.get_list_url() + 'export/'
+
+    def get_content(self, response):
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_usage_is_exported_as_csv(self):
+        self.client.force_login(self.fixture.owner)
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+        lines = self.get_content(response).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('allocation_uuid,allocation_name,year,month'))
+        self.assertTrue(lines[1].startswith(str(self.usage.allocation.uuid)))
+
+    def test_usage_is_exported_as_ndjson(self):
+        self.client.force_login(self.fixture.owner)
+        response = self.client.get(self.url, {'file_format': 'ndjson'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = [json.loads(line) for line in self.get_content(response).splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['cpu_usage'], self.usage.cpu_usage)
+        self.assertEqual(rows[0]['username'], self.usage.username)
+
+    def test_export_is_filtered_by_permissions(self):
+        self.client.force_login(self.fixture.user)
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.get_content(response).splitlines()), 1)
+
+    def test_unsupported_format_is_rejected(self):
+        self.client.force_login(self.fixture.owner)
+        response = self.client.get(self.url, {'file_format': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AllocationUsagePaginationTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.usages = factories.AllocationUsageFactory.create_batch(3, allocation=self.fixture.allocation)
+        self.url = factories.AllocationUsageFactory.get_list_url()
+
+    def test_pages_are_linked_by_cursor(self):
+        self.client.force_login(self.fixture.staff)
+        response = self.client.get(self.url, {'page_size': 2, 'pagination': 'cursor'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertIn('rel="next"', response['Link'])
+
+        next_url = response['Link'].split(';')[0].strip('<>')
+        response = self.client.get(next_url)
+        self.assertEqual(len(response.data), 1)
+        self.assertNotIn('rel="next"', response['Link'])
+
+    def test_number_of_results_is_reported_by_default(self):
+        self.client.force_login(self.fixture.staff)
+        response = self.client.get(self.url, {'page_size': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(response['X-Result-Count'], '3')
+
+    def test_usage_is_retrieved_by_id(self):
+        self.client.force_login(self.fixture.staff)
+        response = self.client.get(factories.AllocationUsageFactory.get_url(self.usages[0]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['cpu_usage'], self.usages[0].cpu_usage)
+
+
+@ddt
+class UsageRollupGetTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.rollup = models.UsageRollup.objects.create(
+            level=models.UsageRollup.Levels.PROJECT,
+            period=models.UsageRollup.Periods.MONTH,
+            date=datetime.date(2017, 10, 1),
+            project=self.fixture.project,
+            customer=self.fixture.customer,
+            cpu_usage=100,
+        )
+        self.url = reverse('slurm-usage-rollup-list')
+
+    @data('staff', 'owner', 'manager', 'admin')
+    def test_authorized_user_can_get_rollups(self, username):
+        self.client.force_login(getattr(self.fixture, username))
+        response = self.client.get(self.url, {'level': 'project', 'period': 'month'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['cpu_usage'], 100)
+
+    def test_unauthorized_user_can_not_get_rollups(self):
+        self.client.force_login(self.fixture.user)
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 0)
@@ -1,18 +1,22 @@
 from __future__ import unicode_literals
 
 import decimal
+import subprocess  # nosec
 
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection
+from django.db.models import signals
+from django.test import TestCase, override_settings
 import mock
 from freezegun import freeze_time
 
 from waldur_freeipa import models as freeipa_models
-from .. import models
-from . import fixtures
+from .. import locks, models, profiling
+from . import factories, fixtures
 
 VALID_REPORT = """
-allocation1|cpu=1,mem=51200M,node=1,gres/gpu=1,gres/gpu:tesla=1|00:01:00|user1|
-allocation1|cpu=2,mem=51200M,node=2,gres/gpu=2,gres/gpu:tesla=1|00:02:00|user2|
+allocation1|cpu=1,mem=51200M,node=1,gres/gpu=1,gres/gpu:tesla=1|00:01:00|user1|1|Unknown|
+allocation1|cpu=2,mem=51200M,node=2,gres/gpu=2,gres/gpu:tesla=1|00:02:00|user2|2|Unknown|
 """
 
 
@@ -34,6 +38,63 @@ class BackendTest(TestCase):
         self.assertEqual(self.allocation.gpu_usage, 1 + 2 * 2 * 2)
         self.assertEqual(self.allocation.ram_usage, (1 + 2 * 2) * 51200 * 2**20)
 
+    @mock.patch('subprocess.check_output')
+    def test_project_quotas_are_updated_after_synchronization(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+
+        cpu_usage = self.fixture.project.quotas.get(name='nc_cpu_usage').usage
+        self.assertEqual(cpu_usage, 1 + 2 * 2 * 2)
+
+    @mock.patch('waldur_slurm.handlers.update_quotas')
+    @mock.patch('subprocess.check_output')
+    def test_project_quotas_are_updated_once_per_chunk(self, check_output, update_quotas):
+        allocation = factories.AllocationFactory(service_project_link=self.fixture.spl)
+        account = 'waldur_allocation_' + allocation.uuid.hex
+        report = VALID_REPORT.replace('allocation1', account)
+        report = report.replace('|1|Unknown|', '|3|Unknown|').replace('|2|Unknown|', '|4|Unknown|')
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account) + report
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+
+        scopes = [call[0][0] for call in update_quotas.call_args_list]
+        self.assertEqual(scopes, [self.fixture.project, self.fixture.customer])
+
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, SYNC_CHUNK_SIZE=1))
+    @mock.patch('waldur_slurm.rollups.update_usage_rollups')
+    @mock.patch('subprocess.check_output')
+    def test_customer_rollups_are_updated_once_per_synchronization(self, check_output, update_usage_rollups):
+        allocation = factories.AllocationFactory(service_project_link=self.fixture.spl)
+        account = 'waldur_allocation_' + allocation.uuid.hex
+        report = VALID_REPORT.replace('allocation1', account)
+        report = report.replace('|1|Unknown|', '|3|Unknown|').replace('|2|Unknown|', '|4|Unknown|')
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account) + report
+        update_usage_rollups.return_value = 0
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+
+        self.assertEqual(update_usage_rollups.call_count, 1)
+        self.assertEqual(update_usage_rollups.call_args[0][0], {self.fixture.customer.pk})
+
+    @freeze_time('2017-10-16 00:00:00')
+    @mock.patch('subprocess.check_output')
+    def test_save_signal_is_sent_if_usage_is_changed(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+        handler = mock.Mock()
+        signals.post_save.connect(handler, sender=models.Allocation)
+        self.addCleanup(signals.post_save.disconnect, handler, sender=models.Allocation)
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+        backend.sync_usage()
+
+        self.assertEqual(handler.call_count, 1)
+        self.assertIn('cpu_usage', handler.call_args[1]['update_fields'])
+
     @freeze_time('2017-10-16 00:00:00')
     @mock.patch('subprocess.check_output')
     def test_usage_per_user(self, check_output):
@@ -58,6 +119,131 @@ class BackendTest(TestCase):
         self.assertEqual(user1_allocation.gpu_usage, 1)
         self.assertEqual(user1_allocation.ram_usage, 51200 * 2**20)
 
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, SYNC_PROFILING_ENABLED=True))
+    @mock.patch('subprocess.check_output')
+    def test_sync_phases_are_profiled(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+
+        profiles = profiling.get_sync_profiles(self.fixture.service.settings)
+        phases = {phase['name']: phase for phase in profiles[0]['phases']}
+        self.assertEqual(set(phases), {'load', 'fetch', 'write', 'sum', 'rollup'})
+        self.assertEqual(phases['fetch']['rows'], 2)
+        self.assertEqual(phases['write']['rows'], 2)
+        # SLURM version is detected before usage report is requested
+        self.assertEqual(phases['fetch']['remote_commands'], 2)
+        self.assertIsNone(profiles[0]['cprofile'])
+
+    @mock.patch('subprocess.check_output')
+    def test_usage_report_is_fetched_outside_of_transaction(self, check_output):
+        report = VALID_REPORT.replace('allocation1', self.account)
+        depth = len(connection.savepoint_ids)
+        depths = []
+
+        def execute(*args, **kwargs):
+            depths.append(len(connection.savepoint_ids))
+            return report
+
+        check_output.side_effect = execute
+        self.allocation.get_backend().sync_usage()
+
+        self.assertEqual(set(depths), {depth})
+        self.allocation.refresh_from_db()
+        self.assertEqual(self.allocation.cpu_usage, 1 + 2 * 2 * 2)
+
+    @mock.patch('subprocess.check_output')
+    def test_concurrent_synchronization_is_skipped(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+        backend = self.allocation.get_backend()
+
+        with locks.single_flight('usage:%s' % self.fixture.service.settings.uuid.hex):
+            backend.sync_usage()
+        self.assertEqual(check_output.call_count, 0)
+
+        backend.sync_usage()
+        self.allocation.refresh_from_db()
+        self.assertEqual(self.allocation.cpu_usage, 1 + 2 * 2 * 2)
+
+    @mock.patch('subprocess.check_output')
+    def test_cprofile_report_is_collected_on_demand(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+        profiling.request_profile_dump(self.fixture.service.settings)
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+
+        profiles = profiling.get_sync_profiles(self.fixture.service.settings)
+        self.assertIn('cumulative', profiles[0]['cprofile'])
+
+    @freeze_time('2017-10-16 00:00:00')
+    @mock.patch('subprocess.check_output')
+    def test_daily_usage_and_rollups_are_updated(self, check_output):
+        report = (
+            'allocation1|cpu=1,mem=1M,node=1|00:01:00|user1|1|2017-10-02T10:00:00|\n'
+            'allocation1|cpu=2,mem=1M,node=1|00:01:00|user1|2|2017-10-03T10:00:00|\n'
+            'allocation1|cpu=4,mem=1M,node=1|00:01:00|user1|3|Unknown|\n'
+        )
+        check_output.return_value = report.replace('allocation1', self.account)
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+
+        daily = models.AllocationDailyUsage.objects.filter(allocation=self.allocation).order_by('date')
+        self.assertEqual([(str(usage.date), usage.cpu_usage) for usage in daily],
+                         [('2017-10-02', 1), ('2017-10-03', 2), ('2017-10-16', 4)])
+
+        rollup = models.UsageRollup.objects.get(
+            level=models.UsageRollup.Levels.CUSTOMER,
+            period=models.UsageRollup.Periods.MONTH,
+            customer=self.fixture.customer,
+        )
+        self.assertEqual(str(rollup.date), '2017-10-01')
+        self.assertEqual(rollup.cpu_usage, 1 + 2 + 4)
+
+    @mock.patch('subprocess.check_output')
+    def test_usage_of_past_days_is_not_changed_while_job_is_running(self, check_output):
+        report = 'allocation1|cpu=1,mem=1M,node=1|%s|user1|1|Unknown|2017-10-15T12:00:00|\n'
+        backend = self.allocation.get_backend()
+
+        with freeze_time('2017-10-16 12:00:00'):
+            check_output.return_value = (report % '1-00:00:00').replace('allocation1', self.account)
+            backend.sync_usage()
+
+        with freeze_time('2017-10-17 06:00:00'):
+            check_output.return_value = (report % '1-18:00:00').replace('allocation1', self.account)
+            backend.sync_usage()
+
+        daily = models.AllocationDailyUsage.objects.filter(allocation=self.allocation).order_by('date')
+        self.assertEqual([(str(usage.date), usage.cpu_usage) for usage in daily],
+                         [('2017-10-15', 12 * 60), ('2017-10-16', 24 * 60), ('2017-10-17', 6 * 60)])
+
+    @mock.patch('subprocess.check_output')
+    def test_repeated_synchronization_does_not_double_count_jobs(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+        backend.sync_usage()
+        self.allocation.refresh_from_db()
+
+        self.assertEqual(self.allocation.cpu_usage, 1 + 2 * 2 * 2)
+        self.assertEqual(models.Job.objects.filter(allocation=self.allocation).count(), 2)
+
+    @mock.patch('subprocess.check_output')
+    def test_usage_of_running_job_is_updated_in_ledger(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+
+        check_output.return_value = check_output.return_value.replace('|00:01:00|', '|00:03:00|')
+        backend.sync_usage()
+        self.allocation.refresh_from_db()
+
+        self.assertEqual(self.allocation.cpu_usage, 3 + 2 * 2 * 2)
+        self.assertEqual(models.Job.objects.get(allocation=self.allocation, job_id='1').cpu_usage, 3)
+
     @mock.patch('subprocess.check_output')
     def test_set_resource_limits(self, check_output):
         self.allocation.cpu_limit = 1000
@@ -76,6 +262,110 @@ class BackendTest(TestCase):
 
         check_output.assert_called_once_with(command, stderr=mock.ANY)
 
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, EXTRA_TRES=('billing',)))
+    @mock.patch('subprocess.check_output')
+    def test_extra_tres_limits_are_applied(self, check_output):
+        self.allocation.tres_limits = {'billing': 500}
+        self.allocation.save()
+
+        backend = self.allocation.get_backend()
+        backend.set_resource_limits(self.allocation)
+
+        command = check_output.call_args[0][0][-1]
+        self.assertTrue(command.endswith('GrpTRESMins=cpu=-1,gres/gpu=-1,mem=-1,billing=500'))
+
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, EXTRA_TRES=('gres/gpu:tesla',)))
+    @mock.patch('subprocess.check_output')
+    def test_extra_tres_usage_is_stored(self, check_output):
+        check_output.return_value = VALID_REPORT.replace('allocation1', self.account)
+
+        backend = self.allocation.get_backend()
+        backend.sync_usage()
+        self.allocation.refresh_from_db()
+
+        self.assertEqual(self.allocation.tres_usage, {'gres/gpu:tesla': 1 + 1 * 2 * 2})
+
+    @mock.patch('subprocess.check_output')
+    def test_allocations_with_equal_limits_are_updated_by_single_command(self, check_output):
+        allocation2 = factories.AllocationFactory(
+            service_project_link=self.fixture.spl,
+            cpu_limit=self.allocation.cpu_limit,
+            gpu_limit=self.allocation.gpu_limit,
+            ram_limit=self.allocation.ram_limit,
+        )
+        account2 = 'waldur_allocation_' + allocation2.uuid.hex
+
+        backend = self.allocation.get_backend()
+        results = backend.set_resource_limits_bulk([self.allocation, allocation2])
+
+        self.assertEqual(results, {self.allocation: None, allocation2: None})
+        self.assertEqual(check_output.call_count, 1)
+        command = check_output.call_args[0][0][-1]
+        self.assertIn('where name=', command)
+        self.assertIn(self.account, command)
+        self.assertIn(account2, command)
+
+    @mock.patch('subprocess.check_output')
+    def test_failed_batch_is_reported_per_allocation(self, check_output):
+        allocation2 = factories.AllocationFactory(
+            service_project_link=self.fixture.spl,
+            cpu_limit=self.allocation.cpu_limit,
+            gpu_limit=self.allocation.gpu_limit,
+            ram_limit=self.allocation.ram_limit,
+        )
+
+        def execute(command, **kwargs):
+            if 'where name=' in command[-1] or self.account in command[-1]:
+                raise subprocess.CalledProcessError(1, command, 'Error')
+            return ''
+
+        check_output.side_effect = execute
+
+        backend = self.allocation.get_backend()
+        results = backend.set_resource_limits_bulk([self.allocation, allocation2])
+
+        self.assertEqual(results[self.allocation], 'Error')
+        self.assertIsNone(results[allocation2])
+
+    @mock.patch('subprocess.check_output')
+    def test_bulk_modification_is_disabled_if_it_is_not_supported(self, check_output):
+        allocation2 = factories.AllocationFactory(
+            service_project_link=self.fixture.spl,
+            cpu_limit=self.allocation.cpu_limit,
+            gpu_limit=self.allocation.gpu_limit,
+            ram_limit=self.allocation.ram_limit,
+        )
+
+        def execute(command, **kwargs):
+            if 'where name=' in command[-1]:
+                raise subprocess.CalledProcessError(1, command, 'Error')
+            return ''
+
+        check_output.side_effect = execute
+        backend = self.allocation.get_backend()
+        backend.set_resource_limits_bulk([self.allocation, allocation2])
+
+        check_output.reset_mock()
+        results = backend.set_resource_limits_bulk([self.allocation, allocation2])
+
+        self.assertEqual(results, {self.allocation: None, allocation2: None})
+        commands = [call[0][0][-1] for call in check_output.call_args_list]
+        self.assertEqual(len(commands), 2)
+        self.assertFalse(any('where name=' in command for command in commands))
+
+    @mock.patch('subprocess.check_output')
+    def test_cancel_allocation_sets_limits_to_usage(self, check_output):
+        self.allocation.cpu_usage = 500
+        self.allocation.save()
+
+        backend = self.allocation.get_backend()
+        backend.cancel_allocation(self.allocation)
+        self.allocation.refresh_from_db()
+
+        self.assertFalse(self.allocation.is_active)
+        self.assertEqual(self.allocation.cpu_limit, 500)
+        self.assertTrue(check_output.called)
+
 
 class BackendMOABTest(TestCase):
     def setUp(self):
@@ -86,12 +376,12 @@ class BackendMOABTest(TestCase):
         self.subprocess_patcher = mock.patch('subprocess.check_output')
         self.subprocess_mock = self.subprocess_patcher.start()
         self.subprocess_mock.return_value = """
-            test_acc|4|||21|centos|0.00|1
-            test_acc|4|6|12|20|centos|0.00|1
-            test_acc|4|||100|centos|0.03|1
-            test_acc|4|||100|centos|0.03|1
-            test_acc|4|||500|centos|0.17|1
-            test_acc|4|||2|centos|0.00|1
+            test_acc|4|||21|centos|0.00|1|1
+            test_acc|4|6|12|20|centos|0.00|1|2
+            test_acc|4|||100|centos|0.03|1|3
+            test_acc|4|||100|centos|0.03|1|4
+            test_acc|4|||500|centos|0.17|1|5
+            test_acc|4|||2|centos|0.00|1|6
         """.replace('test_acc', 'waldur_allocation_' + self.fixture.allocation.uuid.hex)
 
     def tearDown(self):
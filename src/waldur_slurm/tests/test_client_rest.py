@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+import datetime
+
+from django.test import TestCase
+
+from .. import utils
+from ..client_rest import SlurmRestClient, SlurmRestError
+from ..structures import Quotas
+from . import fixtures
+from .fake_cluster import FakeCluster
+from .fake_slurmrestd import TOKEN, FakeSlurmRestServer
+
+
+class SlurmRestClientTest(TestCase):
+    def setUp(self):
+        self.cluster = FakeCluster()
+        self.server = FakeSlurmRestServer(self.cluster).start()
+        self.addCleanup(self.server.stop)
+        self.client = SlurmRestClient(self.server.url, token=TOKEN)
+
+    def test_account_lifecycle(self):
+        self.client.create_account('acc1', 'Allocation', 'org1')
+        self.assertEqual(self.client.get_account('acc1').organization, 'org1')
+
+        self.client.create_association('user1', 'acc1', 'acc1')
+        self.assertEqual(self.client.get_association('user1', 'acc1').user, 'user1')
+
+        self.client.delete_account('acc1')
+        self.assertIsNone(self.client.get_account('acc1'))
+        self.assertIsNone(self.client.get_association('user1', 'acc1'))
+
+    def test_limits_are_applied(self):
+        self.client.create_account('acc1', 'Allocation', 'org1')
+        self.client.create_association('user1', 'acc1')
+
+        self.client.set_resource_limits('acc1', Quotas(cpu=100, gpu=10, ram=1000))
+        self.assertEqual(self.client.get_association('user1', 'acc1').value, 100)
+
+    def test_usage_report_is_filtered_by_account(self):
+        now = datetime.datetime.now()
+        self.cluster.add_job(1, 'acc1', 'user1', 'cpu=2,mem=1024M,node=1', 120, now, now)
+        self.cluster.add_job(2, 'acc2', 'user1', 'cpu=2,mem=1024M,node=1', 120, now, now)
+
+        records = list(self.client.get_usage_report(['acc1']))
+        self.assertEqual([(record.account, record.values[0], record.job_id) for record in records],
+                         [('acc1', 2 * 2, '1')])
+        self.assertEqual(records[0].values[2], 1024 * 2**20 * 2)
+        self.assertEqual(records[0].day, now.date().isoformat())
+
+    def test_usage_report_is_truncated_to_period(self):
+        start = datetime.datetime(2018, 1, 25)
+        end = datetime.datetime(2018, 2, 5)
+        self.cluster.add_job(1, 'acc1', 'user1', 'cpu=2,mem=1024M,node=1', 11 * 24 * 60 * 60, start, end)
+
+        records = list(self.client.get_usage_report(['acc1'], '2018-02-01', '2018-03-01'))
+        self.assertEqual(records[0].values[0], 2 * 4 * 24 * 60)
+        self.assertEqual(records[0].day, '2018-02-05')
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            self.client.list_accounts()
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_invalid_token_is_reported(self):
+        client = SlurmRestClient(self.server.url, token='invalid')
+        self.assertRaises(SlurmRestError, client.list_accounts)
+
+
+class JsonStreamTest(TestCase):
+    def test_array_items_are_decoded_across_chunks(self):
+        document = '{"meta": {"jobs": [0]}, "jobs": [{"job_id": 12345}, {"job_id": 67890}], "errors": []}'
+        chunks = [document[index:index + 3] for index in range(0, len(document), 3)]
+        items = list(utils.iter_json_array(chunks, 'jobs'))
+        self.assertEqual(items, [{'job_id': 12345}, {'job_id': 67890}])
+
+
+class SlurmRestBackendTest(TestCase):
+    def setUp(self):
+        self.cluster = FakeCluster()
+        self.server = FakeSlurmRestServer(self.cluster).start()
+        self.addCleanup(self.server.stop)
+
+        self.fixture = fixtures.SlurmFixture()
+        settings = self.fixture.service.settings
+        settings.options = {'hostname': 'fake.cluster', 'slurmrestd_url': self.server.url}
+        settings.token = TOKEN
+        settings.save()
+
+    def test_allocation_is_created_and_synchronized(self):
+        allocation = self.fixture.allocation
+        backend = allocation.get_backend()
+        self.assertIsInstance(backend.client, SlurmRestClient)
+        backend.create_allocation(allocation)
+
+        account = backend.get_allocation_name(allocation)
+        self.assertIn(account, self.cluster.accounts)
+
+        now = datetime.datetime.now()
+        self.cluster.add_job(1, account, 'user1', 'cpu=2,mem=1024M,node=1', 600, now, now)
+        backend.sync_usage()
+
+        allocation.refresh_from_db()
+        self.assertEqual(allocation.cpu_usage, 2 * 10)
@@ -0,0 +1,253 @@
+from __future__ import unicode_literals
+
+import datetime
+import decimal
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+import mock
+
+from .. import capabilities, models, tasks, transport
+from ..client import SlurmClient
+from ..client_moab import MoabClient
+from ..structures import Quotas
+from . import factories, fixtures
+from .benchmarks import SyncBenchmark
+from .fake_cluster import FakeCluster
+
+
+class FakeSlurmClusterTest(TestCase):
+    def setUp(self):
+        self.cluster = FakeCluster()
+        self.client = SlurmClient(hostname='fake', key_path='', transport=self.cluster)
+
+    def test_account_lifecycle(self):
+        self.client.create_account('acc1', 'Allocation', 'org1')
+        self.assertEqual(self.client.get_account('acc1').organization, 'org1')
+
+        self.client.create_association('user1', 'acc1', 'acc1')
+        self.assertEqual(self.client.get_association('user1', 'acc1').user, 'user1')
+
+        self.client.delete_account('acc1')
+        self.assertIsNone(self.client.get_account('acc1'))
+        self.assertIsNone(self.client.get_association('user1', 'acc1'))
+
+    def test_usage_report_is_filtered_by_account(self):
+        now = datetime.datetime.now()
+        self.cluster.add_job(1, 'acc1', 'user1', 'cpu=2,mem=1024M,node=1', 120, now, now)
+        self.cluster.add_job(2, 'acc2', 'user1', 'cpu=2,mem=1024M,node=1', 120, now, now)
+
+        records = list(self.client.get_usage_report(['acc1']))
+        self.assertEqual([(record.account, record.values[0]) for record in records], [('acc1', 2 * 2)])
+
+
+class FakeSlurmJsonClusterTest(TestCase):
+    def setUp(self):
+        self.cluster = FakeCluster(version='21.08.8')
+        self.client = SlurmClient(hostname='fake', key_path='', transport=self.cluster, use_json=None)
+        capabilities.clear_capabilities('fake')
+        self.addCleanup(capabilities.clear_capabilities, 'fake')
+
+    def test_json_report_is_used_if_supported(self):
+        now = datetime.datetime.now()
+        self.cluster.add_job(1, 'acc1', 'user1', 'cpu=2,mem=1024M,node=1', 120, now, now)
+
+        records = list(self.client.get_usage_report(['acc1']))
+        self.assertTrue(self.client.supports_json())
+        self.assertEqual([(record.job_id, record.values[0]) for record in records], [('1', 2 * 2)])
+
+    def test_text_report_is_used_by_older_version(self):
+        self.cluster.version = '20.11.9'
+        list(self.client.get_usage_report(['acc1']))
+        self.assertFalse(self.client.supports_json())
+
+    def test_capabilities_are_probed_once(self):
+        list(self.client.get_usage_report(['acc1']))
+        list(self.client.get_usage_report(['acc1']))
+        self.assertEqual(self.client.get_capabilities()['version'], (21, 8))
+        # One version probe and two usage reports
+        self.assertEqual(self.cluster.executed_commands['sacct'], 3)
+
+
+class FakeMoabClusterTest(TestCase):
+    def setUp(self):
+        self.cluster = FakeCluster()
+        self.client = MoabClient(hostname='fake', key_path='', transport=self.cluster)
+
+    def test_deposit_is_applied(self):
+        self.client.create_account('acc1', 'Allocation', 'org1')
+        self.client.create_association('user1', 'acc1')
+
+        self.client.set_resource_limits('acc1', Quotas(deposit=100))
+        self.assertEqual(self.client.get_association('user1', 'acc1').value, '100')
+
+
+class FakeClusterBackendTest(TestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.fixture.service.settings.options = {'hostname': 'fake.cluster'}
+        self.fixture.service.settings.save()
+
+        self.cluster = FakeCluster()
+        transport.register_transport('fake.cluster', self.cluster)
+        self.addCleanup(transport.unregister_transport, 'fake.cluster')
+
+    def test_allocation_is_created_and_synchronized(self):
+        allocation = self.fixture.allocation
+        backend = allocation.get_backend()
+        backend.create_allocation(allocation)
+
+        account = backend.get_allocation_name(allocation)
+        self.assertIn(account, self.cluster.accounts)
+
+        now = datetime.datetime.now()
+        self.cluster.add_job(1, account, 'user1', 'cpu=2,mem=1024M,node=1', 600, now, now)
+        backend.sync_usage()
+
+        allocation.refresh_from_db()
+        self.assertEqual(allocation.cpu_usage, 2 * 10)
+
+    def create_allocations_with_jobs(self):
+        allocations = [self.fixture.allocation, factories.AllocationFactory(service_project_link=self.fixture.spl)]
+        backend = self.fixture.allocation.get_backend()
+        now = datetime.datetime.now()
+        for job_id, allocation in enumerate(allocations, 1):
+            account = backend.get_allocation_name(allocation)
+            self.cluster.add_job(job_id, account, 'user1', 'cpu=2,mem=1024M,node=1', 600 * job_id, now, now)
+        return allocations
+
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, SYNC_CHUNK_SIZE=1))
+    def test_allocations_are_synchronized_in_chunks(self):
+        allocations = self.create_allocations_with_jobs()
+        capabilities.clear_capabilities(self.fixture.service.settings.uuid.hex)
+        self.fixture.service.settings.get_backend().sync_usage()
+
+        # SLURM version is detected once and usage of each chunk is requested separately
+        self.assertEqual(self.cluster.executed_commands['sacct'], 3)
+        for job_id, allocation in enumerate(allocations, 1):
+            allocation.refresh_from_db()
+            self.assertEqual(allocation.cpu_usage, 2 * 10 * job_id)
+        cpu_usage = self.fixture.project.quotas.get(name='nc_cpu_usage').usage
+        self.assertEqual(cpu_usage, 2 * 10 + 2 * 20)
+
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, SYNC_CHUNK_SIZE=1))
+    def test_interrupted_synchronization_is_resumed_after_checkpoint(self):
+        allocations = self.create_allocations_with_jobs()
+        settings = self.fixture.service.settings
+
+        with mock.patch('waldur_slurm.ledger.update_rollups', side_effect=[None, ValueError('Worker is lost')]):
+            self.assertRaises(ValueError, settings.get_backend().sync_usage)
+        checkpoint = models.UsageSyncCheckpoint.objects.get(settings=settings)
+        self.assertEqual(checkpoint.last_allocation_id, allocations[0].pk)
+
+        self.cluster.executed_commands.clear()
+        settings.get_backend().sync_usage()
+
+        # Usage of the first chunk has been committed before failure, so that it is not requested again
+        self.assertEqual(self.cluster.executed_commands['sacct'], 1)
+        allocations[1].refresh_from_db()
+        self.assertEqual(allocations[1].cpu_usage, 2 * 20)
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_allocation_id, 0)
+
+    def test_usage_of_job_spanning_time_windows_is_summed(self):
+        allocation = self.fixture.allocation
+        account = allocation.get_backend().get_allocation_name(allocation)
+        start = datetime.datetime(2018, 1, 5)
+        end = datetime.datetime(2018, 1, 25)
+        self.cluster.add_job(1, account, 'user1', 'cpu=2,mem=1024M,node=1', 20 * 24 * 60 * 60, start, end)
+
+        settings = self.fixture.service.settings
+        tasks.backfill_usage(settings.uuid.hex, [(2018, 1)], windows=4)
+
+        # Report of each window contains only the part of job within the window
+        usage = models.AllocationUsage.objects.get(allocation=allocation, year=2018, month=1)
+        self.assertEqual(usage.cpu_usage, 2 * 20 * 24 * 60)
+        backfill = models.UsageBackfill.objects.get(settings=settings, year=2018, month=1)
+        self.assertEqual(backfill.state, models.UsageBackfill.States.DONE)
+
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, SYNC_CHUNK_SIZE=1))
+    def test_usage_is_backfilled_in_chunks(self):
+        allocations = [self.fixture.allocation, factories.AllocationFactory(service_project_link=self.fixture.spl)]
+        backend = self.fixture.allocation.get_backend()
+        start = datetime.datetime(2018, 1, 5)
+        end = datetime.datetime(2018, 1, 25)
+        for job_id, allocation in enumerate(allocations, 1):
+            account = backend.get_allocation_name(allocation)
+            req_tres = 'cpu=%s,mem=1024M,node=1' % (2 * job_id)
+            self.cluster.add_job(job_id, account, 'user1', req_tres, 20 * 24 * 60 * 60, start, end)
+
+        with mock.patch('waldur_slurm.ledger.update_rollups') as update_rollups:
+            tasks.backfill_usage(self.fixture.service.settings.uuid.hex, [(2018, 1)], windows=2)
+
+        # Parts of job reported in each window of the chunk are summed
+        for job_id, allocation in enumerate(allocations, 1):
+            usage = models.AllocationUsage.objects.get(allocation=allocation, year=2018, month=1)
+            self.assertEqual(usage.cpu_usage, 2 * 20 * 24 * 60 * job_id)
+        self.assertEqual(update_rollups.call_count, 1)
+
+    def test_usage_of_job_spanning_months_is_split_between_them(self):
+        allocation = self.fixture.allocation
+        account = allocation.get_backend().get_allocation_name(allocation)
+        start = datetime.datetime(2018, 1, 25)
+        end = datetime.datetime(2018, 2, 5)
+        self.cluster.add_job(1, account, 'user1', 'cpu=2,mem=1024M,node=1', 11 * 24 * 60 * 60, start, end)
+
+        settings = self.fixture.service.settings
+        tasks.backfill_usage(settings.uuid.hex, [(2018, 1), (2018, 2)])
+
+        january = models.AllocationUsage.objects.get(allocation=allocation, year=2018, month=1)
+        self.assertEqual(january.cpu_usage, 2 * 7 * 24 * 60)
+        february = models.AllocationUsage.objects.get(allocation=allocation, year=2018, month=2)
+        self.assertEqual(february.cpu_usage, 2 * 4 * 24 * 60)
+        jobs = models.Job.objects.filter(allocation=allocation, job_id='1').order_by('month')
+        self.assertEqual([str(job.end) for job in jobs], ['2018-01-31', '2018-02-05'])
+
+    def test_usage_of_running_job_is_spread_between_days_when_it_was_running(self):
+        allocation = self.fixture.allocation
+        account = allocation.get_backend().get_allocation_name(allocation)
+        self.cluster.add_job(1, account, 'user1', 'cpu=2,mem=1024M,node=1', 3 * 24 * 60 * 60,
+                             datetime.datetime(2018, 1, 25, 12))
+
+        tasks.backfill_usage(self.fixture.service.settings.uuid.hex, [(2018, 1)])
+
+        daily = models.AllocationDailyUsage.objects.filter(allocation=allocation).order_by('date')
+        self.assertEqual([(str(usage.date), usage.cpu_usage) for usage in daily], [
+            ('2018-01-25', 2 * 12 * 60),
+            ('2018-01-26', 2 * 24 * 60),
+            ('2018-01-27', 2 * 24 * 60),
+            ('2018-01-28', 2 * 12 * 60),
+        ])
+
+    def test_moab_job_spanning_time_windows_is_backfilled_once(self):
+        settings = self.fixture.service.settings
+        settings.options = dict(settings.options, batch_service='MOAB')
+        settings.save()
+        allocation = self.fixture.allocation
+        account = allocation.get_backend().get_allocation_name(allocation)
+        start = datetime.datetime(2018, 1, 5)
+        end = datetime.datetime(2018, 1, 25)
+        self.cluster.add_job(1, account, 'user1', 'cpu=2,mem=1024M,node=1', 600, start, end, charge='1.50')
+
+        tasks.backfill_usage(settings.uuid.hex, [(2018, 1)], windows=4)
+
+        # MOAB reports usage of the whole job in each window
+        usage = models.AllocationUsage.objects.get(allocation=allocation, year=2018, month=1)
+        self.assertEqual(usage.cpu_usage, 2 * 10)
+        self.assertEqual(usage.deposit_usage, decimal.Decimal('1.50'))
+
+    def test_completed_month_is_not_backfilled_again(self):
+        settings = self.fixture.service.settings
+        models.UsageBackfill.objects.create(
+            settings=settings, year=2018, month=1, state=models.UsageBackfill.States.DONE)
+
+        tasks.backfill_usage(settings.uuid.hex, [(2018, 1)])
+        self.assertEqual(sum(self.cluster.executed_commands.values()), 0)
+
+
+class BenchmarkSmokeTest(TestCase):
+    def test_benchmark_runs_on_small_dataset(self):
+        benchmark = SyncBenchmark(allocations=3, users=2, jobs=20, burst=1)
+        results = benchmark.run()
+        self.assertEqual([result.name for result in results], ['sync_usage', 'create_allocation', 'role_granted'])
+        self.assertFalse(models.Allocation.objects.filter(name='allocation0').exists())
@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
-from django.test import TransactionTestCase
+from django.conf import settings
+from django.test import TransactionTestCase, override_settings
 import mock
 
 from waldur_core.core import utils as core_utils
@@ -8,7 +9,7 @@ from waldur_core.structure import models as structure_models
 from waldur_core.structure.tests import factories as structure_factories
 from waldur_freeipa import models as freeipa_models
 
-from .. import tasks
+from .. import tasks, utils
 from . import fixtures
 
 
@@ -52,6 +53,24 @@ class SlurmAssociationSynchronizationTest(TransactionTestCase):
             mock_client().create_association.assert_called_once_with(
                 self.freeipa_profile.username, account, 'waldur_user')
 
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, QUEUE_ROUTING_ENABLED=True))
+    def test_association_is_created_by_task_sent_to_queue_of_cluster(self):
+        allocation = self.fixture.allocation
+        self.customer.add_user(self.user, structure_models.CustomerRole.OWNER)
+
+        with mock.patch('waldur_slurm.tasks.add_allocations_user') as mock_task:
+            tasks.add_user(self.serialized_profile)
+            mock_task.apply_async.assert_called_once_with(
+                args=([allocation.uuid.hex], self.freeipa_profile.username),
+                queue='waldur_slurm_%s' % self.fixture.service.settings.uuid.hex,
+            )
+
+    @override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, QUEUE_ROUTING_ENABLED=True))
+    def test_clusters_of_the_same_group_share_queue(self):
+        service_settings = self.fixture.service.settings
+        service_settings.options['queue'] = 'small'
+        self.assertEqual(utils.get_queue_name(service_settings), 'waldur_slurm_small')
+
     def test_when_project_manager_role_is_granted_profile_is_synchronized(self):
         with mock.patch('waldur_slurm.tasks.process_role_granted') as mock_task:
             self.project.add_user(self.user, structure_models.ProjectRole.MANAGER)
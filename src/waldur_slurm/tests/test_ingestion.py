@@ -0,0 +1,90 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.test import override_settings
+from freezegun import freeze_time
+from rest_framework import status, test
+
+from .. import ledger, locks, models
+from . import factories, fixtures
+
+
+@freeze_time('2017-10-16 00:00:00')
+class JobsIngestTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.allocation = self.fixture.allocation
+        self.account = 'waldur_allocation_' + self.allocation.uuid.hex
+        self.url = factories.SlurmServiceFactory.get_url(self.fixture.service, 'ingest')
+        self.jobs = [
+            [self.account, 'cpu=2,mem=1M,node=1', '00:10:00', 'user1', '1', '2017-10-15T10:00:00'],
+            [self.account, 'cpu=1,mem=1M,node=1', '00:10:00', 'user1', '2', '2017-09-30T10:00:00'],
+        ]
+
+    def test_staff_can_ingest_jobs(self):
+        self.client.force_login(self.fixture.staff)
+        response = self.client.post(self.url, {'jobs': self.jobs}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'ingested': 2, 'updated': 0, 'skipped': 0})
+
+        self.allocation.refresh_from_db()
+        self.assertEqual(self.allocation.cpu_usage, 2 * 10)
+        usage = models.AllocationUsage.objects.get(allocation=self.allocation, year=2017, month=9)
+        self.assertEqual(usage.cpu_usage, 10)
+
+    def test_ingested_jobs_are_skipped(self):
+        self.client.force_login(self.fixture.staff)
+        self.client.post(self.url, {'jobs': self.jobs}, format='json')
+        response = self.client.post(self.url, {'jobs': self.jobs}, format='json')
+
+        self.assertEqual(response.data, {'ingested': 0, 'updated': 0, 'skipped': 2})
+        self.allocation.refresh_from_db()
+        self.assertEqual(self.allocation.cpu_usage, 2 * 10)
+
+    def test_jobs_with_changed_usage_are_updated(self):
+        self.client.force_login(self.fixture.staff)
+        self.client.post(self.url, {'jobs': self.jobs}, format='json')
+        self.jobs[0][2] = '00:20:00'
+        response = self.client.post(self.url, {'jobs': self.jobs}, format='json')
+
+        self.assertEqual(response.data, {'ingested': 0, 'updated': 1, 'skipped': 1})
+        self.allocation.refresh_from_db()
+        self.assertEqual(self.allocation.cpu_usage, 2 * 20)
+
+    def test_jobs_are_not_ingested_while_usage_is_synchronized(self):
+        self.client.force_login(self.fixture.staff)
+        lease = locks.Lease('usage:%s' % self.fixture.service.settings.uuid.hex)
+        lease.acquire()
+        self.addCleanup(lease.release)
+
+        with override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, LOCK_WAIT=0)):
+            response = self.client.post(self.url, {'jobs': self.jobs}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(models.Job.objects.exists())
+
+    def test_job_stored_concurrently_is_updated(self):
+        job = models.Job.objects.create(
+            settings=self.fixture.service.settings, job_id='1', year=2017, month=10, username='user1', cpu_usage=10)
+        duplicate = models.Job(
+            settings=job.settings, job_id='1', year=2017, month=10, username='user1', cpu_usage=20)
+
+        self.assertFalse(ledger.create_job(duplicate))
+        job.refresh_from_db()
+        self.assertEqual(job.cpu_usage, 20)
+
+    def test_usage_of_job_spanning_months_is_split_between_them(self):
+        self.client.force_login(self.fixture.staff)
+        jobs = [[self.account, 'cpu=1,mem=1M,node=1', '1-00:00:00', 'user1', '3', '2017-10-01T12:00:00']]
+        self.client.post(self.url, {'jobs': jobs}, format='json')
+
+        september = models.AllocationUsage.objects.get(allocation=self.allocation, year=2017, month=9)
+        self.assertEqual(september.cpu_usage, 12 * 60)
+        self.allocation.refresh_from_db()
+        self.assertEqual(self.allocation.cpu_usage, 12 * 60)
+        self.assertEqual(models.Job.objects.filter(job_id='3').count(), 2)
+
+    def test_owner_can_not_ingest_jobs(self):
+        self.client.force_login(self.fixture.owner)
+        response = self.client.post(self.url, {'jobs': self.jobs}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
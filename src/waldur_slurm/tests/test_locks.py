@@ -0,0 +1,63 @@
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from .. import locks
+
+
+class LeaseTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_lease_is_not_acquired_while_it_is_held(self):
+        with locks.single_flight('usage:cluster') as lease:
+            self.assertTrue(lease.acquired)
+            with locks.single_flight('usage:cluster') as concurrent_lease:
+                self.assertFalse(concurrent_lease.acquired)
+
+        with locks.single_flight('usage:cluster') as lease:
+            self.assertTrue(lease.acquired)
+
+    def test_lease_of_other_cluster_is_acquired(self):
+        with locks.single_flight('usage:cluster1'):
+            with locks.single_flight('usage:cluster2') as lease:
+                self.assertTrue(lease.acquired)
+
+    def test_expired_lease_acquired_by_another_worker_is_not_released(self):
+        lease = locks.Lease('usage:cluster')
+        lease.acquire()
+        cache.delete(lease.key)
+
+        other_lease = locks.Lease('usage:cluster')
+        self.assertTrue(other_lease.acquire())
+        lease.release()
+        self.assertEqual(cache.get(lease.key), other_lease.token)
+
+
+class SemaphoreTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_number_of_holders_is_limited(self):
+        semaphores = [locks.Semaphore('cluster', limit=2) for _ in range(3)]
+        self.assertTrue(semaphores[0].acquire())
+        self.assertTrue(semaphores[1].acquire())
+        self.assertFalse(semaphores[2].acquire())
+
+        semaphores[0].release()
+        self.assertTrue(semaphores[2].acquire())
+
+    def test_free_slot_is_reserved_for_earlier_waiter(self):
+        holder = locks.Semaphore('cluster', limit=1)
+        holder.acquire()
+        ticket = locks.Semaphore('cluster', limit=1).get_ticket()
+        waiter_key = locks.WAITER_KEY % ('cluster', ticket)
+        cache.set(waiter_key, True)
+        holder.release()
+
+        late_semaphore = locks.Semaphore('cluster', limit=1)
+        self.assertFalse(late_semaphore.acquire())
+
+        cache.delete(waiter_key)
+        self.assertTrue(late_semaphore.acquire())
@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+
+import subprocess  # nosec
+
+from django.core.cache import cache
+from django.urls import reverse
+import mock
+from rest_framework import status, test
+
+from waldur_core.structure.tests import factories as structure_factories
+
+from .. import base, metrics
+from ..client import SlurmClient
+
+
+class CommandKindTest(test.APISimpleTestCase):
+    def test_sacctmgr_subcommand_is_included(self):
+        command = ['sacctmgr', '--parsable2', '--noheader', '--immediate', 'show', 'account', 'foo']
+        self.assertEqual(base.get_command_kind(command), 'sacctmgr show')
+
+    def test_other_commands_are_described_by_name(self):
+        self.assertEqual(base.get_command_kind(['sacct', '--allusers']), 'sacct')
+        self.assertEqual(base.get_command_kind(['mam-list-accounts', '--raw']), 'mam-list-accounts')
+
+
+class CommandMetricsTest(test.APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.client_slurm = SlurmClient(hostname='cluster', key_path='/etc/waldur/id_rsa')
+        self.url = 'http://testserver' + reverse('slurm-metrics-list')
+
+    def get_metrics(self):
+        self.client.force_login(structure_factories.UserFactory(is_staff=True))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.content.decode('utf-8')
+
+    @mock.patch('subprocess.check_output')
+    def test_successful_command_is_recorded(self, check_output):
+        check_output.return_value = 'acc1|desc|org\nacc2|desc|org\n'
+        self.client_slurm.list_accounts()
+
+        content = self.get_metrics()
+        self.assertIn('waldur_slurm_commands_total{cluster="cluster",kind="sacctmgr list"} 1', content)
+        self.assertIn('waldur_slurm_command_output_lines_total{cluster="cluster",kind="sacctmgr list"} 2', content)
+        self.assertIn('waldur_slurm_command_duration_seconds_count{cluster="cluster",kind="sacctmgr list"} 1',
+                      content)
+
+    @mock.patch('subprocess.check_output')
+    def test_failed_command_is_recorded(self, check_output):
+        check_output.side_effect = subprocess.CalledProcessError(1, 'sacctmgr', 'Error')
+        with self.assertRaises(base.BatchError):
+            self.client_slurm.list_accounts()
+
+        content = self.get_metrics()
+        self.assertIn('waldur_slurm_command_failures_total{cluster="cluster",kind="sacctmgr list"} 1', content)
+
+    @mock.patch('subprocess.check_output')
+    def test_command_failed_without_exit_status_is_recorded(self, check_output):
+        check_output.side_effect = OSError('Connection refused')
+        with self.assertRaises(OSError):
+            self.client_slurm.list_accounts()
+
+        content = self.get_metrics()
+        self.assertIn('waldur_slurm_command_failures_total{cluster="cluster",kind="sacctmgr list"} 1', content)
+
+    def test_series_are_registered_once(self):
+        metrics.register_series('cluster', 'sacct')
+        metrics.register_series('cluster2', 'sacct')
+        metrics.register_series('cluster', 'sacct')
+        self.assertEqual(metrics.get_series(), [('cluster', 'sacct'), ('cluster2', 'sacct')])
+
+    @mock.patch('subprocess.check_output')
+    def test_wait_for_free_slot_is_recorded(self, check_output):
+        check_output.return_value = ''
+        self.client_slurm.max_concurrency = 1
+        self.client_slurm.list_accounts()
+
+        content = self.get_metrics()
+        self.assertIn('waldur_slurm_command_wait_seconds_count{cluster="cluster",kind="sacctmgr list"} 1', content)
+
+    @mock.patch('waldur_slurm.metrics.cache')
+    @mock.patch('subprocess.check_output')
+    def test_failure_of_metrics_storage_does_not_fail_command(self, check_output, metrics_cache):
+        check_output.return_value = 'acc1|desc|org\n'
+        metrics_cache.add.side_effect = ValueError('Cache is not available')
+        self.assertEqual(len(self.client_slurm.list_accounts()), 1)
+
+    @mock.patch('waldur_slurm.metrics.cache')
+    @mock.patch('subprocess.check_output')
+    def test_failure_of_metrics_storage_does_not_mask_error_of_command(self, check_output, metrics_cache):
+        check_output.side_effect = subprocess.CalledProcessError(1, 'sacctmgr', 'Error')
+        metrics_cache.add.side_effect = ValueError('Cache is not available')
+        with self.assertRaises(base.BatchError):
+            self.client_slurm.list_accounts()
+
+    def test_number_of_cache_operations_per_command_is_limited(self):
+        metrics.record_command('cluster', 'sacct', 0.2, 0, 10, 1)
+        with mock.patch('waldur_slurm.metrics.cache') as metrics_cache:
+            metrics_cache.add.return_value = False
+            metrics.record_command('cluster', 'sacct', 0.2, 0, 10, 1)
+        # Registration check and increments of output bytes, lines, duration sum and bucket
+        self.assertEqual(metrics_cache.add.call_count + metrics_cache.incr.call_count, 5)
+
+    def test_metrics_are_not_available_for_non_staff(self):
+        self.client.force_login(structure_factories.UserFactory())
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -1,6 +1,12 @@
-from django.test import TestCase
+import decimal
+import json
+
+from django.conf import settings
+from django.test import TestCase, override_settings
 import mock
 
+from waldur_slurm import parser, parser_json, parser_moab, utils
+from waldur_slurm.structures import Quotas
 from waldur_slurm.tests import fixtures
 
 VALID_ALLOCATION = 'allocation1'
@@ -59,3 +65,83 @@ class ParserTest(TestCase):
         report = self.get_report(REPORT_WITHOUT_GPU)
         total = report[VALID_ALLOCATION]['TOTAL_ACCOUNT_USAGE']
         self.assertEqual(total.gpu, 0)
+
+
+@override_settings(WALDUR_SLURM=dict(settings.WALDUR_SLURM, EXTRA_TRES=('billing', 'gres/gpu:tesla')))
+class ExtraTresTest(ParserTest):
+    def test_extra_tres_usage_is_calculated(self):
+        # Extra TRES are multiplied by number of nodes and duration like base resources
+        total = self.report[VALID_ALLOCATION]['TOTAL_ACCOUNT_USAGE']
+        self.assertEqual(total.extra, {'billing': 0, 'gres/gpu:tesla': 1 + 1 * 2 * 2})
+
+    def test_quotas_are_accumulated_in_place(self):
+        quotas = Quotas(cpu=1, extra={'billing': 10})
+        same = quotas
+        quotas += Quotas(cpu=2, extra={'billing': 5})
+        self.assertIs(quotas, same)
+        self.assertEqual(quotas.cpu, 3)
+        self.assertEqual(quotas.extra['billing'], 15)
+
+
+class ParseDurationTest(TestCase):
+    def test_duration_longer_than_day_is_parsed(self):
+        self.assertEqual(parser.parse_duration('2-01:30:00'), 2 * 24 * 60 + 90)
+
+    def test_duration_without_hours_is_parsed(self):
+        self.assertEqual(parser.parse_duration('05:59'), 5)
+
+
+class ParseStartTest(TestCase):
+    def test_start_is_reported_by_sacct(self):
+        line = 'allocation1|cpu=1,node=1|1-00:00:00|user1|1|Unknown|2017-10-15T12:00:00|'
+        record = parser.parse_line(line)
+        self.assertEqual((record.start, record.minutes), ('2017-10-15T12:00:00', 24 * 60))
+
+    def test_start_of_completed_job_is_calculated_from_its_end(self):
+        line = 'allocation1|cpu=1,node=1|01:30:00|user1|1|2017-10-16T01:00:00|'
+        self.assertEqual(parser.parse_line(line).start, '2017-10-15T23:30:00')
+
+
+class ParseChargeTest(TestCase):
+    def test_charge_is_parsed_to_cents(self):
+        self.assertEqual(parser_moab.parse_charge('12.3'), 1230)
+        self.assertEqual(parser_moab.parse_charge('-0.05'), -5)
+
+    def test_precise_charge_is_kept_exact(self):
+        cents = parser_moab.parse_charge('1.005')
+        self.assertEqual(utils.cents_to_decimal(cents), decimal.Decimal('1.005'))
+
+
+class JsonParserTest(TestCase):
+    def setUp(self):
+        job = {
+            'job_id': 10,
+            'account': 'allocation1',
+            'user': 'user1',
+            'time': {'elapsed': 120, 'end': 0},
+            'tres': {'requested': [
+                {'type': 'cpu', 'name': '', 'count': 2},
+                {'type': 'mem', 'name': '', 'count': 1024},
+                {'type': 'node', 'name': '', 'count': 2},
+                {'type': 'gres', 'name': 'gpu', 'count': {'set': True, 'number': 1}},
+            ]},
+        }
+        self.document = json.dumps({'meta': {}, 'jobs': [job, dict(job, job_id=11)], 'errors': []})
+
+    def test_jobs_are_parsed_from_chunks(self):
+        chunks = [self.document[index:index + 7] for index in range(0, len(self.document), 7)]
+        records = list(parser_json.parse_report(chunks))
+
+        self.assertEqual([record.job_id for record in records], ['10', '11'])
+        self.assertEqual(records[0].values, [2 * 2 * 2, 1 * 2 * 2, 1024 * 2**20 * 2 * 2, 0])
+        self.assertEqual(records[0].day, '')
+
+    def test_json_and_text_reports_are_equal(self):
+        line = 'allocation1|cpu=2,mem=1024M,node=2,gres/gpu=1|00:02:00|user1|10|Unknown|'
+        self.assertEqual(list(parser_json.parse_report([self.document]))[0], parser.parse_line(line))
+
+    @override_settings(TIME_ZONE='Europe/Tallinn')
+    def test_end_day_is_in_project_time_zone(self):
+        job = dict(json.loads(self.document)['jobs'][0], time={'elapsed': 120, 'end': 1514757600})
+        # 2017-12-31 22:00 UTC is already the next day in the project time zone
+        self.assertEqual(parser_json.parse_job(job).day, '2018-01-01')
@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+
+import datetime
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from freezegun import freeze_time
+import mock
+
+from .. import models, scheduling, tasks, transport
+from . import fixtures
+from .fake_cluster import FakeCluster
+
+ADAPTIVE_SYNC_SETTINGS = dict(
+    settings.WALDUR_SLURM,
+    ADAPTIVE_SYNC_ENABLED=True,
+    ADAPTIVE_SYNC_MIN_INTERVAL=300,
+    ADAPTIVE_SYNC_MAX_INTERVAL=6 * 3600,
+    ADAPTIVE_SYNC_REFERENCE_VELOCITY=60,
+)
+
+
+@override_settings(WALDUR_SLURM=ADAPTIVE_SYNC_SETTINGS)
+class SyncIntervalTest(TestCase):
+    def setUp(self):
+        self.allocation = fixtures.SlurmFixture().allocation
+
+    def test_dormant_allocation_is_synchronized_rarely(self):
+        self.allocation.usage_velocity = 0
+        self.assertEqual(scheduling.get_sync_interval(self.allocation), 6 * 3600)
+
+    def test_active_allocation_is_synchronized_more_often(self):
+        self.allocation.usage_velocity = 60
+        self.assertEqual(scheduling.get_sync_interval(self.allocation), 3 * 3600)
+
+    def test_allocation_near_limit_is_synchronized_with_minimal_interval(self):
+        self.allocation.cpu_limit = 1000
+        self.allocation.cpu_usage = 950
+        self.assertEqual(scheduling.get_sync_interval(self.allocation), 300)
+
+    def test_velocity_is_smoothed(self):
+        now = timezone.now()
+        self.allocation.usage_velocity = 100
+        self.allocation.last_usage_sync = now - datetime.timedelta(hours=2)
+        self.allocation.cpu_usage = 1000 + 2 * 60
+        self.assertEqual(scheduling.get_usage_velocity(self.allocation, 1000, now), (60 + 100) / 2.0)
+
+
+@override_settings(WALDUR_SLURM=ADAPTIVE_SYNC_SETTINGS)
+class SyncDueUsageTest(TestCase):
+    def setUp(self):
+        self.fixture = fixtures.SlurmFixture()
+        self.fixture.service.settings.options = {'hostname': 'fake.cluster'}
+        self.fixture.service.settings.save()
+
+        self.cluster = FakeCluster()
+        transport.register_transport('fake.cluster', self.cluster)
+        self.addCleanup(transport.unregister_transport, 'fake.cluster')
+
+    @freeze_time('2017-10-16 00:00:00')
+    def test_only_due_allocations_are_synchronized(self):
+        due = self.fixture.allocation
+        fresh = models.Allocation.objects.create(
+            service_project_link=self.fixture.spl,
+            name='fresh',
+            next_usage_sync=timezone.now() + datetime.timedelta(hours=1),
+        )
+
+        # Task of each cluster is executed by the current worker
+        with mock.patch.object(tasks.sync_usage, 'delay', side_effect=tasks.sync_usage):
+            tasks.sync_due_usage()
+
+        due.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(due.last_usage_sync, timezone.now())
+        self.assertIsNone(fresh.last_usage_sync)
+        self.assertEqual(due.next_usage_sync, timezone.now() + datetime.timedelta(hours=6))
+
+    @mock.patch('waldur_slurm.tasks.sync_usage')
+    def test_synchronization_of_cluster_is_sent_to_worker_if_queue_routing_is_disabled(self, sync_usage):
+        tasks.sync_due_usage()
+
+        settings_uuid = self.fixture.service.settings.uuid.hex
+        sync_usage.delay.assert_called_once_with(settings_uuid, [self.fixture.allocation.uuid.hex])
+        self.assertFalse(sync_usage.called)
@@ -0,0 +1,141 @@
+from __future__ import unicode_literals
+
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+import mock
+
+from .. import base, transport
+from ..client import SlurmClient
+from .fake_cluster import FakeCluster
+
+
+class RecordReplayTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'trace.jsonl.gz')
+
+        self.cluster = FakeCluster()
+        self.cluster.add_account('acc1', 'Secret project', 'org1')
+        now = datetime.datetime.now()
+        self.cluster.add_job(1, 'acc1', 'john', 'cpu=2,mem=1024M,node=1', 120, now, now)
+
+        recorder = transport.RecordingTransport(self.cluster, self.path)
+        self.client = SlurmClient(hostname='fake', key_path='', transport=recorder)
+
+    def test_recorded_usage_report_is_replayed(self):
+        expected = list(self.client.get_usage_report(['acc1']))
+
+        replay_client = SlurmClient(hostname='fake', key_path='', transport=transport.ReplayTransport(self.path))
+        actual = list(replay_client.get_usage_report(['acc1']))
+        self.assertEqual(expected, actual)
+
+    def test_user_names_are_redacted(self):
+        self.client.get_usage_report(['acc1'])
+        self.client.create_association('john', 'acc1')
+
+        records = list(transport.read_trace(self.path))
+        self.assertNotIn('john', records[0]['output'])
+        self.assertNotIn('john', ' '.join(records[1]['command']))
+        self.assertNotIn('john', records[1]['output'])
+
+        # Pseudonyms are stable, so that usage of the same user can be aggregated
+        pseudonym = records[0]['output'].split('|')[3]
+        self.assertIn(pseudonym, ' '.join(records[1]['command']))
+
+    def test_failed_command_is_replayed_as_error(self):
+        with self.assertRaises(base.BatchError):
+            self.client.create_association('john', 'missing_account')
+
+        replay_client = SlurmClient(hostname='fake', key_path='', transport=transport.ReplayTransport(self.path))
+        with self.assertRaises(base.BatchError):
+            replay_client.create_association('john', 'missing_account')
+
+    def test_missing_command_raises_error(self):
+        self.client.get_usage_report(['acc1'])
+        replay_client = SlurmClient(hostname='fake', key_path='', transport=transport.ReplayTransport(self.path))
+        with self.assertRaises(base.BatchError):
+            replay_client.list_accounts()
+
+    def test_account_description_and_organization_are_redacted(self):
+        self.client.list_accounts()
+
+        records = list(transport.read_trace(self.path))
+        self.assertNotIn('Secret project', records[0]['output'])
+        self.assertNotIn('org1', records[0]['output'])
+        self.assertEqual(records[0]['output'].split('|')[0], 'acc1')
+
+
+class StreamingTransport(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def execute(self, command):
+        return ''.join(self.chunks)
+
+    def execute_stream(self, command):
+        for chunk in self.chunks:
+            yield chunk
+
+
+class RecordingTransportTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'trace.jsonl.gz')
+
+    def test_command_failed_without_exit_status_is_recorded_and_replayed_as_error(self):
+        inner = mock.Mock(spec=['execute'])
+        inner.execute.side_effect = OSError('Connection refused')
+        recorder = transport.RecordingTransport(inner, self.path)
+        with self.assertRaises(OSError):
+            recorder.execute(['sacctmgr', 'list', 'account'])
+
+        record = list(transport.read_trace(self.path))[0]
+        self.assertEqual(record['exit_status'], base.UNKNOWN_EXIT_STATUS)
+        self.assertIn('Connection refused', record['error'])
+
+        with self.assertRaises(base.CommandError):
+            transport.ReplayTransport(self.path).execute(['sacctmgr', 'list', 'account'])
+
+    def test_streamed_output_is_yielded_in_chunks_and_recorded(self):
+        chunks = ['{"jobs": ', '[]}']
+        recorder = transport.RecordingTransport(StreamingTransport(chunks), self.path)
+        self.assertEqual(list(recorder.execute_stream(['sacct', '--json'])), chunks)
+
+        record = list(transport.read_trace(self.path))[0]
+        self.assertEqual(record['output'], ''.join(chunks))
+        replay = transport.ReplayTransport(self.path)
+        self.assertEqual(''.join(replay.execute_stream(['sacct', '--json'])), ''.join(chunks))
+
+    def test_output_is_recorded_if_wrapped_transport_does_not_stream(self):
+        recorder = transport.RecordingTransport(FakeCluster(), self.path)
+        output = ''.join(recorder.execute_stream(['sacctmgr', '--parsable2', '--noheader', 'list', 'account']))
+
+        record = list(transport.read_trace(self.path))[0]
+        self.assertEqual(record['output'], output)
+
+
+class RedactorTest(TestCase):
+    def setUp(self):
+        self.redactor = transport.Redactor()
+
+    def test_quoted_option_of_moab_command_is_redacted(self):
+        command = 'mam-create-account -a acc1 -d "Secret project" -o org1'.split()
+        redacted = self.redactor.redact_command(command)
+
+        self.assertNotIn('Secret', ' '.join(redacted))
+        self.assertNotIn('org1', ' '.join(redacted))
+        self.assertEqual(redacted[:3], ['mam-create-account', '-a', 'acc1'])
+        self.assertEqual(redacted[4], '"%s"' % self.redactor.pseudonym('Secret project'))
+
+    def test_values_are_redacted_regardless_of_case(self):
+        text = 'User=john Description=secret Organization="Secret org"'
+        redacted = self.redactor.redact_text(text)
+
+        self.assertNotIn('john', redacted)
+        self.assertNotIn('secret', redacted.lower())
@@ -0,0 +1,287 @@
+"""
+Transports deliver batch commands to the cluster. SSH transport is used by default,
+alternative transports can be registered for the cluster hostname,
+which is useful for testing and benchmarking. Traffic of any transport
+can be recorded to a trace file and replayed later.
+"""
+from __future__ import unicode_literals
+
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import six
+
+from .base import UNKNOWN_EXIT_STATUS, CommandError, SSHTransport, get_command_kind
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+
+
+def register_transport(hostname, transport):
+    _registry[hostname] = transport
+
+
+def unregister_transport(hostname):
+    _registry.pop(hostname, None)
+
+
+def get_transport(hostname):
+    """
+    Return transport registered for the given hostname or None if SSH transport should be used.
+    """
+    return _registry.get(hostname)
+
+
+class Redactor(object):
+    """
+    Replaces sensitive values with stable pseudonyms, so that the same value
+    is always replaced by the same pseudonym within a trace.
+    Each pattern should contain a single group which matches sensitive value, patterns are case-insensitive.
+    Besides patterns, user, description and organization columns of parsable
+    sacctmgr, sacct and MOAB output are redacted, as well as values of MOAB command options.
+    """
+
+    def __init__(self, patterns=None, salt=''):
+        if patterns is None:
+            patterns = DEFAULT_REDACT_PATTERNS
+        self.patterns = [re.compile(pattern, re.MULTILINE | re.IGNORECASE) for pattern in patterns]
+        self.salt = salt
+
+    def pseudonym(self, value):
+        if not value:
+            return value
+        digest = hashlib.sha1((self.salt + value).encode('utf-8')).hexdigest()
+        return 'redacted_%s' % digest[:10]
+
+    def redact_text(self, text):
+        for pattern in self.patterns:
+            text = pattern.sub(self._replace_group, text)
+        return text
+
+    def _replace_group(self, match):
+        start, end = match.span(1)
+        offset = match.start(0)
+        value = match.group(0)
+        return value[:start - offset] + self.pseudonym(match.group(1)) + value[end - offset:]
+
+    def redact_command(self, command):
+        moab = bool(command) and command[0].startswith('mam-')
+        result = []
+        index = 0
+        while index < len(command):
+            part = command[index]
+            previous = command[max(index - 2, 0):index]
+            if previous[-1:] and previous[-1] in USER_OPTIONS or previous == ['add', 'user']:
+                part = self.pseudonym(part)
+            elif moab and previous[-1:] and previous[-1] in MOAB_SENSITIVE_OPTIONS:
+                # Quoted value is split into several arguments, it is replaced by a single pseudonym
+                end = get_quoted_end(command, index)
+                value = ' '.join(command[index:end + 1])
+                if value.startswith('"') and value.endswith('"') and len(value) > 1:
+                    part = '"%s"' % self.pseudonym(value[1:-1])
+                else:
+                    part = self.pseudonym(value)
+                index = end
+            elif 'user' in command and part.lower().startswith('name='):
+                part = part[:len('name=')] + self.pseudonym(part[len('name='):])
+            else:
+                part = self.redact_text(part)
+            result.append(part)
+            index += 1
+        return result
+
+    def redact_output(self, command, output):
+        columns = self.get_sensitive_columns(command)
+        if columns:
+            lines = []
+            for line in output.splitlines():
+                parts = line.split('|')
+                for column in columns:
+                    if len(parts) > column:
+                        parts[column] = self.pseudonym(parts[column].strip())
+                lines.append('|'.join(parts))
+            output = '\n'.join(lines) + ('\n' if output.endswith('\n') else '')
+        return self.redact_text(output)
+
+    def get_sensitive_columns(self, command):
+        """
+        Return indexes of columns of parsable output which contain sensitive values.
+        """
+        if 'sacctmgr' in command:
+            if 'association' in command:
+                return [2]
+            if 'account' in command and ('list' in command or 'show' in command):
+                # Default format of account is Account|Descr|Org
+                return [1, 2]
+        for index, part in enumerate(command):
+            if part.startswith('--format='):
+                columns = part[len('--format='):]
+            elif part == '--show' and index + 1 < len(command):
+                columns = command[index + 1]
+            else:
+                continue
+            columns = [column.lower() for column in columns.split(',')]
+            return [position for position, column in enumerate(columns) if column in SENSITIVE_COLUMNS]
+        return []
+
+
+def get_quoted_end(command, index):
+    """
+    Return index of the last argument of value starting at the given index.
+    Value enclosed in double quotes may be split into several arguments.
+    """
+    if not command[index].startswith('"'):
+        return index
+    for end in range(index, len(command)):
+        part = command[end][1:] if end == index else command[end]
+        if part.endswith('"'):
+            return end
+    return len(command) - 1
+
+
+DEFAULT_REDACT_PATTERNS = (
+    r'([\w.+-]+@[\w-]+\.[\w.-]+)',
+    r'\bdescription="([^"]*)"',
+    r'\borganization="([^"]*)"',
+    r'\b(?:description|organization)=(?!")([^\s,|]+)',
+    r'\buser=([^\s,|]+)',
+    r'"user":\s*"([^"]*)"',
+    r'^\s*U = (\S+)',
+)
+
+# Command options followed by user name
+USER_OPTIONS = ('-u', '--add-user', '--del-user')
+
+# Options of MOAB commands followed by account description and organization
+MOAB_SENSITIVE_OPTIONS = ('-d', '-o')
+
+# Columns of parsable output which are redacted, column names are listed in the format option of command
+SENSITIVE_COLUMNS = ('user', 'description', 'descr', 'organization', 'org')
+
+
+class RecordingTransport(object):
+    """
+    Executes commands using wrapped transport and appends command, output and latency
+    to gzip-compressed trace file with JSON record per line.
+    Command failed without exit status, for example, because connection is refused,
+    is recorded with unknown exit status, so that it is replayed as error.
+    """
+
+    def __init__(self, transport, path, redactor=None):
+        self.transport = transport
+        self.path = path
+        self.redactor = redactor or Redactor()
+        self.lock = threading.Lock()
+
+    def execute(self, command):
+        return ''.join(self._execute(command, lambda: [self.transport.execute(command)]))
+
+    def execute_stream(self, command):
+        """
+        Yield output of command as it is streamed by wrapped transport. Output is accumulated
+        for the trace record, which is written when command is finished.
+        """
+        execute_stream = getattr(self.transport, 'execute_stream', None)
+        if execute_stream is None:
+            return [self.execute(command)]
+        return self._execute(command, lambda: execute_stream(command))
+
+    def _execute(self, command, get_chunks):
+        started = time.time()
+        record = {'exit_status': 0}
+        chunks = []
+        try:
+            for chunk in get_chunks():
+                chunks.append(chunk)
+                yield chunk
+            record['output'] = ''.join(chunks)
+        except CommandError as e:
+            record.update(exit_status=e.exit_status, output=e.output, error=six.text_type(e))
+            raise
+        except Exception as e:
+            record.update(exit_status=UNKNOWN_EXIT_STATUS, output=''.join(chunks), error=six.text_type(e))
+            raise
+        finally:
+            record['latency'] = time.time() - started
+            record['command'] = command
+            self.write(record)
+
+    def write(self, record):
+        record['output'] = self.redactor.redact_output(record['command'], record.get('output') or '')
+        if 'error' in record:
+            record['error'] = self.redactor.redact_text(record['error'])
+        record['command'] = self.redactor.redact_command(record['command'])
+        line = json.dumps(record) + '\n'
+        try:
+            with self.lock:
+                # Each record is written as a separate gzip member,
+                # so that trace stays readable even if process is killed.
+                with gzip.open(self.path, 'ab') as trace:
+                    trace.write(line.encode('utf-8'))
+        except (IOError, OSError):
+            logger.exception('Unable to write command trace to %s.', self.path)
+
+
+def read_trace(path):
+    with gzip.open(path, 'rb') as trace:
+        for line in trace:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
+
+
+class ReplayTransport(object):
+    """
+    Serves outputs of recorded commands in the order they were recorded.
+    :param match: "kind" matches commands by kind, such as "sacctmgr show" or "sacct",
+                  so that changed arguments such as dates do not prevent replay;
+                  "command" requires exact match of command.
+    :param realtime: if True, recorded latency is reproduced.
+    """
+
+    def __init__(self, path, match='kind', realtime=False):
+        self.match = match
+        self.realtime = realtime
+        self.records = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        for record in read_trace(path):
+            self.records[self.get_key(record['command'])].append(record)
+
+    def get_key(self, command):
+        if self.match == 'command':
+            return tuple(command)
+        return get_command_kind(command)
+
+    def execute(self, command):
+        with self.lock:
+            queue = self.records.get(self.get_key(command))
+            if not queue:
+                raise CommandError('Command is not found in trace: %s' % ' '.join(command))
+            record = queue.popleft()
+
+        if self.realtime:
+            time.sleep(record['latency'])
+
+        if record['exit_status'] != 0:
+            raise CommandError(record.get('error', ''), record['exit_status'], record['output'])
+        return record['output']
+
+    def execute_stream(self, command):
+        """
+        Yield recorded output in chunks of the same size as SSH transport reads them.
+        """
+        output = self.execute(command)
+        for index in range(0, len(output), SSHTransport.CHUNK_SIZE):
+            yield output[index:index + SSHTransport.CHUNK_SIZE]
+
+
+def get_trace_path(trace_dir, hostname):
+    return os.path.join(trace_dir, '%s-%s.jsonl.gz' % (hostname, time.strftime('%Y%m%d')))
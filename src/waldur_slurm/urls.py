@@ -7,3 +7,5 @@ def register_in(router):
                     base_name='slurm-spl')
     router.register(r'slurm-allocation', views.AllocationViewSet, base_name='slurm-allocation')
     router.register(r'slurm-allocation-usage', views.AllocationUsageViewSet, base_name='slurm-allocation-usage')
+    router.register(r'slurm-usage-rollup', views.UsageRollupViewSet, base_name='slurm-usage-rollup')
+    router.register(r'slurm-metrics', views.MetricsViewSet, base_name='slurm-metrics')
@@ -1,6 +1,16 @@
-from django.utils import timezone
+import calendar
+import collections
+import datetime
+import decimal
+import json
+import time
+import uuid
 
-from waldur_core.core import utils as core_utils
+from django.conf import settings as django_settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
 
 MAPPING = {
     'cpu_usage': 'nc_cpu_usage',
@@ -13,8 +23,240 @@ FIELD_NAMES = MAPPING.keys()
 QUOTA_NAMES = MAPPING.values()
 
 
+def cents_to_decimal(cents):
+    """
+    Convert amount accumulated in cents to Decimal with two decimal places.
+    """
+    return decimal.Decimal(cents).scaleb(-2)
+
+
 def format_current_month():
     today = timezone.now()
-    month_start = core_utils.month_start(today).strftime('%Y-%m-%d')
-    month_end = core_utils.month_end(today).strftime('%Y-%m-%d')
-    return month_start, month_end
+    return get_month_windows(today.year, today.month)[0]
+
+
+def get_timestamp(value):
+    """
+    Convert date formatted as YYYY-MM-DD to UNIX timestamp of its midnight in the project time zone.
+    """
+    date = datetime.datetime.strptime(value, '%Y-%m-%d')
+    return calendar.timegm(timezone.make_aware(date).utctimetuple())
+
+
+def parse_month(value):
+    """
+    Convert string formatted as YYYY-MM to (year, month) pair.
+    """
+    date = datetime.datetime.strptime(value, '%Y-%m')
+    return date.year, date.month
+
+
+def get_month_range(start, end):
+    """
+    Return list of (year, month) pairs between start and end months inclusive.
+    """
+    months = []
+    year, month = start
+    while (year, month) <= tuple(end):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def get_month_windows(year, month, count=1):
+    """
+    Split month into adjacent time windows of whole days. End date of window is exclusive,
+    it is the start date of the next window, so that windows do not overlap.
+    Usage report is truncated to the window, therefore job running across boundary
+    of windows is reported in each of them with the part of usage within the window.
+    :return: list of (start, end) pairs of dates formatted as YYYY-MM-DD
+    """
+    days = calendar.monthrange(year, month)[1]
+    count = max(1, min(count, days))
+    start = datetime.date(year, month, 1)
+    bounds = [start + datetime.timedelta(days=days * index // count) for index in range(count + 1)]
+    return [(bounds[index].strftime('%Y-%m-%d'), bounds[index + 1].strftime('%Y-%m-%d'))
+            for index in range(count)]
+
+
+def iterate_chunks(queryset, size, start_after=None):
+    """
+    Iterate over queryset in chunks ordered by primary key. Each chunk is fetched by separate
+    query starting after the last row of previous chunk, so that database cursor is not kept
+    open while chunk is processed and committed.
+    :param start_after: optional primary key, rows up to it are skipped
+    :return: iterator of lists of model instances
+    """
+    queryset = queryset.order_by('pk')
+    if start_after:
+        queryset = queryset.filter(pk__gt=start_after)
+    chunk = list(queryset[:size])
+    while chunk:
+        yield chunk
+        chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:size])
+
+
+def get_queue_name(service_settings):
+    """
+    Return name of Celery queue for tasks of the cluster or None if queue routing is disabled.
+    Clusters with the same queue option share the queue, so that small clusters can be served
+    by the same workers, otherwise each cluster has its own queue.
+    """
+    options = django_settings.WALDUR_SLURM
+    if not options.get('QUEUE_ROUTING_ENABLED', False):
+        return None
+    name = service_settings.options.get('queue') or service_settings.uuid.hex
+    return '%s%s' % (options.get('QUEUE_PREFIX', 'waldur_slurm_'), name)
+
+
+VersionStamp = collections.namedtuple('VersionStamp', ['token', 'timestamp'])
+
+VERSION_STAMP_GLOBAL_SCOPE = 'global'
+
+# Changes of related objects, such as projects and permissions, may affect allocations of any scope
+VERSION_STAMP_SHARED_SCOPE = 'shared'
+
+VERSION_STAMP_TIMEOUT = 60 * 60
+
+
+def get_version_stamp_key(scope=None):
+    if scope is None:
+        scope = VERSION_STAMP_GLOBAL_SCOPE
+    return 'waldur_slurm:version_stamp:%s' % scope
+
+
+def _get_version_stamp(scope):
+    key = get_version_stamp_key(scope)
+    stamp = cache.get(key)
+    if stamp is None:
+        stamp = _make_version_stamp()
+        if not cache.add(key, stamp, VERSION_STAMP_TIMEOUT):
+            stamp = cache.get(key) or stamp
+    return VersionStamp(*stamp)
+
+
+def get_version_stamp(scope=None):
+    """
+    Return version stamp of allocation data for the given scope.
+    Scope is primary key of service settings. If scope is not specified,
+    stamp covers allocations of all SLURM service settings.
+    Stamp of service settings is combined with shared stamp, so that it is
+    invalidated by changes which are not specific to service settings.
+    """
+    stamp = _get_version_stamp(scope)
+    if scope is None:
+        return stamp
+    shared = _get_version_stamp(VERSION_STAMP_SHARED_SCOPE)
+    return VersionStamp(stamp.token + shared.token, max(stamp.timestamp, shared.timestamp))
+
+
+def bump_version_stamp(scope=None):
+    """
+    Invalidate version stamp of the given scope and global version stamp.
+    If scope is not specified, shared stamp is invalidated, so that stamps of all scopes change.
+    """
+    keys = [get_version_stamp_key(), get_version_stamp_key(VERSION_STAMP_SHARED_SCOPE if scope is None else scope)]
+    stamp = _make_version_stamp()
+    cache.set_many({key: stamp for key in keys}, VERSION_STAMP_TIMEOUT)
+
+
+def _make_version_stamp():
+    return uuid.uuid4().hex, int(time.time())
+
+
+def is_cache_shared():
+    """
+    Return False if cache is local to the process, so that changes of version stamps,
+    locks and metrics made by Celery workers are not visible to other processes.
+    """
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (DummyCache, LocMemCache))
+
+
+class JsonStreamReader(object):
+    """
+    Decodes JSON document from iterable of text chunks, so that large document
+    is processed without loading it into memory at once.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+
+    def read(self):
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Return the next non-whitespace character without consuming it.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                raise ValueError('Unexpected end of JSON document.')
+
+    def expect(self, *chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('Expected %s but got %r.' % (' or '.join(repr(c) for c in chars), char))
+        self.position += 1
+        return char
+
+    def decode(self):
+        """
+        Decode the next value. Value which ends exactly at the end of buffer
+        may continue in the next chunk, for example number, so that it is decoded again.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if not self.read():
+                    raise
+                continue
+            if end == len(self.buffer) and self.read():
+                continue
+            self.position = end
+            return value
+
+
+def iter_json_array(chunks, key):
+    """
+    Yield items of array stored under the given key of top-level JSON object.
+    Items are decoded one by one, other values of the object are decoded and skipped.
+    :param chunks: iterable of text chunks
+    """
+    reader = JsonStreamReader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+
+    while True:
+        name = reader.decode()
+        reader.expect(':')
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.decode()
+                if reader.expect(',', ']') == ']':
+                    return
+        reader.decode()
+        if reader.expect(',', '}') == '}':
+            return
@@ -1,17 +1,171 @@
+from functools import reduce
+import hashlib
+
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.utils.translation import ugettext_lazy as _
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import decorators, permissions, response, status, viewsets
+from rest_framework import decorators, exceptions, permissions, response, status, viewsets
+import six
 
+from waldur_core.core import validators as core_validators
 from waldur_core.structure import filters as structure_filters
 from waldur_core.structure import views as structure_views
 from waldur_core.structure import permissions as structure_permissions
 
-from . import executors, filters, models, serializers
+from . import executors, export, filters, ingestion, metrics, models, pagination, profiling, serializers, tasks, utils
+
+
+class ConditionalGetMixin(object):
+    """
+    Allocation data is changed only by backend synchronization and executors.
+    Therefore version stamp is used as a validator for ETag header,
+    so that response is not rendered at all if client already has the latest version.
+    Last-Modified header is not used, because it has granularity of one second.
+    Version stamps are bumped by Celery workers, so that conditional requests are supported
+    only if cache is shared by all processes, see utils.is_cache_shared.
+    """
+
+    # Path to ID of service settings of the object, for example "service_project_link.service.settings_id",
+    # global version stamp is used if it is not set
+    version_scope_path = None
+
+    def get_version_scope(self, obj):
+        if not self.version_scope_path:
+            return None
+        return reduce(getattr, self.version_scope_path.split('.'), obj)
+
+    def is_conditional(self):
+        return django_settings.WALDUR_SLURM.get('CONDITIONAL_GET_ENABLED', True) and utils.is_cache_shared()
+
+    def get_etag(self, request, stamp):
+        key = '|'.join([
+            str(request.user.pk),
+            request.get_full_path(),
+            request.META.get('HTTP_ACCEPT', ''),
+            stamp.token,
+        ])
+        return quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def get_conditional_response(self, request, stamp, render):
+        etag = self.get_etag(request, stamp)
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        result = render()
+        result['ETag'] = etag
+        return result
+
+    def list(self, request, *args, **kwargs):
+        render = super(ConditionalGetMixin, self).list
+        if not self.is_conditional():
+            return render(request, *args, **kwargs)
+        stamp = utils.get_version_stamp()
+        return self.get_conditional_response(request, stamp, lambda: render(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+
+        def render():
+            return response.Response(self.get_serializer(instance).data)
+
+        if not self.is_conditional():
+            return render()
+        stamp = utils.get_version_stamp(self.get_version_scope(instance))
+        return self.get_conditional_response(request, stamp, render)
 
 
 class SlurmServiceViewSet(structure_views.BaseServiceViewSet):
     queryset = models.SlurmService.objects.all()
     serializer_class = serializers.ServiceSerializer
 
+    @decorators.detail_route(methods=['get', 'post'])
+    def sync_profiles(self, request, uuid=None):
+        """
+        GET returns summaries of the latest usage synchronization runs of service settings.
+        POST requests cProfile report for the next synchronization run.
+        """
+        service_settings = self.get_object().settings
+        if request.method == 'POST':
+            profiling.request_profile_dump(service_settings)
+            return response.Response({'status': _('Profile will be collected during next synchronization.')},
+                                     status=status.HTTP_202_ACCEPTED)
+        return response.Response(profiling.get_sync_profiles(service_settings))
+
+    sync_profiles_permissions = [structure_permissions.is_staff]
+
+    @decorators.detail_route(methods=['get', 'post'])
+    def backfill(self, request, uuid=None):
+        """
+        GET returns progress of usage backfill of service settings.
+        POST schedules recalculation of usage for the given range of past months, for example:
+
+            {
+                "start": "2018-01",
+                "end": "2018-03",
+                "windows": 4
+            }
+
+        Months which are already backfilled are skipped unless force flag is set.
+        """
+        service_settings = self.get_object().settings
+        if request.method == 'GET':
+            queryset = models.UsageBackfill.objects.filter(settings=service_settings)
+            return response.Response(serializers.UsageBackfillSerializer(queryset, many=True).data)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        months = serializer.validated_data['months']
+        force = serializer.validated_data['force']
+
+        with transaction.atomic():
+            for year, month in months:
+                backfill, _ = models.UsageBackfill.objects.get_or_create(
+                    settings=service_settings, year=year, month=month)
+                if force or backfill.state != models.UsageBackfill.States.DONE:
+                    backfill.state = models.UsageBackfill.States.PENDING
+                    backfill.save(update_fields=['state', 'modified'])
+
+            transaction.on_commit(lambda: tasks.send_to_cluster(tasks.backfill_usage, service_settings, (
+                service_settings.uuid.hex, months, serializer.validated_data['windows'], force)))
+
+        return response.Response({'status': _('Usage backfill was scheduled.')}, status=status.HTTP_202_ACCEPTED)
+
+    backfill_permissions = [structure_permissions.is_staff]
+    backfill_serializer_class = serializers.UsageBackfillRequestSerializer
+
+    @decorators.detail_route(methods=['post'])
+    def ingest(self, request, uuid=None):
+        """
+        Push completed jobs reported by agent running on the cluster, for example:
+
+            {
+                "jobs": [
+                    ["waldur_allocation_<uuid>", "cpu=2,mem=4G,node=1", "01:00:00", "alice", "1234", "2018-01-05T10:00:00"]
+                ]
+            }
+
+        Fields of job are the same as in output of
+        sacct --parsable2 --format=Account,ReqTRES,Elapsed,User,JobID,End.
+        Jobs which have been already ingested with the same usage are skipped,
+        jobs with changed usage are updated.
+        """
+        service_settings = self.get_object().settings
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            ingested, updated, skipped = ingestion.ingest_jobs(service_settings, serializer.validated_data['jobs'])
+        except ingestion.IngestionConflict as e:
+            return response.Response({'detail': six.text_type(e)}, status=status.HTTP_409_CONFLICT)
+        return response.Response({'ingested': ingested, 'updated': updated, 'skipped': skipped})
+
+    ingest_permissions = [structure_permissions.is_staff]
+    ingest_serializer_class = serializers.JobsIngestSerializer
+
 
 class SlurmServiceProjectLinkViewSet(structure_views.BaseServiceProjectLinkViewSet):
     queryset = models.SlurmServiceProjectLink.objects.all()
@@ -19,7 +173,12 @@ class SlurmServiceProjectLinkViewSet(structure_views.BaseServiceProjectLinkViewS
     filter_class = filters.SlurmServiceProjectLinkFilter
 
 
-class AllocationViewSet(structure_views.BaseResourceViewSet):
+def validate_allocation_is_active(allocation):
+    if not allocation.is_active:
+        raise exceptions.ValidationError(_('Allocation is already cancelled.'))
+
+
+class AllocationViewSet(ConditionalGetMixin, structure_views.BaseResourceViewSet):
     queryset = models.Allocation.objects.all()
     serializer_class = serializers.AllocationSerializer
     filter_class = filters.AllocationFilter
@@ -36,19 +195,99 @@ class AllocationViewSet(structure_views.BaseResourceViewSet):
     @decorators.detail_route(methods=['post'])
     def cancel(self, request, uuid=None):
         allocation = self.get_object()
-        allocation.get_backend().cancel_allocation(allocation)
-        return response.Response(status=status.HTTP_200_OK)
+        executors.AllocationCancelExecutor.execute(allocation)
+        return response.Response({'status': _('Cancel operation was scheduled.')}, status=status.HTTP_202_ACCEPTED)
 
     cancel_permissions = [structure_permissions.is_owner]
+    cancel_validators = [core_validators.StateValidator(models.Allocation.States.OK),
+                         validate_allocation_is_active]
+
+    @decorators.list_route(methods=['post'])
+    def set_limits(self, request):
+        """
+        Update limits of many allocations at once. Allocations are grouped by
+        service settings and limits of each group are applied by a single background task.
+        Result of update is reported via allocation state and error message.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        groups = {}
+        with transaction.atomic():
+            for item in serializer.validated_data['limits']:
+                allocation = item.pop('allocation')
+                for field, value in item.items():
+                    setattr(allocation, field, value)
+                allocation.schedule_updating()
+                allocation.save(update_fields=list(item.keys()) + ['state'])
+                service_settings = allocation.service_project_link.service.settings
+                groups.setdefault(service_settings, []).append(allocation.uuid.hex)
+
+            for service_settings, allocation_uuids in groups.items():
+                transaction.on_commit(lambda settings=service_settings, uuids=allocation_uuids: tasks.send_to_cluster(
+                    tasks.set_resource_limits_bulk, settings, (uuids,)))
+
+        return response.Response({'status': _('Limits update was scheduled.')}, status=status.HTTP_202_ACCEPTED)
+
+    set_limits_permissions = [structure_permissions.is_staff]
+    set_limits_serializer_class = serializers.AllocationLimitsBulkSerializer
 
+    version_scope_path = 'service_project_link.service.settings_id'
 
-class AllocationUsageViewSet(viewsets.ReadOnlyModelViewSet):
+
+class AllocationUsageViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = models.AllocationUsage.objects.all()
     serializer_class = serializers.AllocationUsageSerializer
-    lookup_field = 'uuid'
     permission_classes = (permissions.IsAuthenticated,)
     filter_backends = (structure_filters.GenericRoleFilter, DjangoFilterBackend)
     filter_class = filters.AllocationUsageFilter
+    pagination_class = pagination.OptionalCursorPagination
+    version_scope_path = 'allocation.service_project_link.service.settings_id'
+
+    @decorators.list_route()
+    def export(self, request):
+        """
+        Stream filtered allocation usage as CSV or newline-delimited JSON.
+        Use file_format query parameter to choose format, CSV is used by default.
+        """
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in export.EXPORT_FORMATS:
+            raise exceptions.ValidationError({
+                'file_format': _('Supported formats are: %s.') % ', '.join(sorted(export.EXPORT_FORMATS))
+            })
+
+        renderer, content_type = export.EXPORT_FORMATS[file_format]
+        queryset = self.filter_queryset(self.get_queryset()).order_by('pk')
+        rows = export.iter_usage_rows(queryset)
+
+        stream = StreamingHttpResponse(export.iter_chunks(renderer(rows)), content_type=content_type)
+        stream['Content-Disposition'] = 'attachment; filename="allocation_usage.%s"' % file_format
+        return stream
+
+
+class UsageRollupViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Usage of allocations, projects and organizations summed per day or month.
+    Use level and period filters to select series, for example ?level=project&period=day.
+    """
+    queryset = models.UsageRollup.objects.all().select_related('allocation', 'project', 'customer')
+    serializer_class = serializers.UsageRollupSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+    filter_backends = (structure_filters.GenericRoleFilter, DjangoFilterBackend)
+    filter_class = filters.UsageRollupFilter
+    pagination_class = pagination.LinkHeaderCursorPagination
+    # Customer rollups combine allocations of many clusters, so that global version stamp is used
+    version_scope_path = None
+
+
+class MetricsViewSet(viewsets.ViewSet):
+    """
+    Batch commands metrics in Prometheus text format.
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def list(self, request):
+        return HttpResponse(metrics.render_metrics(), content_type='text/plain; version=0.0.4')
 
 
 def get_project_allocation_count(project):